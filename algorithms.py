@@ -14,6 +14,7 @@ Application: classic algorithms,
     CCA: Canonical correlation analysis
         Refer: None
     Extended CCA: Extended Canonical correlation analysis
+        (ecca_fit & ecca_predict: fused version for many classes and test trials)
         Refer: Nakanishi, et al. "Enhancing detection of SSVEPs for a high-speed brain speller using task-related component analysis."
             IEEE Trans. Biomed. Eng. 65.1 (2017): 104-112.
     tt-CCA: Transfer Template CCA
@@ -26,8 +27,11 @@ Application: classic algorithms,
 '''
 import numpy as np
 from numpy import linalg as LA
+from scipy import linalg as sLA
 from sklearn.cross_decomposition import CCA
 
+from mcee import (trca_matrix, sin_bank)
+
 def trca_compute(Xin, subspace_idx=None):
     '''
     task-related component analysis (TRCA)
@@ -43,7 +47,7 @@ def trca_compute(Xin, subspace_idx=None):
             (n_channels * n_channels)
     '''
     # print('Now, algorithm TRCA is running...')
-    n_chans = Xin.shape[0]
+    n_times = Xin.shape[1]
     n_epochs = Xin.shape[2]
 
     # zero means
@@ -51,19 +55,13 @@ def trca_compute(Xin, subspace_idx=None):
     # Xin_std = Xin.std(axis=1, ddof=1, keepdims=True)
     Xin = (Xin-values_mean)  # /Xin_std
 
-    S = np.zeros((n_chans, n_chans))
-    # computation of correlation matrices
-    for epoch_i in range(n_epochs):
-        for epoch_j in range(n_epochs):
-            Xin_i = Xin[:,:,epoch_i]
-            Xin_j = Xin[:,:,epoch_j]
-            S += np.dot(Xin_i, Xin_j.T)
-
-    Xin_i2 = Xin.reshape((Xin.shape[0], -1), order='F')
-    Xin_i2 = Xin_i2 - Xin_i2.mean(axis=1, keepdims=True)
-    Q = np.dot(Xin_i2, Xin_i2.T)
+    # computation of correlation matrices (shared kernel, epochs already zero-mean)
+    S, Q = trca_matrix(Xin.transpose((2, 0, 1)))
+    Q *= n_epochs*n_times
+    S = S*n_times + Q  # including the i == j terms
 
-    eig_vals, eig_vectors = LA.eig(np.dot(LA.inv(Q),S)) # or LA.pinv for general
+    eig_vals, eig_vectors = sLA.eigh(S, Q)
+    eig_vectors /= LA.norm(eig_vectors, axis=0, keepdims=True)
 
     eig_vectors = eig_vectors[:, eig_vals.argsort()[::-1]] # return indices in ascending order and reverse
 
@@ -93,8 +91,8 @@ def cca_manu(Xin, Yin):
         Yin = Yin.mean(axis=-1, keepdims=False)
 
     # print('Now, algorithm cca_manu is running...')
-    Xin -= Xin.mean(axis=1, keepdims=True)
-    Yin -= Yin.mean(axis=1, keepdims=True)
+    Xin = Xin - Xin.mean(axis=1, keepdims=True)
+    Yin = Yin - Yin.mean(axis=1, keepdims=True)
     cov_xx = np.cov(Xin, rowvar=True, bias=False)
     cov_yy = np.cov(Yin, rowvar=True, bias=False)
     # cross covariance
@@ -166,17 +164,11 @@ def extended_cca(Xtest, Xtrain, freq_stim, fs, t_begin, t_end, n_hf=5, init_phas
     Xtest -= Xtest.mean(axis=1, keepdims=True)
 
     init_phase = 0 if init_phase is None else init_phase
-    t1 = np.ceil(fs*t_begin)
-    t2 = np.ceil(fs*t_end)
-    t_time = np.arange(t1, t2+1, 1)/fs
-
-    # generate sin-cos template
-    Yf = None
-    for idx_hf in range(1, n_hf+1):
-        sin_tmp = np.sin(2*np.pi*freq_stim*idx_hf*t_time+init_phase)
-        cos_tmp = np.cos(2*np.pi*freq_stim*idx_hf*t_time+init_phase)
-        Yf_tmp = np.vstack((sin_tmp, cos_tmp)).T
-        Yf = Yf_tmp if Yf is None else np.hstack((Yf, Yf_tmp))  # n_time * n_chans
+    t1 = int(np.ceil(fs*t_begin))
+    t2 = int(np.ceil(fs*t_end))
+
+    # sin-cos template from the shared reference bank (read-only)
+    Yf = sin_bank(freq_stim, n_hf, t2-t1+1, init_phase/np.pi, fs, t1).T  # n_time * n_chans
 
     # recognition by extended CCA
     n_chans, n_features = Xtrain.shape
@@ -215,6 +207,110 @@ def extended_cca(Xtest, Xtrain, freq_stim, fs, t_begin, t_end, n_hf=5, init_phas
 
     return rr_fusion
 
+def _inv_sqrt(cov):
+    '''
+    batched inverse square root of covariance matrices (same form as cca_manu)
+    :param cov: ndarray, (..., n, n)
+    :return: ndarray, (..., n, n)
+    '''
+    U, sigma, VT = LA.svd(cov)
+    return (U * sigma[..., None, :]**(-0.5)) @ VT
+
+def _flat_corr(Xin, Yin):
+    '''
+    correlation coefficient of two flattened projections, batched over leading dims
+    :param Xin: ndarray, (..., n_dims, n_time)
+    :param Yin: ndarray, (..., n_dims, n_time)
+    :return: ndarray, (...)
+    '''
+    Xin = Xin.reshape(Xin.shape[:-2] + (-1,))
+    Yin = Yin.reshape(Yin.shape[:-2] + (-1,))
+    Xin = Xin - Xin.mean(axis=-1, keepdims=True)
+    Yin = Yin - Yin.mean(axis=-1, keepdims=True)
+    return (Xin*Yin).sum(axis=-1) / np.sqrt((Xin**2).sum(axis=-1) * (Yin**2).sum(axis=-1))
+
+def ecca_fit(Xtrain, freq_stim, fs, t_begin, t_end, n_hf=5, init_phase=None, subspace=None):
+    '''
+    Fused extended CCA, training part: factors of each class's template and sin-cos reference
+        (covariance, inverse square root, template-reference CCA filters) are computed only once.
+    :param Xtrain: 4D, ndarray.
+        (n_classes * n_channels * n_features * n_epochs)
+    :param freq_stim: list of float, unit: Hz.
+        stimulation frequency of each class.
+    :param fs, t_begin, t_end, n_hf, init_phase, subspace: see extended_cca.
+    :return: model: dict,
+        shared factors for ecca_predict.
+    '''
+    if t_begin > t_end:
+        raise ValueError('t_begin should be less than t_end.')
+    if len(freq_stim) != Xtrain.shape[0]:
+        raise ValueError('Each class should have its own stimulation frequency.')
+
+    # zero means
+    template = Xtrain.mean(axis=-1)  # n_classes * n_chans * n_time
+    template = template - template.mean(axis=-1, keepdims=True)
+    n_classes, n_chans, n_features = template.shape
+    if subspace is None:
+        subspace = int(np.ceil(n_chans/2)) if n_chans <= n_features else int(np.ceil(n_features/2))
+
+    init_phase = 0 if init_phase is None else init_phase
+    t1 = int(np.ceil(fs*t_begin))
+    t2 = int(np.ceil(fs*t_end))
+    Yf = np.stack([sin_bank(freq, n_hf, t2-t1+1, init_phase/np.pi, fs, t1) for freq in freq_stim])
+    Yf = Yf - Yf.mean(axis=-1, keepdims=True)  # n_classes * (2*n_hf) * n_time
+
+    inv_2_tt = _inv_sqrt(template @ template.swapaxes(-1, -2) / (n_features-1))
+    inv_2_yy = _inv_sqrt(Yf @ Yf.swapaxes(-1, -2) / (n_features-1))
+
+    # CCA between template and reference (the 4th coefficient)
+    M = inv_2_tt @ (template @ Yf.swapaxes(-1, -2) / (n_features-1)) @ inv_2_yy
+    u_ty = inv_2_tt @ LA.svd(M)[0][..., :subspace]
+
+    return {'template': template, 'Yf': Yf, 'inv_2_tt': inv_2_tt, 'inv_2_yy': inv_2_yy,
+            'proj_ty': u_ty.swapaxes(-1, -2) @ template, 'u_ty': u_ty, 'subspace': subspace}
+
+def ecca_predict(Xtest, model):
+    '''
+    Fused extended CCA, test part: each test trial is whitened only once,
+        then the CCA of all classes is solved by batched SVD.
+    :param Xtest: 2D/3D, ndarray.
+        (n_channels * n_features) or (n_tests * n_channels * n_features)
+    :param model: dict, from ecca_fit.
+    :return: rr_fusion: ndarray,
+        (n_classes,) or (n_tests * n_classes), the same as extended_cca for each class.
+    '''
+    template, Yf = model['template'], model['Yf']
+    subspace = model['subspace']
+    n_features = template.shape[-1]
+
+    Xtest = Xtest - Xtest.mean(axis=-1, keepdims=True)
+    X = Xtest[..., None, :, :]  # (n_tests) * 1 * n_chans * n_time
+    inv_2_xx = _inv_sqrt(Xtest @ Xtest.swapaxes(-1, -2) / (n_features-1))[..., None, :, :]
+
+    rr_coef = np.zeros(Xtest.shape[:-2] + (template.shape[0], 5))
+
+    # CCA between test trial and reference: the 1st & 3rd coefficients
+    M = inv_2_xx @ (X @ Yf.swapaxes(-1, -2) / (n_features-1)) @ model['inv_2_yy']
+    U, sigma, _ = LA.svd(M)
+    u_x = (inv_2_xx @ U[..., :subspace]).swapaxes(-1, -2)
+    rr_coef[..., 0] = sigma[..., :subspace].mean(axis=-1)
+    rr_coef[..., 2] = _flat_corr(u_x @ X, u_x @ template)
+
+    # CCA between test trial and template: the 2nd & 5th coefficients
+    M = inv_2_xx @ (X @ template.swapaxes(-1, -2) / (n_features-1)) @ model['inv_2_tt']
+    U, _, VT = LA.svd(M)
+    u_x = (inv_2_xx @ U[..., :subspace]).swapaxes(-1, -2)
+    v_y = (model['inv_2_tt'] @ VT.swapaxes(-1, -2)[..., :subspace]).swapaxes(-1, -2)
+    rr_coef[..., 1] = _flat_corr(u_x @ X, u_x @ template)
+    rr_coef[..., 4] = _flat_corr(u_x @ template, v_y @ template)
+
+    # CCA between template and reference: the 4th coefficient
+    rr_coef[..., 3] = _flat_corr(model['u_ty'].swapaxes(-1, -2) @ X, model['proj_ty'])
+
+    rr_fusion = (np.sign(rr_coef)*(rr_coef**2)).sum(axis=-1)
+
+    return rr_fusion
+
 def extended_cca2(Xtest, Xtrain, freq_stim, fs, t_begin, t_end, n_hf=5, init_phase=None, subspce_idx=None):
     '''
     Extended CCA, Using sklearn's CCA, NO Recommended!
@@ -248,17 +344,11 @@ def extended_cca2(Xtest, Xtrain, freq_stim, fs, t_begin, t_end, n_hf=5, init_pha
     Xtest -= Xtest.mean(axis=1, keepdims=True)
 
     init_phase = 0 if init_phase is None else init_phase
-    t1 = np.ceil(fs*t_begin)
-    t2 = np.ceil(fs*t_end)
-    t_time = np.arange(t1, t2+1, 1)/fs
-
-    # generate sin-cos template
-    Yf = None
-    for idx_hf in range(1, n_hf+1):
-        sin_tmp = np.sin(2*np.pi*freq_stim*idx_hf*t_time+init_phase)
-        cos_tmp = np.cos(2*np.pi*freq_stim*idx_hf*t_time+init_phase)
-        Yf_tmp = np.vstack((sin_tmp, cos_tmp)).T
-        Yf = Yf_tmp if Yf is None else np.hstack((Yf, Yf_tmp))
+    t1 = int(np.ceil(fs*t_begin))
+    t2 = int(np.ceil(fs*t_end))
+
+    # sin-cos template from the shared reference bank (read-only)
+    Yf = sin_bank(freq_stim, n_hf, t2-t1+1, init_phase/np.pi, fs, t1).T
 
     # recognition by extended CCA
     n_chans, n_features = Xtrain.shape
@@ -330,17 +420,11 @@ def standard_cca(Xtest, freq_stim, fs, t_begin, t_end, n_hf=5, init_phase=None,
     Xtest -= Xtest.mean(axis=1, keepdims=True)
 
     init_phase = 0 if init_phase is None else init_phase
-    t1 = np.ceil(fs*t_begin)
-    t2 = np.ceil(fs*t_end)
-    t_time = np.arange(t1, t2+1, 1)/fs
-
-    # generate sin-cos template
-    Yf = None
-    for idx_hf in range(1, n_hf+1):
-        sin_tmp = np.sin(2*np.pi*freq_stim*idx_hf*t_time+init_phase)
-        cos_tmp = np.cos(2*np.pi*freq_stim*idx_hf*t_time+init_phase)
-        Yf_tmp = np.vstack((sin_tmp, cos_tmp)).T
-        Yf = Yf_tmp if Yf is None else np.hstack((Yf, Yf_tmp))  # n_time * n_chans
+    t1 = int(np.ceil(fs*t_begin))
+    t2 = int(np.ceil(fs*t_end))
+
+    # sin-cos template from the shared reference bank (read-only)
+    Yf = sin_bank(freq_stim, n_hf, t2-t1+1, init_phase/np.pi, fs, t1).T  # n_time * n_chans
 
     # recognition by extended CCA
     n_chans, n_features = Xtest.shape
@@ -67,22 +67,31 @@ del v, k, file, line       # release RAM
      
 
 #%% Load multiple data file & also can be used to process multiple data
-# CAUTION: may lead to RAM crash (5-D array takes more than 6125MB)
-# Now I know why people need 32G's RAM...PLEASE SKIP THIS PART!!!
+# CAUTION: np.zeros((35, 64, 1500, 40, 6)) may lead to RAM crash (5-D array takes more than 6125MB)
+# convert once into a memory-mapped store, then only the slices in use are read
+from dataset_store import convert_benchmark, DatasetStore
+
 filepath = r'E:\dataset\data'
+store_path = r'E:\dataset\store'
+
+if not os.path.exists(os.path.join(store_path, 'index.json')):
+    filelist = [os.path.join(filepath, file) for file in os.listdir(filepath)
+                if file.startswith('S') and file.endswith('.mat')]
+    chan_names = sorted(channels, key=lambda k: int(channels[k]))
+    convert_benchmark(filelist, store_path, chans=chan_names,
+                      freq_phase=r'E:\dataset\Freq_Phase.mat', sfreq=250)
+    del filelist, chan_names
+
+store = DatasetStore(store_path)
+# (n_subjects, n_events, n_blocks, n_chans, n_times) = (35, 40, 6, 64, 1500)
+print(store.shape)
+
+# e.g. 9 occipital channels of all subjects: (35, 40, 6, 9, 1500), the other 55 channels are never read
+tar_list = [47, 53, 54, 55, 56, 57, 60, 61, 62]
+eeg = store.stack(chans=tar_list)
+
+# or one subject at a time
+for people, data in store.iter_subjects(chans=tar_list):
+    pass  # add more codes here to achieve multiple data processing
 
-filelist = []
-for file in os.listdir(filepath):
-    full_path = os.path.join(filepath, file)
-    filelist.append(full_path)
-
-i = 0
-eeg = np.zeros((35, 64, 1500, 40, 6))
-for file in filelist:
-    temp = io.loadmat(file)
-    eeg[i,:,:,:,:] = temp['data']
-    i += 1
-    
-# add more codes here to achieve multiple data processing (PLEASE DON'T)
-    
-del temp, i, file, filelist, filepath, full_path
+del filepath, store_path
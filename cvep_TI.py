@@ -11,6 +11,7 @@ from numpy import (sin, cos, pi)
 from numpy import newaxis as NA
 import scipy.io as io
 import mcee
+from dataset_store import (fdata_store, SubsetReader)
 import pandas as pd
 import xlrd
 import matplotlib.pyplot as plt
@@ -38,11 +39,12 @@ srca_setrca = np.zeros((len(nameList), n_cv))
 
 for n_peo in range(len(nameList)):
     people = nameList[n_peo]
-    eeg = io.loadmat(r'D:\SSVEP\dataset\preprocessed_data\cvep_8\%s\fir_50_70.mat' %(people))
-    f_data = eeg['f_data'][...,:2940]
-    chans = eeg['chan_info'].tolist()
+    # all channels (SRCA models) but only the first 2940 points are read from the (cached) file
+    store, name = fdata_store(r'D:\SSVEP\dataset\preprocessed_data\cvep_8\%s\fir_50_70.mat' %(people))
+    f_data = SubsetReader(store, times=(0, 2940))(name)
+    chans = store.chans
     n_events = f_data.shape[0]
-    del eeg
+    del store
 
     print("Now running " + people + "'s data...")
 
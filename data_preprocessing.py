@@ -18,6 +18,7 @@ import scipy.io as io
 from mne.io import concatenate_raws
 from mne import Epochs
 from mne.filter import filter_data
+from preprocessing import CntPipeline
 import copy
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
@@ -26,66 +27,28 @@ import seaborn as sns
 %matplotlib auto
 
 # %% load data
+# .cnt files are read & epoched once, later runs (e.g. other filter bands) reuse the cache
 filepath = r'D:\SSVEP\dataset\code_VEP\wuqiaoyi'
-
 subjectlist = ['srca train-12-31']
-
-filefolders = []
-for subindex in subjectlist:
-    filefolder = os.path.join(filepath, subindex)
-    filefolders.append(filefolder)
-
-filelist = []
-for filefolder in filefolders:
-    for file in os.listdir(filefolder):
-        filefullpath = os.path.join(filefolder, file)
-        filelist.append(filefullpath)
-
-raw_cnts = []
-for file in filelist:
-    # montage = mne.channels.make_standard_montage('standard_1020')
-    raw_cnt = mne.io.read_raw_cnt(file, eog=['HEO', 'VEO'], emg=['EMG'], ecg=['EKG'],
-            preload=True, verbose=False)
-    raw_cnts.append(raw_cnt)
-
-raw = concatenate_raws(raw_cnts)
-
-del raw_cnts, file, filefolder, filefolders, filefullpath, filelist
-del filepath, subindex, subjectlist, raw_cnt
-
-# preprocessing
-events, events_id = mne.events_from_annotations(raw)
+pipeline = CntPipeline.from_folders(filepath, subjectlist, n_jobs=8)
 
 # drop channels
 drop_chans = ['M1', 'M2']
 
-picks = mne.pick_types(raw.info, emg=False, eeg=True, stim=False, eog=False,
-                       exclude=drop_chans)
-picks_ch_names = [raw.ch_names[i] for i in picks]  # layout picked channels' name
-
 # define labels
 # event_id = dict(f60p0=2, f60p1=3, f80p0=4, f80p1=5)  # unnecessary 
 # baseline = (-0.2, 0)    # define baseline
 tmin, tmax = -1, 1    # set the time range
 sfreq = 1000
 
-# transform raw object into array
-n_events = len(events_id)
-n_trials = int(events.shape[0] / n_events)
-n_chans = len(picks)
-n_times = int((tmax - tmin) * sfreq + 1)
-
-# pick up data
-data = np.zeros((n_events, n_trials, n_chans, n_times))
-
-# change the input of the function yourself
-for i in range(n_events):
-    data[i, ...] = Epochs(raw, events=events, event_id=i+1, tmin=tmin, picks=picks,
-               tmax=tmax, baseline=None, preload=True).get_data() * 1e6
-    data[i, ...] = filter_data(data[i, ...], sfreq=sfreq, l_freq=50, h_freq=70, n_jobs=8, method='fir')
+# (n_events, n_trials, n_chans, n_times)
+data, picks_ch_names = pipeline.filtered(tmin=tmin, tmax=tmax, l_freq=50, h_freq=70, method='fir',
+                                         drop_chans=drop_chans)
 
 data_path = r'D:\SSVEP\dataset\preprocessed_data\cvep_32\wuqiaoyi\train_fir_50_70.mat'
-io.savemat(data_path, {'f_data':data, 'chan_info':picks_ch_names})
+io.savemat(data_path, {'f_data':np.asarray(data), 'chan_info':picks_ch_names})
+
+del filepath, subjectlist
 print('Preprocessing done.')
 
 #%%
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped multi-subject dataset store
+
+1. convert_benchmark: benchmark S*.mat files (n_chans, n_times, n_events, n_blocks)
+    -> store, one-time conversion
+2. convert_fdata: our preprocessed .mat files ('f_data' (n_events, n_trials, n_chans, n_times)
+    & 'chan_info') -> store, one-time conversion
+3. DatasetStore: lazy loader of a store,
+    every subject is a (n_events, n_blocks, n_chans, n_times) memmap, the whole store
+    reads as (subject, event, block, chan, time) and only the touched slices are loaded
+4. SubsetReader & read_fdata: channels (by name), time window and trials fixed up front,
+    only those bytes are read from the store (a .mat file is cached as a store on first use)
+
+Layout on disk:
+    root/index.json: subjects, shapes, dtype, sfreq, chans and freq/phase information
+    root/<subject>.npy: one .npy file (memmap-able) per subject
+
+@author: Brynhildr
+"""
+
+import os
+import re
+import json
+
+import numpy as np
+import scipy.io as io
+
+
+def _read_index(root):
+    path = os.path.join(root, 'index.json')
+    if not os.path.exists(path):
+        return {'subjects': [], 'shapes': {}, 'dtype': None, 'sfreq': None, 'chans': None, 'info': {}}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _write_index(root, index):
+    # write to a temporary file first, a crash never leaves a broken index
+    path = os.path.join(root, 'index.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _natural_key(path):
+    # 'S2.mat' < 'S10.mat': digit runs compare as numbers
+    name = os.path.basename(path)
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+
+def _strip_chans(chans):
+    return [str(c).strip() for c in chans]
+
+
+def _add_subject(root, name, data, dtype, sfreq, chans, info=None):
+    """
+    Write one subject into the store.
+    :param root: directory of the store.
+    :param name: subject's name (file name without extension).
+    :param data: (n_events, n_blocks, n_chans, n_times) array-like.
+    :param dtype: data type on disk.
+    :param sfreq: sampling frequency / Hz.
+    :param chans: list of channel names or None.
+    :param info: extra json-serializable information of the store (e.g. freqs & phases).
+    """
+    os.makedirs(root, exist_ok=True)
+    index = _read_index(root)
+    dtype = np.dtype(dtype).str
+    if index['subjects']:
+        if index['dtype'] != dtype or index['sfreq'] != sfreq:
+            raise ValueError('dtype & sfreq should be the same for all subjects of a store.')
+        if chans is not None and index['chans'] is not None and _strip_chans(chans) != _strip_chans(index['chans']):
+            raise ValueError('Channels of %s are different from the store.' % name)
+
+    out = np.lib.format.open_memmap(os.path.join(root, name + '.npy'), mode='w+',
+                                    dtype=dtype, shape=data.shape)
+    # the source is already in memory (io.loadmat reads the whole file), copying event by event
+    # only avoids a second full-size temporary for the transposed & dtype-converted array
+    for ne in range(data.shape[0]):
+        out[ne] = data[ne]
+    out.flush()
+    del out
+
+    if name not in index['subjects']:
+        index['subjects'].append(name)
+    index['shapes'][name] = list(data.shape)
+    index['dtype'] = dtype
+    index['sfreq'] = sfreq
+    if chans is not None:
+        # names are kept as in chan_info (e.g. 'PZ '), mcee looks them up with chans.index
+        index['chans'] = [str(c) for c in chans]
+    if info:
+        index['info'].update(info)
+    _write_index(root, index)
+
+
+def convert_benchmark(mat_files, root, chans=None, freq_phase=None, sfreq=250, dtype=np.float32):
+    """
+    Convert the benchmark dataset into a store.
+    :param mat_files: list of S*.mat files ('data': (n_chans, n_times, n_events, n_blocks)),
+        subjects are stored in numeric order (S1, S2, ..., S10, ...).
+    :param root: directory of the store.
+    :param chans: list of channel names (e.g. from the channel_info .txt) or None.
+    :param freq_phase: Freq_Phase.mat file or None.
+    :param sfreq: sampling frequency / Hz (250 for the benchmark).
+    :param dtype: data type on disk, float32 halves the disk & RAM of float64.
+    :return: store: DatasetStore
+    """
+    info = None
+    if freq_phase is not None:
+        fp = io.loadmat(freq_phase)
+        info = {'freqs': fp['freqs'].ravel().tolist(), 'phases': fp['phases'].ravel().tolist()}
+    for mat_file in sorted(mat_files, key=_natural_key):
+        name = os.path.splitext(os.path.basename(mat_file))[0]
+        data = io.loadmat(mat_file)['data']
+        # (n_chans, n_times, n_events, n_blocks) -> (n_events, n_blocks, n_chans, n_times)
+        _add_subject(root, name, data.transpose((2, 3, 0, 1)), dtype, sfreq, chans, info)
+        del data
+    return DatasetStore(root)
+
+
+def convert_fdata(mat_files, root, names=None, sfreq=1000, dtype=np.float32):
+    """
+    Convert preprocessed .mat files (see data_preprocessing.py) into a store.
+    :param mat_files: list of .mat files with 'f_data' (n_events, n_trials, n_chans, n_times) & 'chan_info'.
+    :param root: directory of the store.
+    :param names: subjects' names, default: name of the parent folder of each file.
+    :param sfreq: sampling frequency / Hz.
+    :param dtype: data type on disk.
+    :return: store: DatasetStore
+    """
+    if names is None:
+        names = [os.path.basename(os.path.dirname(os.path.abspath(f))) for f in mat_files]
+    if len(set(names)) != len(names):
+        raise ValueError('Subjects\' names should be unique.')
+    for mat_file, name in zip(mat_files, names):
+        eeg = io.loadmat(mat_file)
+        chans = eeg['chan_info'].tolist() if 'chan_info' in eeg else None
+        _add_subject(root, name, eeg['f_data'], dtype, sfreq, chans)
+        del eeg
+    return DatasetStore(root)
+
+
+def resolve_chans(chans, chan_info):
+    """
+    Channel names -> indices.
+    :param chans: list of names (e.g. ['PZ ','PO5',...], padding is ignored) or indices.
+    :param chan_info: list of channel names of the data.
+    :return: list of int
+    """
+    lookup = {name: i for i, name in enumerate(_strip_chans(chan_info))}
+    indices = []
+    for chan in chans:
+        if isinstance(chan, (int, np.integer)):
+            indices.append(int(chan))
+        elif str(chan).strip() in lookup:
+            indices.append(lookup[str(chan).strip()])
+        else:
+            raise ValueError('Unknown channel: %s' % chan)
+    return indices
+
+
+class DatasetStore:
+    """
+    Lazy loader of a store.
+    Usage:
+        store = DatasetStore(r'E:\\dataset\\store')
+        data = store['S15']  # (n_events, n_blocks, n_chans, n_times) memmap, nothing loaded
+        data = store.load('S15', blocks=[0, 1], chans=[47, 53])  # only those slices are read
+        for name, data in store.iter_subjects(chans=[47, 53]):
+            ...
+    """
+    def __init__(self, root, mode='r'):
+        """
+        :param root: directory of the store.
+        :param mode: 'r' (read-only) or 'r+' (writable views).
+        """
+        self.root = root
+        self.mode = mode
+        self.index = _read_index(root)
+        if not self.index['subjects']:
+            raise ValueError('No subject in %s.' % root)
+        self.subjects = list(self.index['subjects'])
+        self.sfreq = self.index['sfreq']
+        self.chans = self.index['chans']
+        self.info = self.index['info']
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __contains__(self, subject):
+        return subject in self.index['shapes']
+
+    def __getitem__(self, subject):
+        return self.subject(subject)
+
+    @property
+    def shape(self):
+        """(n_subjects, n_events, n_blocks, n_chans, n_times) if all subjects have the same shape."""
+        shapes = {tuple(self.index['shapes'][s]) for s in self.subjects}
+        if len(shapes) != 1:
+            raise ValueError('Subjects have different shapes: %s' % shapes)
+        return (len(self.subjects),) + shapes.pop()
+
+    def subject(self, subject):
+        """
+        :param subject: name or index of the subject.
+        :return: (n_events, n_blocks, n_chans, n_times) memmap.
+        """
+        if not isinstance(subject, str):
+            subject = self.subjects[subject]
+        if subject not in self._maps:
+            self._maps[subject] = np.load(os.path.join(self.root, subject + '.npy'),
+                                          mmap_mode=self.mode)
+        return self._maps[subject]
+
+    def view(self, subject, events=None, blocks=None, chans=None, times=None):
+        """
+        Lazy view of a subject, the file is only read when the view is used.
+        Basic indexing only: each of events/blocks/chans/times is None (all), an int or a slice.
+        :return: memmap view
+        """
+        key = tuple(slice(None) if k is None else k for k in (events, blocks, chans, times))
+        return self.subject(subject)[key]
+
+    def load(self, subject, events=None, blocks=None, chans=None, times=None):
+        """
+        Read a subset of a subject into memory.
+        :param events, blocks, chans: None (all), slice or list of indices.
+        :param times: None (all) or slice of time points.
+        :return: (n_events, n_blocks, n_chans, n_times) ndarray
+        """
+        data = self.subject(subject)
+        times = slice(None) if times is None else times
+        indices = (events, blocks, chans)
+        if all(idx is None or isinstance(idx, slice) for idx in indices):
+            key = tuple(slice(None) if idx is None else idx for idx in indices)
+            return np.array(data[key + (times,)])
+        # one fancy index over events x blocks x chans (slices -> ranges), only the selection is copied
+        ranges = []
+        for n, idx in zip(data.shape[:3], indices):
+            if idx is None or isinstance(idx, slice):
+                idx = np.arange(n)[slice(None) if idx is None else idx]
+            ranges.append(np.asarray(idx))
+        return data[np.ix_(*ranges) + (times,)]
+
+    def iter_subjects(self, subjects=None, **kwargs):
+        """
+        Iterate over subjects, reading one subject's subset at a time.
+        :param subjects: names/indices, default all.
+        :param kwargs: see load.
+        :return: generator of (name, data)
+        """
+        for subject in (self.subjects if subjects is None else subjects):
+            name = subject if isinstance(subject, str) else self.subjects[subject]
+            yield name, self.load(name, **kwargs)
+
+    def stack(self, subjects=None, **kwargs):
+        """
+        (n_subjects, ...) array of the subsets of several subjects.
+        Only the selected part is loaded, e.g. 9 channels of 35 subjects instead of 64.
+        :param subjects: names/indices, default all.
+        :param kwargs: see load.
+        :return: ndarray
+        """
+        subjects = self.subjects if subjects is None else subjects
+        out = None
+        for ns, (name, data) in enumerate(self.iter_subjects(subjects, **kwargs)):
+            if out is None:
+                out = np.empty((len(subjects),) + data.shape, dtype=data.dtype)
+            out[ns] = data
+        return out
+
+
+class SubsetReader:
+    """
+    Read the same channels/time window of a store many times (e.g. CV loops).
+    Channel names are resolved once, each call only reads the selected bytes.
+    Usage:
+        reader = SubsetReader(store, chans=['PZ ','PO5','PO3','POZ','PO4','PO6','O1 ','OZ ','O2 '],
+                              times=(1140, 1640))
+        train_data = reader('wuqiaoyi', trials=randPick[:40])  # (n_events, 40, 9, 500)
+    """
+    def __init__(self, store, chans=None, times=None, trials=None, events=None):
+        """
+        :param store: DatasetStore.
+        :param chans: list of channel names or indices, None for all.
+        :param times: (start, stop) time points, slice or None (all).
+        :param trials: default trial (block) indices, None for all.
+        :param events: event indices, None for all.
+        """
+        self.store = store
+        if chans is not None and store.chans is not None:
+            chans = resolve_chans(chans, store.chans)
+        elif chans is not None and not all(isinstance(c, (int, np.integer)) for c in chans):
+            raise ValueError('The store has no channel information, use channel indices.')
+        self.chans = chans
+        self.times = slice(*times) if isinstance(times, tuple) else times
+        self.trials = trials
+        self.events = events
+
+    def __call__(self, subject=0, trials=None):
+        """
+        :param subject: name or index of the subject.
+        :param trials: trial indices of this read (default: the ones given up front).
+        :return: (n_events, n_trials, n_chans, n_times) ndarray
+        """
+        return self.store.load(subject, events=self.events,
+                               blocks=self.trials if trials is None else trials,
+                               chans=self.chans, times=self.times)
+
+
+def fdata_store(mat_file, cache_dir=None, sfreq=1000, dtype=np.float64):
+    """
+    Store cache of a preprocessed .mat file, converted on first use
+    (or when the .mat file is newer than its cache).
+    :param mat_file: .mat file with 'f_data' & 'chan_info'.
+    :param cache_dir: directory of the cache, default: '<folder of mat_file>/.store'.
+    :param sfreq: sampling frequency / Hz.
+    :param dtype: data type of the cache.
+    :return: store: DatasetStore
+        name: subject's name of the file in the store
+    """
+    root, file_name = os.path.split(os.path.abspath(mat_file))
+    name = os.path.splitext(file_name)[0]
+    cache_dir = os.path.join(root, '.store') if cache_dir is None else cache_dir
+    npy_file = os.path.join(cache_dir, name + '.npy')
+    if not os.path.exists(npy_file) or os.path.getmtime(npy_file) < os.path.getmtime(mat_file):
+        convert_fdata([mat_file], cache_dir, names=[name], sfreq=sfreq, dtype=dtype)
+    return DatasetStore(cache_dir), name
+
+
+def read_fdata(mat_file, chans=None, times=None, trials=None, events=None, cache_dir=None):
+    """
+    Replacement of io.loadmat(mat_file)['f_data'][events][:, trials][..., chans, times].
+    :param mat_file: .mat file with 'f_data' & 'chan_info'.
+    :param chans, times, trials, events: see SubsetReader.
+    :param cache_dir: see fdata_store.
+    :return: (n_events, n_trials, n_chans, n_times) ndarray
+    """
+    store, name = fdata_store(mat_file, cache_dir)
+    return SubsetReader(store, chans, times, trials, events)(name)
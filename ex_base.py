@@ -5,16 +5,23 @@ Created on Thu Oct 29 19:49:39 2020
 @author: Brynhildr
 """
 import time
+import os, json
 
 import numpy as np
 import scipy.io as sio
 
 import socket, struct, threading, queue
+import bisect, csv
+import asyncio, inspect
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from collections import deque
 from copy import deepcopy
 
 from psychopy import (core, visual, event, parallel)
 
+from . import mcee
+from .algorithms import (ecca_fit, ecca_predict)
 from .base import NeuroPort
 from .base import BaseDynamicStimuli
 
@@ -176,72 +183,389 @@ class NeuroPort:
     def sendLabel(self, label):
         raise NotImplementedError
 
+def _takes_t_recv(handler):
+    # hooks accepting a t_recv keyword get the receive time of the package that completed the epoch
+    try:
+        return 't_recv' in inspect.signature(handler).parameters
+    except (TypeError, ValueError):
+        return False
+
+_worker_hook = None  # (handler, args, kwargs) installed in a process-pool worker of AsyncNeuroscan
+
+def _install_hook(handler, args, kwargs):
+    # ProcessPoolExecutor initializer: the handler (e.g. a fitted OnlineDecoder) is pickled once per worker
+    global _worker_hook
+    _worker_hook = (handler, args, kwargs)
+
+def _run_hook(eeg_data, extras, **call_kwargs):
+    handler, args, kwargs = _worker_hook
+    return handler(eeg_data, extras, *args, **dict(kwargs, **call_kwargs))
+
+class PipelineStats:
+    """
+    Low-overhead instrumentation of the real-time pipeline.
+    Durations (time.perf_counter) are counted in log-spaced histograms (1 us - 10 s) per (hook, stage):
+        'queue': package enqueued -> dequeued by the hook
+        'handler': handler start -> end
+        'output': package received -> output put into the output queue (lag behind the data/trigger)
+    Gauges keep the latest and the largest queue depth of each hook.
+    """
+    edges = list(np.logspace(-6, 1, 71))
+
+    def __init__(self):
+        self.hists = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self._t_dump = None
+        self._stop_dump = threading.Event()
+
+    def record(self, name, stage, duration):
+        key = (name, stage)
+        if key not in self.hists:
+            with self.lock:
+                self.hists.setdefault(key, [[0]*(len(self.edges)+1), 0, 0.0, 0.0])
+        hist = self.hists[key]  # counts, n, sum, max
+        hist[0][bisect.bisect(self.edges, duration)] += 1
+        hist[1] += 1
+        hist[2] += duration
+        if duration > hist[3]:
+            hist[3] = duration
+
+    def gauge(self, name, depth):
+        last, largest = self.gauges.get(name, (0, 0))
+        self.gauges[name] = (depth, max(largest, depth))
+
+    def _percentile(self, counts, n, q, largest):
+        target, cum = q*n, 0
+        for i, count in enumerate(counts):
+            cum += count
+            if cum >= target:
+                if i >= len(self.edges):
+                    return largest
+                return min(self.edges[i], largest)  # upper edge of the bin, at most the observed max
+        return largest
+
+    def snapshot(self):
+        """
+        :return: dict {hook: {stage: {count, mean, p50, p95, p99, max} / s, 'queue_depth': (last, max)}}
+        """
+        with self.lock:
+            keys = list(self.hists.keys())
+        summary = {}
+        for name, stage in keys:
+            counts, n, total, largest = self.hists[(name, stage)]
+            counts = list(counts)
+            summary.setdefault(name, {})[stage] = {
+                'count': n, 'mean': total/n if n else 0.0,
+                'p50': self._percentile(counts, n, 0.5, largest), 'p95': self._percentile(counts, n, 0.95, largest),
+                'p99': self._percentile(counts, n, 0.99, largest), 'max': largest}
+        for name, depth in list(self.gauges.items()):
+            summary.setdefault(name, {})['queue_depth'] = depth
+        return summary
+
+    def _dump(self, file_name, interval):
+        with open(file_name, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if f.tell() == 0:
+                writer.writerow(['time', 'hook', 'stage', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'])
+            while not self._stop_dump.wait(interval):
+                t_now = time.time()
+                for name, stages in self.snapshot().items():
+                    for stage, value in stages.items():
+                        if stage == 'queue_depth':
+                            writer.writerow([t_now, name, stage, value[0], '', '', '', '', value[1]])
+                        else:
+                            writer.writerow([t_now, name, stage, value['count']]
+                                            + [1e3*value[k] for k in ('mean', 'p50', 'p95', 'p99', 'max')])
+                f.flush()
+
+    def start_dump(self, file_name='pipeline_stats.csv', interval=10):
+        """Append a snapshot to a CSV file every interval seconds (queue_depth rows: count=last, max_ms=max)."""
+        self._stop_dump.clear()
+        self._t_dump = threading.Thread(target=self._dump, args=(file_name, interval), daemon=True, name='stats_dump')
+        self._t_dump.start()
+
+    def stop_dump(self):
+        self._stop_dump.set()
+
 class Amplifier:
     """
     An abstract class for eeg amplifiers.
     """
     class _Buff:
         """
-        Inner buffer object to store buffer data.
+        Inner ring buffer object to store buffer data.
+        Samples are kept twice (mirrored) in a preallocated (2*capacity, n_cols) array,
+        so that any window of the latest samples is a contiguous view without copy.
         """
-        def __init__(self, lim_buff):
+        def __init__(self, lim_buff, n_cols=None):
             self.lim_buff = lim_buff
-            self.buff = deque(maxlen=self.lim_buff)
-            for _ in range(self.lim_buff):
-                self.buff.append(None)
+            self.capacity = 2*lim_buff
+            self.n_cols = n_cols
+            self.buff = None if n_cols is None else np.zeros((2*self.capacity, n_cols))
+            self.head = 0
             self.buff_size = 0
 
-        def buffering(self, data):
-            for d in data:
-                value = self.buff.popleft()
-                self.buff.append(d)
-                if self.buff_size < self.lim_buff-1:
-                    self.buff_size += 1
-
-        def access_buffer(self):
-            c_buffer = []
-            for _ in range(self.lim_buff):
-                d = self.buff.popleft()
-                if d:
-                    c_buffer.append(d)  # only access those are not None
-                self.buff.append(d)
-            return c_buffer
+        def _allocate(self, capacity, n_cols):
+            buff = np.zeros((2*capacity, n_cols))
+            n_keep = min(self.buff_size, capacity)
+            if self.buff is not None and n_keep:
+                buff[:n_keep] = self.access_buffer(n_samples=n_keep)
+            self.buff, self.capacity, self.n_cols = buff, capacity, n_cols
+            self.head = n_keep % capacity
+            if n_keep == capacity:
+                buff[capacity:] = buff[:capacity]
 
-        def is_full(self):
-            return self.buff_size == self.lim_buff-1
+        def buffering(self, data):
+            """
+            Block write of one package.
+            :param data: (n_samples, n_cols)
+            """
+            data = np.asarray(data)
+            n_samples = data.shape[0]
+            if self.buff is None or n_samples + self.lim_buff > self.capacity:
+                self._allocate(max(self.capacity, n_samples + self.lim_buff), data.shape[1])
+            cap, head = self.capacity, self.head
+            end = head + n_samples
+            self.buff[head:end] = data
+            if end <= cap:
+                self.buff[head+cap:end+cap] = data
+            else:
+                self.buff[head+cap:] = data[:cap-head]
+                self.buff[:end-cap] = data[cap-head:]
+            self.head = end % cap
+            self.buff_size = min(self.buff_size + n_samples, cap)
+
+        def access_buffer(self, delay=0, n_samples=None):
+            """
+            Contiguous view of the latest samples, valid until the next buffering.
+            :param delay: the window ends delay samples before the newest one.
+            :param n_samples: length of the window, default lim_buff.
+            :return: (n_samples, n_cols)
+            """
+            n_samples = self.lim_buff if n_samples is None else n_samples
+            start = (self.head - delay - n_samples) % self.capacity
+            return self.buff[start:start+n_samples]
+
+        def is_full(self, delay=0):
+            return self.buff_size >= self.lim_buff + delay
 
     class _MarkerRuler:
+        """
+        Block-level event detector.
+        Marker onsets of a whole package are found at once; an epoch completes latency samples
+        after its onset (or every latency+1 samples if there is no marker).
+        """
         def __init__(self, marker=None, latency=0):
             self.marker = marker
-            self.latency = latency
-            self.countdowns = {}
-
-        def __call__(self, data):
+            self.latency = latency if latency > 0 else 0
+            self.deadlines = np.zeros((0), dtype=np.int64)  # pending epochs (sorted sample indices)
+            self.n_seen = 0
+            self.last_label = None
+
+        def __call__(self, labels):
+            """
+            :param labels: (n_samples,) label column of one package.
+            :return: indices (within the package) of the samples at which epochs complete.
+            """
+            labels = np.asarray(labels)
+            start = self.n_seen
+            stop = start + labels.shape[0]
             if self.marker: # int marker
-                if data[-1] == self.marker:
-                    self.countdowns[str(self.marker) + str(len(self.countdowns))] = self.latency if self.latency > 0 else 0
-                drop_keys = []
-                for key in self.countdowns.keys():
-                    if self.countdowns[key] == 0:
-                        drop_keys.append(key)
-                    self.countdowns[key] -= 1
-                if drop_keys:
-                    for key in drop_keys:
-                        del self.countdowns[key]
-                    return True
-            else: # no marker)
-                if 'fixed' not in self.countdowns.keys():
-                    self.countdowns['fixed'] = self.latency if self.latency > 0 else 0
-                if self.countdowns['fixed'] == 0:
-                    self.countdowns['fixed'] = self.latency if self.latency > 0 else 0
-                    return True
-                self.countdowns['fixed'] -= 1
-            return False
+                is_marker = labels == self.marker
+                onsets = np.flatnonzero(is_marker)
+                # only onsets, not samples on which the marker is held
+                previous = np.concatenate(([self.last_label == self.marker], is_marker[:-1]))
+                onsets = onsets[~previous[onsets]] + start
+                self.deadlines = np.concatenate((self.deadlines, onsets + self.latency))
+                n_done = np.searchsorted(self.deadlines, stop)
+                triggers = np.unique(self.deadlines[:n_done]) - start
+                self.deadlines = self.deadlines[n_done:]
+            else: # no marker, fixed period
+                if self.deadlines.size == 0:
+                    self.deadlines = np.array([start + self.latency], dtype=np.int64)
+                triggers = np.arange(self.deadlines[0], stop, self.latency + 1)
+                if triggers.size:
+                    self.deadlines[0] = triggers[-1] + self.latency + 1
+                triggers -= start
+            if labels.shape[0]:
+                self.last_label = labels[-1]
+            self.n_seen = stop
+            return triggers
+
+    class _SharedRing:
+        """
+        Single-producer multi-consumer ring buffer shared by all hooks.
+        Each package is written once; consumers hold read cursors (package numbers)
+        and get read-only views of the packages, without any copy.
+        Samples are numbered along the stream (dropped packages included), epoching consumers
+        cut their windows from the ring's history with window instead of buffering the stream again.
+        Backpressure: with policy 'block', the producer waits (at most timeout) for the slowest consumer;
+        with policy 'drop' (or after timeout), unread packages of lagging consumers are overwritten
+        and counted in overflows.
+        Packages handed out by get, and the history samples before them, are pinned until release:
+        they are never overwritten, an incoming package that would need their slots is dropped instead
+        (counted in dropped and in the overflows of every consumer).
+        """
+        def __init__(self, capacity, policy='drop', timeout=0.1):
+            self.capacity = capacity  # samples
+            self.policy = policy
+            self.timeout = timeout
+            self.buff = None
+            self.packages = deque()  # (n_package, offset, n_samples, extras, times, first sample), oldest first
+            self.n_package = 0  # number of the next package
+            self.n_sample = 0  # number of the next sample
+            self.offset = 0
+            self.cursors = {}
+            self.history = {}  # consumer -> samples needed before its first unread package
+            self.pinned = {}  # consumer -> (first, last) package numbers pinned by get, until release
+            self.overflows = {}
+            self.missed = {}  # consumer -> windows no longer in the ring
+            self.dropped = 0
+            self.closed = False
+            self.cond = threading.Condition()
+
+        def add_consumer(self, name, history=0):
+            with self.cond:
+                if history >= self.capacity:
+                    raise ValueError('Epochs of %s are longer than the shared ring buffer.' % name)
+                self.cursors[name] = self.n_package
+                self.history[name] = history
+                self.overflows[name] = 0
+                self.missed[name] = 0
+
+        def remove_consumer(self, name):
+            with self.cond:
+                if name in self.cursors:
+                    del self.cursors[name]
+                self.pinned.pop(name, None)
+                self.cond.notify_all()
+
+        def _overlap(self, offset, n_samples):
+            if not self.packages:
+                return None
+            n_old, o_old, n_s_old = self.packages[0][:3]
+            if o_old < offset + n_samples and offset < o_old + n_s_old:
+                return n_old
+            return None
+
+        def _is_pinned(self, n_package):
+            return any(first <= n_package <= last for first, last in self.pinned.values())
+
+        def put(self, package, t_recv=None):
+            r_data, extras = package
+            data = np.asarray(r_data)
+            n_samples = data.shape[0]
+            with self.cond:
+                if self.buff is None:
+                    self.buff = np.zeros((self.capacity, data.shape[1]))
+                if n_samples > self.capacity:
+                    raise ValueError('Package is larger than the shared ring buffer.')
+                offset = self.offset if self.offset + n_samples <= self.capacity else 0
+                while True:
+                    n_old = self._overlap(offset, n_samples)
+                    if n_old is None:
+                        break
+                    lagging = [name for name in self.cursors if self.cursors[name] <= n_old]
+                    if (lagging or self._is_pinned(n_old)) and self.policy == 'block' and not self.closed:
+                        if self.cond.wait_for(lambda: all(c > n_old for c in self.cursors.values())
+                                              and not self._is_pinned(n_old), timeout=self.timeout):
+                            continue
+                        lagging = [name for name in self.cursors if self.cursors[name] <= n_old]
+                    if self._is_pinned(n_old):
+                        # still being read: drop the incoming package instead
+                        self.dropped += 1
+                        self.n_sample += n_samples
+                        for name in self.cursors:
+                            self.overflows[name] += 1
+                        return
+                    for name in lagging:  # overflow: lagging consumers lose this package
+                        self.overflows[name] += n_old + 1 - self.cursors[name]
+                        self.cursors[name] = n_old + 1
+                    self.packages.popleft()
+                self.buff[offset:offset+n_samples] = data
+                t_recv = time.perf_counter() if t_recv is None else t_recv
+                self.packages.append((self.n_package, offset, n_samples, extras,
+                                      (t_recv, time.perf_counter()), self.n_sample))
+                self.n_package += 1
+                self.n_sample += n_samples
+                self.offset = offset + n_samples
+                self.cond.notify_all()
+
+        def get(self, name):
+            """
+            Block until there are unread packages.
+            :return: (last package number, [(read-only view, extras, (t_recv, t_enqueue), first sample), ...]),
+                or None if closed/removed.
+            """
+            with self.cond:
+                self.cond.wait_for(lambda: name not in self.cursors or self.closed
+                                   or self.cursors[name] < self.n_package)
+                if name not in self.cursors or self.cursors[name] >= self.n_package:
+                    return None
+                items = []
+                first = None
+                for n_package, offset, n_samples, extras, times, s_first in self.packages:
+                    if n_package >= self.cursors[name]:
+                        if first is None:
+                            # pin the history the consumer needs before this package as well
+                            s_history = s_first - self.history[name]
+                            first = next(p[0] for p in self.packages if p[5] + p[2] > s_history)
+                        view = self.buff[offset:offset+n_samples]
+                        view.flags.writeable = False
+                        items.append((view, extras, times, s_first))
+                self.pinned[name] = (first, self.n_package - 1)
+                return self.n_package - 1, items
+
+        def window(self, name, start, stop):
+            """
+            Samples start ... stop-1 of the stream, read by consumer name between get and release.
+            :return: read-only view if they are contiguous in the buffer, otherwise a copy;
+                None if part of them is no longer in the ring (counted in missed).
+            """
+            with self.cond:
+                pieces = []
+                s_next = start
+                for _, offset, n_samples, _, _, s_first in self.packages:
+                    if s_first + n_samples <= start:
+                        continue
+                    if s_first >= stop or s_first > s_next:  # done or gap (overwritten/dropped)
+                        break
+                    pieces.append((offset + s_next - s_first, offset + min(stop, s_first + n_samples) - s_first))
+                    s_next = min(stop, s_first + n_samples)
+                if s_next < stop:
+                    self.missed[name] += 1
+                    return None
+                if all(pieces[k][1] == pieces[k+1][0] for k in range(len(pieces)-1)):
+                    view = self.buff[pieces[0][0]:pieces[-1][1]]
+                    view.flags.writeable = False
+                    return view
+                # the window wraps around the end of the buffer
+                return np.concatenate([self.buff[a:b] for a, b in pieces])
+
+        def release(self, name, n_package):
+            with self.cond:
+                if name in self.cursors:
+                    self.cursors[name] = max(self.cursors[name], n_package + 1)
+                self.pinned.pop(name, None)
+                self.cond.notify_all()
+
+        def backlog(self):
+            with self.cond:
+                return {name: self.n_package - self.cursors[name] for name in self.cursors}
+
+        def close(self):
+            with self.cond:
+                self.closed = True
+                self.cond.notify_all()
 
     def __init__(self):
         self.registered_handlers = {}
-        self._input_queues = {}
         self._output_queues = {}
+        self.stats = PipelineStats()
+        self._ring = None
+        self.ring_size = 10  # length of the shared ring buffer / s
+        self.ring_policy = 'drop'  # 'drop' or 'block', see _SharedRing
         self._ts = {}
         self._t_data_pipeline = None
         self._t_save_pipeline = None
@@ -256,55 +580,97 @@ class Amplifier:
     def send(self, message):
         pass
 
+    def _get_ring(self):
+        if self._ring is None or self._ring.closed:
+            self._ring = self._SharedRing(int(self.ring_size*self.srate), policy=self.ring_policy)
+        return self._ring
+
     def _data_pipeline(self):
+        ring = self._get_ring()
         while True:
             try:
                 package = self.recv()
             except:
-                self.register_lock.acquire()
-                for key in self._input_queues:
-                    self._input_queues[key].put(None)
-                self.register_lock.release()
+                ring.close()
                 break
-            # Should there be a lock?
-            self.register_lock.acquire()
-            for key in self._input_queues:
-                self._input_queues[key].put(package)
-            self.register_lock.release()
+            if package[0] is None:
+                continue
+            # one write for all consumers
+            ring.put(package, t_recv=time.perf_counter())
 
     def establish_data_pipeline(self):
         self._t_data_pipeline = threading.Thread(target=self._data_pipeline, daemon=True, name='data_pipeline')
         self._t_data_pipeline.start()
 
-    def _save_handler(self, input_queue=None, file_name='default', info={}):
-        save_data = None
-        while True:
-            package = input_queue.get()
-            if package is None:
-                break
-            r_data, extras = package
-            r_data = np.array(r_data).T
-            save_data = np.append(save_data, r_data, axis=1) if save_data is not None else r_data
-            input_queue.task_done()
-        if save_data is not None and info is not None:
+    def _save_handler(self, name='save', file_name='default', info={}, chunk_time=1, flush_time=1, to_mat=True):
+        """
+        Streaming recorder: samples are staged in a fixed-size chunk and appended to
+        file_name.bin (float64, (n_samples, n_chans+1) row-major); file_name.json holds the header
+        and is rewritten at every flush, so the recording survives interruptions (see read_recording).
+        If to_mat and info is not None, file_name.mat is written from the raw file at the end.
+        """
+        file_name = file_name[:-4] if file_name.endswith('.mat') else file_name
+        ring = self._get_ring()
+        chunk = None
+        n_chunk, n_written, n_saved = 0, 0, 0  # staged / already written part of chunk, samples on disk
+        t_flush = time.perf_counter()
+        with open(file_name + '.bin', 'wb') as f:
+            while True:
+                packages = ring.get(name)
+                if packages is None:
+                    break
+                n_package, items = packages
+                self.stats.gauge(name, len(items))
+                for r_data, extras, _, _ in items:
+                    if chunk is None:
+                        chunk = np.zeros((max(int(chunk_time*self.srate), 1), r_data.shape[1]))
+                        self._save_header(file_name, 0, chunk.shape[1], info)
+                    n_done = 0
+                    while n_done < r_data.shape[0]:
+                        n_copy = min(r_data.shape[0] - n_done, chunk.shape[0] - n_chunk)
+                        chunk[n_chunk:n_chunk+n_copy] = r_data[n_done:n_done+n_copy]
+                        n_chunk += n_copy
+                        n_done += n_copy
+                        if n_chunk == chunk.shape[0]:
+                            f.write(chunk[n_written:].data)
+                            n_saved += n_chunk - n_written
+                            n_chunk, n_written = 0, 0
+                ring.release(name, n_package)
+                if time.perf_counter() - t_flush > flush_time and chunk is not None:
+                    f.write(chunk[n_written:n_chunk].data)
+                    n_saved += n_chunk - n_written
+                    n_written = n_chunk
+                    f.flush()
+                    self._save_header(file_name, n_saved, chunk.shape[1], info)
+                    t_flush = time.perf_counter()
+            f.write(chunk[n_written:n_chunk].data if chunk is not None else b'')
+            n_saved += n_chunk - n_written
+        if chunk is None:
+            return
+        self._save_header(file_name, n_saved, chunk.shape[1], info)
+        if to_mat and info is not None:
             print('saving data...')
-            sio.savemat(file_name, {'data': save_data, 'info': info})
-        # np.save(file_name, save_data)
+            sio.savemat(file_name + '.mat', {'data': read_recording(file_name).T, 'info': info})
 
-    def use_save_hook(self, file_name='default', info=None):
+    def _save_header(self, file_name, n_samples, n_cols, info):
+        header = {'n_samples': n_samples, 'n_cols': n_cols, 'dtype': '<f8', 'srate': self.srate, 'info': info}
+        with open(file_name + '.json.tmp', 'w') as f:
+            json.dump(header, f, default=str)
+        os.replace(file_name + '.json.tmp', file_name + '.json')
+
+    def use_save_hook(self, file_name='default', info=None, chunk_time=1, flush_time=1, to_mat=True):
         self.register_lock.acquire()
-        input_queue = queue.Queue()
-        self._input_queues['save'] = input_queue
+        self._get_ring().add_consumer('save')
         self.register_lock.release()
-        kwargs={'file_name': file_name, 'input_queue': input_queue, 'info': info}
+        kwargs={'file_name': file_name, 'name': 'save', 'info': info,
+                'chunk_time': chunk_time, 'flush_time': flush_time, 'to_mat': to_mat}
         self._t_save_pipeline = threading.Thread(target=self._save_handler, args=(), kwargs=kwargs, daemon=True, name='save')
         self._t_save_pipeline.start()
 
     def unuse_save_hook(self):
         self.register_lock.acquire()
-        if 'save' in self._input_queues:
-            self._input_queues['save'].put(None)
-            del self._input_queues['save']
+        if self._ring is not None:
+            self._ring.remove_consumer('save')
         self.register_lock.release()
 
     def register_hook(self, name=None, data_type=None, handler=None, args=(), kwargs={}):
@@ -324,17 +690,17 @@ class Amplifier:
         if names is None:
             names = self.registered_handlers.keys()
         self.register_lock.acquire()
+        ring = self._get_ring()
         for name in names:
             handler, args, kwargs, data_type = self.registered_handlers[name]
-            input_queue = queue.Queue()
+            ring.add_consumer(name, history=self._epoch_window(data_type)[0])
             output_queue = queue.Queue()
-            self._input_queues[name] = input_queue
             self._output_queues[name] = output_queue
 
             wrapper_kwargs = {}
             wrapper_kwargs['args'] = args
             wrapper_kwargs['kwargs'] = kwargs
-            wrapper_kwargs['input_queue'] = input_queue
+            wrapper_kwargs['name'] = name
             wrapper_kwargs['output_queue'] = output_queue
             wrapper_kwargs['handler'] = handler
             wrapper_kwargs['data_type'] = data_type
@@ -346,10 +712,9 @@ class Amplifier:
     def unuse_hooks(self, names=None):
         self.register_lock.acquire()
         if names is None:
-            names = list(self._input_queues.keys())
+            names = list(self._output_queues.keys())
         for name in names:
-            self._input_queues[name].put(None)
-            del self._input_queues[name]
+            self._ring.remove_consumer(name)
             self._output_queues[name].put(None)
             del self._output_queues[name]
         self.register_lock.release()
@@ -357,64 +722,108 @@ class Amplifier:
     def unregister_hook(self, handler=None):
         del self.registered_handlers[handler.__name__]
 
-    def _wrapper_handler(self, data_type=None, input_queue=None, output_queue=None, handler=None, args=(), kwargs={}):
+    def _epoch_window(self, data_type):
+        """
+        :param data_type: see register_hook.
+        :return: (lim_buff, latency, f_p, r_p) / samples: an epoch completes latency samples after its marker
+            and is [f_p:r_p] of the lim_buff samples before that point ((0, 0, 0, 0) for 'realtime').
+        """
         process_type = data_type['process_type']
-        label = data_type['label'] # int
         tlim = data_type['tlim'] # tuple
 
-        if process_type == 'fixed':
+        if process_type == 'realtime':
+            return 0, 0, 0, 0
+        elif process_type == 'fixed':
             lim_buff, latency = tlim
-            lim_buff = np.int(lim_buff*self.srate)
-            latency = np.int(latency*self.srate)
-            buff = self._Buff(lim_buff)
-            is_trigger = self._MarkerRuler(marker=label, latency=latency)
+            lim_buff = int(lim_buff*self.srate)
+            latency = int(latency*self.srate)
+            return lim_buff, latency, 0, lim_buff
         elif process_type == 'label':
             f_p, r_p = tlim
-            f_p = np.int(f_p*self.srate)
-            r_p = np.int(r_p*self.srate)
+            f_p = int(f_p*self.srate)
+            r_p = int(r_p*self.srate)
             lim_buff = max(r_p, 0) - f_p
             latency = max(f_p, r_p, 0)
-            r_p -= f_p
-            f_p -= f_p
-            buff = self._Buff(lim_buff)
-            is_trigger = self._MarkerRuler(marker=label, latency=latency)
-        waiting_queue = deque()
+            return lim_buff, latency, 0, r_p - f_p
 
-        while True:
-            try:
-                package = input_queue.get()
-                if package is None:
-                    output_queue.put(None)
+    def _epoch_cutter(self, data_type, ring=None, name=None):
+        """
+        :param data_type: see register_hook.
+        :param ring: _SharedRing the consumer name reads from; epochs are then cut from the ring's history
+            (cut(r_data, s_first), s_first: first sample of the package, see _SharedRing.get),
+            otherwise the cutter keeps its own buffer (cut(r_data)).
+        :return: function -> list of the epochs completed in this package
+            (views, valid until the next call / release).
+        """
+        if data_type['process_type'] == 'realtime':
+            return lambda r_data, s_first=None: [r_data]
+        lim_buff, latency, f_p, r_p = self._epoch_window(data_type)
+        is_trigger = self._MarkerRuler(marker=data_type['label'], latency=latency)
+
+        if ring is not None:
+            s_start = []  # first sample seen by this consumer
+
+            def cut(r_data, s_first):
+                if not s_start:
+                    s_start.append(s_first)
+                epochs = []
+                for i in is_trigger(r_data[:, -1]):
+                    # epoch: lim_buff samples before the triggered one, read from the shared ring
+                    begin = s_first + i - lim_buff
+                    if begin >= s_start[0]:
+                        epoch = ring.window(name, begin + f_p, begin + r_p)
+                        if epoch is not None:
+                            epochs.append(epoch)
+                return epochs
+            return cut
+
+        buff = self._Buff(lim_buff)
+
+        def cut(r_data):
+            buff.buffering(r_data)
+            n_samples = len(r_data)
+            epochs = []
+            for i in is_trigger(r_data[:, -1]):
+                # epoch: lim_buff samples before the triggered one (contiguous view)
+                if buff.is_full(n_samples-i):
+                    epochs.append(buff.access_buffer(n_samples-i)[f_p:r_p])
+            return epochs
+        return cut
+
+    def _wrapper_handler(self, data_type=None, name=None, output_queue=None, handler=None, args=(), kwargs={}):
+        ring = self._get_ring()
+        cut = self._epoch_cutter(data_type, ring, name)
+        pass_t_recv = _takes_t_recv(handler)
+
+        try:
+            while True:
+                packages = ring.get(name)
+                if packages is None:
                     break
-                # initialization
-                r_data, extras = package
-                if process_type == 'realtime':
-                    eeg_data = deepcopy(r_data) # avoid reference trouble
-                    waiting_queue.append(eeg_data)
-                elif process_type == 'fixed':
-                    for d in r_data:
-                        if is_trigger(d) and buff.is_full():
-                            eeg_data = deepcopy(buff.access_buffer())
-                            waiting_queue.append(eeg_data)
-                        else:
-                            buff.buffering([d])
-                else:
-                    for d in r_data:
-                        if is_trigger(d) and buff.is_full():
-                            eeg_data = deepcopy(buff.access_buffer())
-                            waiting_queue.append(eeg_data[f_p:r_p])
+                n_package, items = packages
+                t_dequeue = time.perf_counter()
+                self.stats.gauge(name, len(items))
+                # r_data & epochs: read-only views of the shared ring, valid until release
+                for r_data, extras, (t_recv, t_enqueue), s_first in items:
+                    self.stats.record(name, 'queue', t_dequeue - t_enqueue)
+                    for eeg_data in cut(r_data, s_first):
+                        t_start = time.perf_counter()
+                        if pass_t_recv:
+                            output = handler(eeg_data, extras, *args, t_recv=t_recv, **kwargs)
                         else:
-                            buff.buffering([d])
-
-                for _ in range(len(waiting_queue)):
-                    eeg_data = waiting_queue.popleft()
-                    output = handler(eeg_data, extras, *args, **kwargs)
-                    if output is not None:
-                        output_queue.put(output)
-
-            except Exception as e:
-                print(e)
-                break
+                            output = handler(eeg_data, extras, *args, **kwargs)
+                        t_end = time.perf_counter()
+                        self.stats.record(name, 'handler', t_end - t_start)
+                        if output is not None:
+                            output_queue.put(output)
+                            self.stats.record(name, 'output', time.perf_counter() - t_recv)
+                ring.release(name, n_package)
+        except Exception as e:
+            print(e)
+        finally:
+            # a failed hook leaves the ring: its cursor & pinned packages must not stall the others
+            ring.remove_consumer(name)
+            output_queue.put(None)
 
     def get_output_queue(self, name):
         return self._output_queues[name]
@@ -426,6 +835,98 @@ class Amplifier:
         else:
             return None, None
 
+def read_recording(file_name):
+    """
+    Memory-mapped view of a recording streamed by Amplifier's save hook.
+    :param file_name: without extension (file_name.bin & file_name.json).
+    :return: (n_samples, n_chans+1), only the samples covered by the last flushed header.
+    """
+    with open(file_name + '.json') as f:
+        header = json.load(f)
+    if header['n_samples'] == 0:
+        return np.zeros((0, header['n_cols']))
+    return np.memmap(file_name + '.bin', dtype=header['dtype'], mode='r',
+                     shape=(header['n_samples'], header['n_cols']))
+
+class OnlineDecoder:
+    """
+    Ready-made hook handler for online target identification.
+    Usage:
+        decoder = OnlineDecoder(method='eTRCA', chans=chans_idx, budget=0.05).fit(train_data)
+        amplifier.register_hook('decoder', data_type={'process_type': 'label', 'label': 1, 'tlim': (0.14, 0.64)},
+            handler=decoder)
+    Each epoch (n_points, n_chans+1) from the pipeline is turned into (label, scores, latency),
+    which goes to the hook's output queue. latency counts from the receipt of the package that
+    completed the epoch (passed by the pipeline as t_recv), i.e. queueing time included.
+    With a process executor the decoder runs in a child process: use latency_report(outputs).
+    """
+    def __init__(self, method='eTRCA', chans=None, budget=None):
+        """
+        :param method: 'TRCA', 'eTRCA' or 'eCCA'.
+        :param chans: column indices of the channels used by the model; if None, all but the label column.
+        :param budget: latency budget of each decision / s; decisions slower than it are counted in n_overrun.
+        """
+        if method not in ('TRCA', 'eTRCA', 'eCCA'):
+            raise ValueError('Unknown method: ' + str(method))
+        self.method = method
+        self.chans = chans
+        self.budget = budget
+        self.latencies = []
+        self.n_overrun = 0
+        self.model = None
+
+    def fit(self, train_data, **kwargs):
+        """
+        :param train_data: (n_events, n_trials, n_chans, n_points)
+        :param kwargs: for eCCA, freq_stim, fs, t_begin, t_end etc. of algorithms.ecca_fit.
+        """
+        if self.method == 'eCCA':
+            self.model = ecca_fit(train_data.transpose((0, 2, 3, 1)), **kwargs)
+        else:
+            self.model = {'w': mcee.TRCA_compute(train_data), 'template': train_data.mean(axis=1)}
+        return self
+
+    def decide(self, X):
+        """
+        :param X: (n_chans, n_points)
+        :return: label (index of event) and scores of all events.
+        """
+        if self.method == 'eCCA':
+            scores = ecca_predict(X, self.model)
+        else:
+            scores = mcee.trca_score(self.model['w'], self.model['template'], X[None, None, ...],
+                                     ensemble=(self.method == 'eTRCA'))[:, 0, 0]
+        return int(np.argmax(scores)), scores
+
+    def __call__(self, eeg_data, extras=None, t_recv=None):
+        t_begin = time.perf_counter() if t_recv is None else t_recv
+        eeg_data = np.asarray(eeg_data)
+        if self.chans is None:
+            X = eeg_data[:, :-1].T
+        else:
+            X = eeg_data[:, self.chans].T
+        label, scores = self.decide(X)
+        latency = time.perf_counter() - t_begin
+        self.latencies.append(latency)
+        if self.budget is not None and latency > self.budget:
+            self.n_overrun += 1
+        return label, scores, latency
+
+    def latency_report(self, outputs=None):
+        """
+        :param outputs: list of (label, scores, latency) from the output queue;
+            if None, the latencies recorded in this process.
+        """
+        if outputs is None:
+            latencies, n_overrun = np.array(self.latencies), self.n_overrun
+        else:
+            latencies = np.array([output[2] for output in outputs])
+            n_overrun = int(np.sum(latencies > self.budget)) if self.budget is not None else 0
+        if latencies.size == 0:
+            return {}
+        return {'n_decisions': latencies.size, 'mean': latencies.mean(),
+                'p95': np.percentile(latencies, 95), 'max': latencies.max(), 'n_overrun': n_overrun}
+
 class NoConnectionError(Exception):
     """No connection established."""
     pass
@@ -447,12 +948,15 @@ class Neuroscan(Amplifier):
     }
 
     def __init__(self, address=None, srate=1000, num_chans=68):
-        Amplifier.__init__()
+        Amplifier.__init__(self)
         self.address = address
         self.neuro_link = None
         self.num_chans = num_chans
+        self.srate = srate
         # the size of package in neuroscan data is srate/25*(num_chans+1)*4 bytes
         self.pkg_size = srate/25*(num_chans+1)*4
+        # preallocated receive buffer, reused by every _recv
+        self._b_buff = bytearray(int(self.pkg_size))
         self.timeout = 0.0625
         self.connected = False
         self.started = False
@@ -467,8 +971,8 @@ class Neuroscan(Amplifier):
         return (ch_id[0].decode('utf-8'), w_code[0], w_request[0], pkg_size[0])
 
     def _unpack_data(self, num_chans, b_data):
-        fmt = '>' + str(num_chans + 1) + 'i'
-        data = np.array(list(struct.iter_unpack(fmt, b_data)), dtype=np.float)
+        # big-endian int32 -> float64 in one conversion, then scaled in place
+        data = np.frombuffer(b_data, dtype='>i4').reshape(-1, num_chans+1).astype(np.float64)
         data[:, :-1] *= 0.0298
         data[:, -1] -= 65280
         return data
@@ -486,22 +990,21 @@ class Neuroscan(Amplifier):
         return data.tobytes()
 
     def _recv(self, num_bytes):
-        fragments = []
-        done = False
+        # receive straight into the preallocated buffer
+        # the returned memoryview is only valid until the next _recv
+        if len(self._b_buff) < num_bytes:
+            self._b_buff = bytearray(num_bytes)
+        b_view = memoryview(self._b_buff)[:num_bytes]
         b_count = 0
-        while not done:
+        while b_count < num_bytes:
             try:
-                chunk = self.neuro_link.recv(num_bytes - b_count)
+                n_bytes = self.neuro_link.recv_into(b_view[b_count:], num_bytes - b_count)
             except socket.timeout:
                 return None
-
-            if b_count == num_bytes or not chunk:
-                done = True
-            b_count += len(chunk)
-            fragments.append(chunk)
-
-        b_data = b''.join(fragments)
-        return b_data
+            if n_bytes == 0:  # connection closed
+                return None
+            b_count += n_bytes
+        return b_view
 
     def recv(self):
         extras = None
@@ -522,12 +1025,14 @@ class Neuroscan(Amplifier):
 
     def command(self, method):
         if method == 'connect':
+            if self.neuro_link is None:
+                self.neuro_link = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.neuro_link.connect(self.address)
             self.connected = True
         elif method == 'start_acq':
             self.neuro_link.send(self._COMMANDS['start_acq'])
-            r_data, extras = self.neuro_link.recv()
-            r_data, extras = self.neuro_link.recv()
+            r_data, extras = self.recv()
+            r_data, extras = self.recv()
         elif method == 'stop_acq':
             self.neuro_link.send(self._COMMANDS['stop_acq'])
             time.sleep(self.timeout*2)
@@ -550,6 +1055,155 @@ class Neuroscan(Amplifier):
         self.unuse_hooks()
         self.unuse_save_hook()
 
+class AsyncNeuroscan(Neuroscan):
+    """
+    Neuroscan with an asyncio backend.
+    One event loop thread reads the socket without blocking and runs every hook as a coroutine,
+    instead of one OS thread per hook talking through queue.Queue.
+    Hooks keep the register_hook/use_hooks API; a handler could also be a coroutine function,
+    and data_type['executor'] = 'process' (or 'thread') offloads a heavy, picklable handler
+    (e.g. OnlineDecoder) to a process pool of n_workers (or the default thread pool).
+    A process pool belongs to one hook: its handler is installed once in every worker,
+    only the epochs and extras are sent for each call.
+    The save hook still runs in its own thread on the shared ring, with ring_policy 'drop' only.
+    """
+    def __init__(self, address=None, srate=1000, num_chans=68, n_workers=1):
+        Neuroscan.__init__(self, address, srate, num_chans)
+        self.n_workers = n_workers
+        self.loop = None
+        self._t_loop = None
+        self._executors = {}  # hook -> ProcessPoolExecutor
+        self._hook_queues = {}
+
+    def _start_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self._t_loop = threading.Thread(target=self.loop.run_forever, daemon=True, name='asyncio_loop')
+            self._t_loop.start()
+
+    async def _arecv(self, num_bytes):
+        if len(self._b_buff) < num_bytes:
+            self._b_buff = bytearray(num_bytes)
+        b_view = memoryview(self._b_buff)[:num_bytes]
+        b_count = 0
+        while b_count < num_bytes:
+            n_bytes = await self.loop.sock_recv_into(self.neuro_link, b_view[b_count:])
+            if n_bytes == 0:  # connection closed
+                return None
+            b_count += n_bytes
+        return b_view
+
+    async def _data_pipeline_async(self):
+        ring = self._get_ring()
+        while True:
+            try:
+                b_header = await self._arecv(12)
+                if b_header is None:
+                    break
+                header = self._unpack_header(b_header)
+                if header[-1] == 0:
+                    continue
+                b_data = await self._arecv(header[-1])
+                if b_data is None:
+                    break
+            except (OSError, ValueError):
+                break
+            t_recv = time.perf_counter()
+            r_data = self._unpack_data(self.num_chans, b_data)
+            extras = None
+            if ring.cursors:  # save hook
+                ring.put((r_data, extras), t_recv=t_recv)
+            for name, (cut, hook_queue) in list(self._hook_queues.items()):
+                for eeg_data in cut(r_data):
+                    # epochs are views of the hook's buffer: keep a copy until the hook runs
+                    hook_queue.put_nowait((eeg_data if eeg_data.base is None else eeg_data.copy(), extras,
+                                           (t_recv, time.perf_counter())))
+                self.stats.gauge(name, hook_queue.qsize())
+        ring.close()
+        for _, hook_queue in list(self._hook_queues.values()):
+            hook_queue.put_nowait(None)
+
+    def _get_ring(self):
+        # put runs on the event loop: a blocking ring would stall every hook
+        if self.ring_policy != 'drop':
+            raise ValueError("AsyncNeuroscan only supports ring_policy='drop'.")
+        return Neuroscan._get_ring(self)
+
+    def establish_data_pipeline(self):
+        self._get_ring()
+        self._start_loop()
+        self.neuro_link.setblocking(False)
+        asyncio.run_coroutine_threadsafe(self._data_pipeline_async(), self.loop)
+
+    async def _async_wrapper(self, name, hook_queue, output_queue, handler, args, kwargs, executor):
+        pass_t_recv = _takes_t_recv(handler)
+        while True:
+            package = await hook_queue.get()
+            if package is None:
+                output_queue.put(None)
+                if name in self._executors:
+                    self._executors.pop(name).shutdown(wait=False)
+                break
+            eeg_data, extras, (t_recv, t_enqueue) = package
+            t_start = time.perf_counter()
+            self.stats.record(name, 'queue', t_start - t_enqueue)
+            call_kwargs = dict(kwargs, t_recv=t_recv) if pass_t_recv else kwargs
+            try:
+                if asyncio.iscoroutinefunction(handler):
+                    output = await handler(eeg_data, extras, *args, **call_kwargs)
+                elif executor == 'process':  # the handler is already in the workers
+                    run = partial(_run_hook, eeg_data, extras, **({'t_recv': t_recv} if pass_t_recv else {}))
+                    output = await self.loop.run_in_executor(self._executors[name], run)
+                elif executor == 'thread':
+                    output = await self.loop.run_in_executor(None, partial(handler, eeg_data, extras, *args, **call_kwargs))
+                else:
+                    output = handler(eeg_data, extras, *args, **call_kwargs)
+            except Exception as e:
+                print(e)
+                break
+            self.stats.record(name, 'handler', time.perf_counter() - t_start)
+            if output is not None:
+                output_queue.put(output)
+                self.stats.record(name, 'output', time.perf_counter() - t_recv)
+
+    async def _create_hook_queue(self):
+        return asyncio.Queue()
+
+    def use_hooks(self, names=None):
+        self._start_loop()
+        if names is None:
+            names = self.registered_handlers.keys()
+        self.register_lock.acquire()
+        for name in names:
+            handler, args, kwargs, data_type = self.registered_handlers[name]
+            executor = data_type.get('executor', None)
+            if executor == 'process' and name not in self._executors:
+                self._executors[name] = ProcessPoolExecutor(max_workers=self.n_workers, initializer=_install_hook,
+                                                            initargs=(handler, args, kwargs))
+            output_queue = queue.Queue()
+            self._output_queues[name] = output_queue
+            hook_queue = asyncio.run_coroutine_threadsafe(self._create_hook_queue(), self.loop).result()
+            self._hook_queues[name] = (self._epoch_cutter(data_type), hook_queue)
+            asyncio.run_coroutine_threadsafe(
+                self._async_wrapper(name, hook_queue, output_queue, handler, args, kwargs, executor), self.loop)
+        self.register_lock.release()
+
+    def unuse_hooks(self, names=None):
+        self.register_lock.acquire()
+        if names is None:
+            names = list(self._hook_queues.keys())
+        for name in names:
+            _, hook_queue = self._hook_queues.pop(name)
+            self.loop.call_soon_threadsafe(hook_queue.put_nowait, None)
+            del self._output_queues[name]
+        self.register_lock.release()
+
+    def _cleanup(self):
+        Neuroscan._cleanup(self)
+        for executor in self._executors.values():
+            executor.shutdown(wait=False)
+        self._executors = {}
+
 class NeuroScanPort(NeuroPort):
     def __init__(self, port_address=0xdefc):
         super().__init__()
@@ -17,7 +17,7 @@ import copy
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-from mne.filter import filter_data
+from fb_engine import (filter_bank, design_sos)
 
 #%% Load data
 eeg = io.loadmat(r'I:\SSVEP\dataset\preprocessed_data\weisiwen\raw_data.mat')
@@ -56,19 +56,14 @@ pl_freq = [(8*(x+1)-2) for x in range(10)]  # the lowest pass frequencies
 ph_freq = [(8*(x+2)+2) for x in range(10)]  # the highest pass frequencies
 sh_freq = [(8*(x+2)+4) for x in range(10)]  # the highest stop frequencies
 
-# 5-D tension
-fb_data = np.zeros((n_bands, n_events, n_trials, n_chans, n_times))
-
-# make data through filter bank
-for i in range(n_bands):
-    # design Chebyshev-II iir band-pass filter
-    b, a = signal.iirdesign(wp=[pl_freq[i], ph_freq[i]], ws=[sl_freq[i], sh_freq[i]],
-                        gpass=3, gstop=18, analog=False, ftype='cheby1', fs=sfreq)
-    # filter data forward and backward to achieve zero-phase
-    fb_data[i,:,:,:,:] = signal.filtfilt(b=b, a=a, x=pk_sig, axis=-1)
-    del a, b
+# 5-D tension: (n_bands, n_events, n_trials, n_chans, n_times), float32
+# design Chebyshev-I iir band-pass filters (minimum order, cached as second-order sections)
+# & filter data forward and backward to achieve zero-phase, all bands at once
+bands = [(pl_freq[i], ph_freq[i], sl_freq[i], sh_freq[i]) for i in range(n_bands)]
+fb_data = filter_bank(pk_sig, sfreq=sfreq, bands=bands, method='iir', order=None,
+                      ftype='cheby1', gpass=3, gstop=18)
     
-del i, sl_freq, pl_freq, ph_freq, sh_freq
+del bands, sl_freq, pl_freq, ph_freq, sh_freq
 print('Filter bank construction complete!')
 
 #%% IIR method 2
@@ -81,17 +76,15 @@ sns.set(style='whitegrid')
 
 fig, ax = plt.subplots(2, 1, figsize=(8, 6))
 
-# 5-D tension
-fb_data = np.zeros((n_events, n_bands, n_trials, n_chans, n_times))
+# 5-D tension: (n_events, n_bands, n_trials, n_chans, n_times)
+# Chebyshev I bandpass filters, filtered forward and backward to achieve zero-phase
+bands = [(l_freq[i], h_freq) for i in range(n_bands)]
+fb_data = filter_bank(pk_sig, sfreq=sfreq, bands=bands, method='iir', order=5,
+                      ftype='cheby1', rp=0.5).swapaxes(0, 1)
 
-# design Chebyshev I bandpass filter
-for i in range(n_bands):
-    b, a = signal.cheby1(N=5, rp=0.5, Wn=[l_freq[i], h_freq], btype='bandpass',
-                         analog=False, output='ba', fs=sfreq)
-    # filter data forward and backward to achieve zero-phase
-    fb_data[:,i,:,:,:] = signal.filtfilt(b=b, a=a, x=pk_sig, axis=-1)
+for i, sos in enumerate(design_sos(sfreq, bands, order=5, ftype='cheby1', rp=0.5)):
     # plot figures
-    w, h = signal.freqz(b, a)
+    w, h = signal.sosfreqz(sos)
     freq = (w*sfreq) / (2*np.pi)
     
     ax[0].plot(freq, 20*np.log10(abs(h)), label='band %d'%(i+1))
@@ -108,8 +101,8 @@ for i in range(n_bands):
     ax[1].set_xlim([0, 200])
     ax[1].legend(loc='best')
     
-    del b, a, w, h, freq
-del i
+    del sos, w, h, freq
+del i, bands
 plt.show()
 
 #%% FIR method
@@ -119,14 +112,7 @@ n_bands = 10
 l_freq = [(8*(x+1)-2) for x in range(n_bands)]
 h_freq = 90
 
-# 5-D tension
-fb_data = np.zeros((n_bands, n_events, n_trials, n_chans, n_times))
-
-# make data through filter bank
-for i in range(n_bands):
-    for j in range(pk_sig.shape[0]):
-        fb_data[i,j,:,:,:] = filter_data(pk_sig[j,:,:,:], sfreq=sfreq,
-               l_freq=l_freq[i], h_freq=h_freq[i], n_jobs=4, filter_length='500ms',
-               l_trans_bandwidth=2, h_trans_bandwidth=2, method='fir',
-               phase='zero', fir_window='hamming', fir_design='firwin2',
-               pad='reflect_limited')
+# 5-D tension: (n_bands, n_events, n_trials, n_chans, n_times)
+# 500ms hamming-window FIR filters, zero-phase, FFT overlap-add over all events at once
+fb_data = filter_bank(pk_sig, sfreq=sfreq, bands=[(l_freq[i], h_freq) for i in range(n_bands)],
+                      method='fir', filter_length=0.5, window='hamming')
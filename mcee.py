@@ -11,15 +11,21 @@ Created on Wed Dec 18 12:07:56 2019
     (6) template_phase: best initial phase of signal template
     (7) template_corr: compute correlation between real signal and template
     (8) apply_SRCA: apply SRCA model
+    (9) batch_mlr: closed-form OLS/Ridge regression for all trials at once
+    (10) srca_index & multi_srca: vectorized SRCA for all target channels
     
 2. Two kinds of recursive algorithm to choose channels for SRCA optimization
     (1) stepwise_SRCA | including SNR, Corr and CCA method, intra-class optimization
     (2) stepwise_SRCA_fs | fisher score method, inter-class optimization
+    (3) SRCA_train_pool | parallel training of (event, target channel, CV fold) models
 
 3. Target identification
-    (1) standard CCA
+    (1) standard CCA (sin_bank & sin_qr: cached sine/cosine reference bank,
+        CCA_qr & cca_svd: QR-based CCA kernel,
+        sCCA_classify & cca_score: batched multi-trial, multi-frequency CCA)
     (2) TRCA: including standard TRCA and extended-TRCA
         for normal signal and SRCA signal
+        (trca_matrix & solve_gep: shared TRCA kernel, also used by other modules)
     (3) DCPM: 5 different descrimination indices for normal and SRCA signal
     (4) corr_detect: single channel detection
 
@@ -32,17 +38,73 @@ version 1.0
 # %% Import third part module
 import numpy as np
 from numpy import linalg as LA
+from scipy import linalg as sLA
 from numpy import corrcoef as CORR
 from numpy import newaxis as NA
 from numpy import (sin, cos)
+from numpy.lib.stride_tricks import as_strided
 
 from sklearn import linear_model
 
 import copy
+import os
+import json
+import hashlib
+import tempfile
 import time
 from math import pi
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # %% Basic operating function
+# closed-form multi-linear regression for all trials at once
+def batch_mlr(model_input, model_target, regression='OLS', alpha=1.0):
+    '''
+    Closed-form OLS/Ridge regression solved for every trial simultaneously
+        using the stacked normal equations: (Xc Xc.T + alpha*I) * coef = Xc yc.T
+
+    Parameters
+    ----------
+    model_input : (n_trials, n_chans, n_times) or (n_trials, n_times)
+        rest-state data of regression channels.
+    model_target : (n_trials, n_times)
+        rest-state data of target channel.
+    regression : str, optional
+        OLS or Ridge. The default is 'OLS'.
+    alpha : float, optional
+        parameters used in Ridge regression. The default is 1.0.
+
+    Returns
+    -------
+    coef : (n_trials, n_chans)
+        regression coefficients of each trial.
+    intercept : (n_trials,)
+        baseline drift of each trial.
+    '''
+    if model_input.ndim == 2:  # single regression channel
+        model_input = model_input[:, NA, :]
+    n_chans = model_input.shape[1]
+
+    # centralize data so that the intercept could be computed separately
+    input_mean = model_input.mean(axis=-1)                      # (n_trials, n_chans)
+    target_mean = model_target.mean(axis=-1)                    # (n_trials,)
+    Xc = model_input - input_mean[..., NA]
+    yc = model_target - target_mean[:, NA]
+
+    # stacked normal equations
+    gram = np.einsum('tcp,tdp->tcd', Xc, Xc)                   # (n_trials, n_chans, n_chans)
+    cross = np.einsum('tcp,tp->tc', Xc, yc)                     # (n_trials, n_chans)
+    if regression == 'Ridge':
+        gram += alpha*np.eye(n_chans)
+    elif regression != 'OLS':
+        raise ValueError('Closed-form solution only supports OLS and Ridge regression.')
+    try:
+        coef = LA.solve(gram, cross[..., NA])[..., 0]
+    except LA.LinAlgError:  # rank-deficient trial(s): minimum-norm solution
+        coef = np.einsum('tcd,td->tc', LA.pinv(gram), cross)
+    intercept = target_mean - np.einsum('tc,tc->t', coef, input_mean)
+    return coef, intercept
+
 # spatial regression component analysis (main function)
 def srca(model_input, model_target, data_input, data_target, regression='OLS',
         alpha=1.0, l1_ratio=1.0):
@@ -61,6 +123,7 @@ def srca(model_input, model_target, data_input, data_target, regression='OLS',
         mission-state data of target channel.
     regression : str, optional
         OLS, Ridge, Lasso or ElasticNet. The default is 'OLS'.
+        OLS and Ridge are solved in closed form for all trials at once (see batch_mlr).
     alpha : float, optional
         parameters used in Ridge, Lasso and EN regression. The default is 1.0.
     l1_ratio : float, optional
@@ -71,15 +134,18 @@ def srca(model_input, model_target, data_input, data_target, regression='OLS',
     extract : (n_trials, n_times)
         SRCA filtered data.
     '''
+    if model_input.ndim == 2:  # single regression channel
+        model_input, data_input = model_input[:, NA, :], data_input[:, NA, :]
+    if regression in ['OLS', 'Ridge']:
+        RC, RI = batch_mlr(model_input, model_target, regression, alpha)
+        estimate = np.einsum('tc,tcp->tp', RC, data_input) + RI[:, NA]
+        extract = data_target - estimate
+        return extract
     n_trials = data_input.shape[0]
     n_times = data_input.shape[-1]
     estimate = np.zeros((n_trials, n_times))  # estimate signal
     for i in range(n_trials):  # basic operating unit: (n_times, n_chans), (n_times, 1)
-        if regression == 'OLS':
-            L = linear_model.LinearRegression().fit(model_input[i, ...].T, model_target[i, :].T)
-        elif regression == 'Ridge':
-            L = linear_model.Ridge(alpha=alpha).fit(model_input[i, ...].T, model_target[i, :].T)
-        elif regression == 'Lasso':
+        if regression == 'Lasso':
             L = linear_model.Lasso(alpha=alpha).fit(model_input[i, ...].T, model_target[i, :].T)
         elif regression == 'ElasticNet':
             L = linear_model.ElasticNet(alpha=alpha, l1_ratio=l1_ratio).fit(model_input[i, ...].T,
@@ -104,13 +170,9 @@ def snr_time(data):
     snr : float
         the mean of SNR sequence.
     '''
-    snr = np.zeros((data.shape[1]))             # (n_times)
-    ex = np.mat(np.mean(data, axis=0))          # one-channel data: (1, n_times)
-    temp = np.mat(np.ones((1, data.shape[0])))  # (1, n_trials)
-    minus = (temp.T * ex).A                     # (n_trials, n_times)
-    ex = (ex.A) ** 2                            # signal's power
-    var = np.mean((data - minus)**2, axis=0)    # noise's power (avg)
-    snr = ex/var
+    ex = np.mean(data, axis=0)                  # one-channel data: (n_times,)
+    var = np.mean((data - ex)**2, axis=0)       # noise's power (avg)
+    snr = ex**2 / var                           # signal's power / noise's power
     return snr
 
 # compute time-domain Pearson Correlation Coefficient
@@ -151,17 +213,12 @@ def fisher_score(data):
     '''
     # initialization
     sampleNum = data.shape[1]    # n_trials
-    featureNum = data.shape[-1]  # n_times
-    groupNum = data.shape[0]     # n_events
     miu = data.mean(axis=1)      # (n_events, n_times)
     all_miu = miu.mean(axis=0)
     # inter-class divergence
     ite_d = np.sum(sampleNum * (miu - all_miu)**2, axis=0)
     # intra-class divergence
-    itr_d= np.zeros((groupNum, featureNum))
-    for i in range(groupNum):
-        for j in range(featureNum):
-            itr_d[i,j] = np.sum((data[i,:,j] - miu[i,j])**2)
+    itr_d = np.sum((data - miu[:, NA, :])**2, axis=1)
     # fisher score
     fs = (ite_d) / np.sum(itr_d, axis=0)
     return fs
@@ -187,9 +244,7 @@ def sinw(freq, time, phase, sfreq=1000):
     wave : (time*sfreq,)
         sequence.
     '''
-    n_point = int(time*sfreq)
-    time_point = np.linspace(0, (n_point-1)/sfreq, n_point)
-    wave = sin(2*pi*freq*time_point + pi*phase)
+    wave = sin_bank(freq, 1, int(time*sfreq), phase, sfreq)[0]
     return wave
 
 # choose best template phase
@@ -251,6 +306,93 @@ def template_corr(data, freq, phase, sfreq=1000):
     return corr
 
 # apply SRCA model
+def srca_index(tar_chans, model_chans, chans):
+    '''
+    Resolve channel names of SRCA models into index arrays (only once for many batches)
+
+    Parameters
+    ----------
+    tar_chans : list
+        names of target channels.
+    model_chans : list
+        names of SRCA channels for all target channels.
+    chans : list
+        names of all channels.
+
+    Returns
+    -------
+    target_index : (n_targets,)
+        indices of target channels.
+    model_index : (n_targets, max_model_chans)
+        indices of SRCA channels, padded with 0.
+    model_mask : (n_targets, max_model_chans)
+        False for padded positions.
+    '''
+    n_model = max([len(mc) for mc in model_chans] + [1])
+    target_index = np.array([chans.index(tc) for tc in tar_chans], dtype=int)
+    model_index = np.zeros((len(tar_chans), n_model), dtype=int)
+    model_mask = np.zeros((len(tar_chans), n_model), dtype=bool)
+    for ntc in range(len(tar_chans)):
+        model_index[ntc, :len(model_chans[ntc])] = [chans.index(mc) for mc in model_chans[ntc]]
+        model_mask[ntc, :len(model_chans[ntc])] = True
+    return target_index, model_index, model_mask
+
+def multi_srca(data, target_index, model_index, model_mask, rest=(0, 1000), task=(1140, None),
+               regression='OLS', alpha=1.0):
+    '''
+    Apply SRCA models of all target channels to a batch of trials in one vectorized pass
+        (OLS or Ridge regression, solved in closed form for each trial & target channel)
+
+    Parameters
+    ----------
+    data : (n_trials, n_chans, n_times)
+        input dataset.
+    target_index, model_index, model_mask : ndarray
+        see srca_index.
+    rest : tuple of int, optional
+        (start, end) points of rest state. The default is (0, 1000).
+    task : tuple of int, optional
+        (start, end) points of mission state. The default is (1140, None).
+    regression : str, optional
+        OLS or Ridge. The default is 'OLS'.
+    alpha : float, optional
+        parameters used in Ridge regression. The default is 1.0.
+
+    Returns
+    -------
+    f_data : (n_trials, n_targets, n_task_times)
+        SRCA filtered data.
+    '''
+    n_model = model_index.shape[-1]
+    rest_data = data[..., rest[0]:rest[1]]
+    task_data = data[..., task[0]:task[1]]
+    mask = model_mask[..., NA]
+
+    # (n_trials, n_targets, n_model, n_times), padded channels are set to zero
+    rest_model = rest_data[:, model_index, :] * mask
+    rest_target = rest_data[:, target_index, :]
+    input_mean = rest_model.mean(axis=-1)
+    target_mean = rest_target.mean(axis=-1)
+    Xc = rest_model - input_mean[..., NA]
+    yc = rest_target - target_mean[..., NA]
+
+    gram = np.einsum('tnkp,tnjp->tnkj', Xc, Xc)
+    gram += ~mask * np.eye(n_model)  # padded positions get zero coefficients
+    if regression == 'Ridge':
+        gram += alpha*np.eye(n_model)
+    elif regression != 'OLS':
+        raise ValueError('Vectorized SRCA only supports OLS and Ridge regression.')
+    cross = np.einsum('tnkp,tnp->tnk', Xc, yc)
+    try:
+        coef = LA.solve(gram, cross[..., NA])[..., 0]
+    except LA.LinAlgError:  # collinear model channels: minimum-norm solution (see batch_mlr)
+        coef = np.einsum('tnkj,tnj->tnk', LA.pinv(gram), cross)
+    intercept = target_mean - np.einsum('tnk,tnk->tn', coef, input_mean)
+
+    estimate = np.einsum('tnk,tnkp->tnp', coef, task_data[:, model_index, :] * mask)
+    f_data = task_data[:, target_index, :] - estimate - intercept[..., NA]
+    return f_data
+
 def apply_SRCA(data, tar_chans, model_chans, chans, regression='OLS', sp=1140):
     '''
     Apply SRCA model in test dataset
@@ -275,6 +417,10 @@ def apply_SRCA(data, tar_chans, model_chans, chans, regression='OLS', sp=1140):
     f_data : (n_trials, n_chans, n_times)
         SRCA filtered data.
     '''
+    if regression in ['OLS', 'Ridge']:  # all target channels at once
+        target_index, model_index, model_mask = srca_index(tar_chans, model_chans, chans)
+        return multi_srca(data, target_index, model_index, model_mask, rest=(0, 1000),
+                          task=(sp, None), regression=regression)
     n_trials = data.shape[0]
     n_chans = len(tar_chans)
     n_times = data.shape[-1] - sp
@@ -351,6 +497,302 @@ def corr_coef(X, y):
 
 
 # %% Stepwise SRCA
+# cached covariance & Cholesky factors for the recursive channel search
+def gram_cache(w, w_target, regression='OLS', alpha=1.0):
+    '''
+    Precompute the per-trial channel covariance of the rest-state data once,
+        so that each candidate model in the stepwise search could be solved
+        from sub-blocks of these matrices instead of refitting the regression.
+
+    Parameters
+    ----------
+    w : (n_trials, n_chans, n_times)
+        rest-state data of all candidate regression channels.
+    w_target : (n_trials, n_times)
+        rest-state data of target channel.
+    regression : str, optional
+        OLS or Ridge. The default is 'OLS'.
+    alpha : float, optional
+        parameters used in Ridge regression. The default is 1.0.
+
+    Returns
+    -------
+    cache : dict
+        'gram' : (n_trials, n_chans, n_chans), Xc @ Xc.T (+ alpha*I for Ridge)
+        'cross' : (n_trials, n_chans), Xc @ yc.T
+        'input_mean' : (n_trials, n_chans)
+        'target_mean' : (n_trials,)
+    '''
+    if regression not in ['OLS', 'Ridge']:
+        raise ValueError('Cached stepwise search only supports OLS and Ridge regression, '
+                         'see refit_extract for Lasso and ElasticNet.')
+    input_mean = w.mean(axis=-1)
+    target_mean = w_target.mean(axis=-1)
+    Xc = w - input_mean[..., NA]
+    yc = w_target - target_mean[:, NA]
+    gram = np.einsum('tcp,tdp->tcd', Xc, Xc)
+    if regression == 'Ridge':
+        gram += alpha*np.eye(w.shape[1])
+    cache = {'gram': gram, 'cross': np.einsum('tcp,tp->tc', Xc, yc),
+             'input_mean': input_mean, 'target_mean': target_mean}
+    return cache
+
+# pivots <= pivot_tol*diag belong to channels collinear with the core ones
+pivot_tol = 1e-10
+
+def tri_solve(L, B, trans=False):
+    '''
+    Batched forward (or backward) substitution with lower-triangular factors
+
+    Parameters
+    ----------
+    L : (n_trials, k, k)
+        lower-triangular matrices.
+    B : (n_trials, k, m)
+        right-hand side.
+    trans : bool, optional
+        if True, solve L.T @ X = B instead of L @ X = B. The default is False.
+
+    Returns
+    -------
+    X : (n_trials, k, m)
+    '''
+    k = L.shape[-1]
+    X = np.zeros(B.shape)
+    if not trans:
+        for i in range(k):
+            X[:, i] = (B[:, i] - np.einsum('tj,tjm->tm', L[:, i, :i], X[:, :i])) / L[:, i, i, NA]
+    else:
+        for i in reversed(range(k)):
+            X[:, i] = (B[:, i] - np.einsum('tj,tjm->tm', L[:, i+1:, i], X[:, i+1:])) / L[:, i, i, NA]
+    return X
+
+def chol_append(L, gram, core, index):
+    '''
+    Extend the Cholesky factor of gram[core, core] by one channel
+
+    Parameters
+    ----------
+    L : (n_trials, k, k)
+        Cholesky factor of the current core channels.
+    gram : (n_trials, n_chans, n_chans)
+        cached covariance (see gram_cache).
+    core : list of int
+        indices of the current core channels.
+    index : int
+        index of the channel to be added.
+
+    Returns
+    -------
+    L_new : (n_trials, k+1, k+1)
+    '''
+    n_trials, k = L.shape[0], L.shape[-1]
+    core = np.asarray(core, dtype=int)
+    l = tri_solve(L, gram[:, core, index][..., NA])[..., 0]  # (n_trials, k)
+    L_new = np.zeros((n_trials, k+1, k+1))
+    L_new[:, :k, :k] = L
+    L_new[:, k, :k] = l
+    # clamp the pivot of a (numerically) collinear channel instead of taking sqrt of <= 0
+    diag = gram[:, index, index]
+    L_new[:, k, k] = np.sqrt(np.maximum(diag - np.sum(l**2, axis=-1), pivot_tol*diag))
+    return L_new
+
+def chol_update(L, x):
+    '''
+    Rank-one update of Cholesky factors: L_new @ L_new.T = L @ L.T + x @ x.T
+
+    Parameters
+    ----------
+    L : (n_trials, k, k)
+    x : (n_trials, k)
+
+    Returns
+    -------
+    L_new : (n_trials, k, k)
+    '''
+    L, x = L.copy(), x.copy()
+    for i in range(L.shape[-1]):
+        r = np.sqrt(L[:, i, i]**2 + x[:, i]**2)
+        c, s = r/L[:, i, i], x[:, i]/L[:, i, i]
+        L[:, i, i] = r
+        L[:, i+1:, i] = (L[:, i+1:, i] + s[:, NA]*x[:, i+1:]) / c[:, NA]
+        x[:, i+1:] = c[:, NA]*x[:, i+1:] - s[:, NA]*L[:, i+1:, i]
+    return L
+
+def chol_delete(L, p):
+    '''
+    Remove the p-th channel from Cholesky factors (downdate)
+
+    Parameters
+    ----------
+    L : (n_trials, k, k)
+    p : int
+        position (in the core list) of the channel to be removed.
+
+    Returns
+    -------
+    L_new : (n_trials, k-1, k-1)
+    '''
+    L_new = np.delete(np.delete(L, p, axis=1), p, axis=2)
+    if p < L.shape[-1]-1:
+        L_new[:, p:, p:] = chol_update(L_new[:, p:, p:], L[:, p+1:, p])
+    return L_new
+
+def stepwise_extract(cache, L, core, candidates, signal_data, data_target):
+    '''
+    SRCA filtered data of every "core + 1 candidate" model,
+        solved from the cached covariance and the Cholesky factor of the core.
+
+    Parameters
+    ----------
+    cache : dict
+        see gram_cache.
+    L : (n_trials, k, k)
+        Cholesky factor of the core channels' covariance.
+    core : list of int
+        indices of the current core channels.
+    candidates : list of int
+        indices of the channels to be tried.
+    signal_data : (n_trials, n_chans, n_times)
+        signal part input data array.
+    data_target : (n_trials, n_times)
+        signal part target data array.
+
+    Returns
+    -------
+    extract : (n_candidates, n_trials, n_times)
+    '''
+    gram, cross = cache['gram'], cache['cross']
+    x_mean, y_mean = cache['input_mean'], cache['target_mean']
+    core = np.asarray(core, dtype=int)
+    cands = np.asarray(candidates, dtype=int)
+
+    # coefficients: only O(k^2) work per candidate
+    l = tri_solve(L, gram[:, core][:, :, cands])                # (n_trials, k, n_cands)
+    z = tri_solve(L, cross[:, core][..., NA])[..., 0]           # (n_trials, k)
+    diag = gram[:, cands, cands]
+    d2 = diag - np.sum(l**2, axis=1)                            # (n_trials, n_cands)
+    # a candidate collinear with the core adds nothing to the regression
+    collinear = d2 <= pivot_tol*diag
+    coef_new = np.where(collinear, 0., (cross[:, cands] - np.einsum('tkm,tk->tm', l, z))
+                        / np.where(collinear, 1., d2))
+    u = tri_solve(L, l, trans=True)                             # (n_trials, k, n_cands)
+    coef_core = tri_solve(L, z[..., NA], trans=True)[..., 0]    # (n_trials, k)
+
+    # residual of the core model & innovation of each candidate (baseline removed)
+    core_data = signal_data[:, core, :] - x_mean[:, core, NA]
+    residual = data_target - y_mean[:, NA] - np.einsum('tk,tkp->tp', coef_core, core_data)
+    innovation = signal_data[:, cands, :] - x_mean[:, cands, NA]
+    innovation -= np.einsum('tkm,tkp->tmp', u, core_data)
+    extract = residual[:, NA, :] - coef_new[..., NA]*innovation
+    return extract.swapaxes(0, 1)
+
+def refit_extract(w, w_target, signal_data, data_target, regression, alpha=1.0, l1_ratio=1.0):
+    '''
+    Candidate extractor refitting the regression of every "core + 1 candidate" model,
+        used by stepwise_search for Lasso and ElasticNet (no closed-form solution).
+
+    Parameters
+    ----------
+    w, w_target, signal_data, data_target : see SRCA_train.
+    regression : str
+        Lasso or ElasticNet (OLS and Ridge also work, but are slower than the cached path).
+    alpha, l1_ratio : float, optional
+        see srca.
+
+    Returns
+    -------
+    extract : callable
+        extract(core, candidates) -> (n_candidates, n_trials, n_times)
+    '''
+    def extract(core, candidates):
+        return np.array([srca(w[:, list(core)+[c], :], w_target, signal_data[:, list(core)+[c], :],
+                              data_target, regression, alpha, l1_ratio) for c in candidates])
+    return extract
+
+def stepwise_search(cache, signal_data, data_target, objective, mpara, extract=None):
+    '''
+    Stepwise recursive channel search based on cached covariance.
+        See SRCA_train for the details of Forward and Backward process.
+
+    Parameters
+    ----------
+    cache : dict
+        see gram_cache.
+    signal_data : (n_trials, n_chans, n_times)
+        signal part input data array.
+    data_target : (n_trials, n_times)
+        signal part target data array.
+    objective : callable
+        objective(extract) -> parameters of SRCA filtered data (n_trials, n_times).
+    mpara : float
+        the mean of original signal's parameters.
+    extract : callable, optional
+        extract(core, candidates) -> (n_candidates, n_trials, n_times), e.g. refit_extract.
+        The default is None (solved from cache).
+
+    Returns
+    -------
+    model_index : list of int
+        indices of channels which should be used in SRCA.
+    para_change : list
+        list of parameter's alteration.
+    '''
+    start = time.perf_counter()
+    n_trials, n_chans = signal_data.shape[:2]
+    remain, para_change = [], []
+    use_cache = extract is None
+    L = np.zeros((n_trials, 0, 0))
+
+    def compare(core, L_core, candidates):
+        if use_cache:
+            ex_all = stepwise_extract(cache, L_core, core, candidates, signal_data, data_target)
+        else:
+            ex_all = extract(core, candidates)
+        return np.array([np.mean(objective(ex)) for ex in ex_all]) - mpara
+
+    j = 1
+    while True:
+        # add 1 channel respectively & keep the best one
+        candidates = [c for c in range(n_chans) if c not in remain]
+        if not candidates:
+            break
+        compare_para = compare(remain, L, candidates)
+        best = np.max(np.where(compare_para == np.max(compare_para)))
+        if use_cache:
+            L = chol_append(L, cache['gram'], remain, candidates[best])
+        remain.append(candidates[best])
+        para_change.append(compare_para[best])
+        if j > 1 and para_change[-1] < np.max(para_change):
+            print('Stepwise complete!')
+            print('Recursive running time: ' + str(time.perf_counter() - start) + 's')
+            remain = remain[:-1]
+            break
+        # delete 1 channel (except the latest one), then add a new one
+        candidates = [c for c in range(n_chans) if c not in remain]
+        if j > 1 and candidates:
+            swap_para = np.zeros((len(remain)-1))
+            swap_index = []
+            for l in range(len(remain)-1):
+                core = remain[:l] + remain[l+1:]
+                temp_para = compare(core, chol_delete(L, l) if use_cache else None, candidates)
+                temp_index = np.max(np.where(temp_para == np.max(temp_para)))
+                swap_index.append(candidates[temp_index])
+                swap_para[l] = temp_para[temp_index]
+            if np.max(swap_para) > np.max(para_change):  # has improvement
+                delete_index = np.max(np.where(swap_para == np.max(swap_para)))
+                core = remain[:delete_index] + remain[delete_index+1:]
+                if use_cache:
+                    L = chol_append(chol_delete(L, delete_index), cache['gram'], core,
+                                    swap_index[delete_index])
+                remain = core + [swap_index[delete_index]]
+                para_change.append(swap_para[delete_index])
+            else:
+                print("Already best in " + str(j) + " channels' condition!")
+        print('Complete ' + str(j) + 'th loop')
+        j += 1
+    return remain, para_change
+
 def SRCA_train(chans, mpara, w, w_target, signal_data, data_target, method='SNR',
                 regression='OLS', alpha=1.0, l1_ratio=1.0, freq=None, phase=None, sfreq=1000):
     '''
@@ -362,6 +804,9 @@ def SRCA_train(chans, mpara, w, w_target, signal_data, data_target, method='SNR'
             keep the best choice;
         (4) repeat (3) until there will be no better choice
             i.e. the convergence point of the recursive algorithm
+    For OLS and Ridge, each candidate model is solved from the cached rest-state covariance
+        (see gram_cache & stepwise_search) instead of refitting the regression;
+        Lasso and ElasticNet refit every candidate (see refit_extract).
 
     Parameters
     ----------
@@ -399,260 +844,22 @@ def SRCA_train(chans, mpara, w, w_target, signal_data, data_target, method='SNR'
     para_change : list
         list of parameter's alteration
     '''
-    # initialize variables
     print('Stepwise SRCA training...')
-    start = time.perf_counter()   
-    j = 1
-    compare_para = np.zeros((len(chans)))
-    max_loop = len(chans)   
-    remain_chans = []
-    para_change = []
-    temp_para = []
-    core_data = []
-    core_w = []
-    # begin loop
-    active = True
-    while active and len(chans) <= max_loop:
-        # initialization
-        compare_para = np.zeros((len(chans)))
-        mtemp_para = np.zeros((len(chans)))
-        # add 1 channel respectively & compare the parameter
-        for i in range(len(chans)):
-            # avoid reshape error in multi-dimension array
-            if j == 1:
-                temp_w = w[:,i,:]
-                temp_data = signal_data[:,i,:]
-            else:
-                temp_w = np.zeros((j, w.shape[0], w.shape[2]))
-                temp_w[:j-1, :, :] = core_w
-                temp_w[j-1, :, :] = w[:,i,:]                
-                temp_data = np.zeros((j, signal_data.shape[0], signal_data.shape[2]))
-                temp_data[:j-1, :, :] = core_data
-                temp_data[j-1, :, :] = signal_data[:,i,:]
-            # multi-linear regression & parameter computation
-            temp_extract = srca(temp_w, w_target, temp_data, data_target, regression)
-            del temp_w, temp_data 
-            if method == 'SNR':
-                temp_para = snr_time(temp_extract)
-            elif method == 'Corr':
-                temp_para = pearson_corr(temp_extract)
-            elif method == 'CCA':
-                temp_para = template_corr(temp_extract, freq=freq, phase=phase, sfreq=sfreq)
-            # compare the parameter with original one
-            mtemp_para[i] = np.mean(temp_para)
-            compare_para[i] = mtemp_para[i] - mpara
-        # keep the channels which can improve parameters most
-        chan_index = np.max(np.where(compare_para == np.max(compare_para)))
-        remain_chans.append(chans.pop(chan_index))
-        para_change.append(np.max(compare_para))
-        del temp_extract, compare_para, mtemp_para, temp_para      
-        # avoid reshape error at the beginning of Forward EE while refreshing data
-        if j == 1: 
-            core_w = w[:, chan_index, :]
-            core_data = signal_data[:, chan_index, :]
-            # refresh data
-            signal_data = np.delete(signal_data, chan_index, axis=1)
-            w = np.delete(w ,chan_index, axis=1)
-            # significant loop mark
-            print('Complete ' + str(j) + 'th loop')        
-        # begin stepwise part (delete & add) 
-        if j == 2:  
-            # save new data
-            temp_core_w = np.zeros((j, w.shape[0], w.shape[2]))
-            temp_core_w[0, :, :] = core_w
-            temp_core_w[1, :, :] = w[:, chan_index, :]
-            core_w = copy.deepcopy(temp_core_w)
-            del temp_core_w
-            temp_core_data = np.zeros((j, signal_data.shape[0], signal_data.shape[2]))
-            temp_core_data[0, :, :] = core_data
-            temp_core_data[1, :, :] = signal_data[:, chan_index, :]
-            core_data = copy.deepcopy(temp_core_data)
-            del temp_core_data
-            # add judge condition to stop program while achieving the target
-            if para_change[-1] < np.max(para_change):
-                print('Stepwise complete!')
-                end = time.perf_counter()
-                print('Recursive running time: ' + str(end - start) + 's')
-                # if this judgement is not passed, then there's no need to continue
-                active = False
-            # delete 1st channel, then add a new one
-            else:
-                # refresh data
-                signal_data = np.delete(signal_data, chan_index, axis=1)
-                w = np.delete(w, chan_index, axis=1)
-                # initialization
-                temp_1_chans = copy.deepcopy(remain_chans)
-                temp_1_data = copy.deepcopy(core_data)
-                temp_1_w = copy.deepcopy(core_w)
-                # delete 1st channel
-                del temp_1_chans[0]
-                temp_1_data = np.delete(temp_1_data, 0, axis=0)
-                temp_1_w = np.delete(temp_1_w, 0, axis=0)
-                # add one channel
-                temp_2_compare_para = np.zeros((signal_data.shape[1]))
-                for k in range(signal_data.shape[1]):
-                    temp_2_w = np.zeros((2, w.shape[0], w.shape[2]))
-                    temp_2_w[0, :, :] = temp_1_w
-                    temp_2_w[1, :, :] = w[:, k, :]
-                    temp_2_data = np.zeros((2, signal_data.shape[0], signal_data.shape[2]))
-                    temp_2_data[0, :, :] = temp_1_data
-                    temp_2_data[1, :, :] = signal_data[:, k, :]
-                    # mlr & compute parameters
-                    temp_2_extract = mlr(model_input=temp_2_w, model_target=w_target,
-                                         data_input=temp_2_data, data_target=data_target,
-                                         regression=regression)
-                    if method == 'SNR':
-                        temp_2_para = snr_time(temp_2_extract)
-                    elif method == 'Corr':
-                        temp_2_para = pearson_corr(temp_2_extract)
-                    elif method == 'CCA':
-                        temp_2_para = template_corr(temp_2_extract, freq=freq, phase=phase, sfreq=sfreq)
-                    mtemp_2_para = np.mean(temp_2_para)
-                    temp_2_compare_para[k] = mtemp_2_para - mpara
-                # keep the best choice
-                temp_2_chan_index = np.max(np.where(temp_2_compare_para == np.max(temp_2_compare_para)))
-                # judge if there's any improvement
-                if temp_2_compare_para[temp_2_chan_index] > para_change[-1]:  # has improvement
-                    # refresh data
-                    chan_index = temp_2_chan_index
-                    remain_chans.append(chans.pop(chan_index))
-                    para_change.append(temp_2_compare_para[temp_2_chan_index])
-                    # delete useless data & add new data
-                    core_w = np.delete(core_w, 0, axis=0)
-                    temp_2_core_w = np.zeros((2, w.shape[0], w.shape[2]))
-                    temp_2_core_w[0, :, :] = core_w
-                    temp_2_core_w[1, :, :] = w[:, chan_index, :]
-                    core_w = copy.deepcopy(temp_2_core_w)
-                    del temp_2_core_w
-                    core_data = np.delete(core_data, 0, axis=0)
-                    temp_2_core_data = np.zeros((2, signal_data.shape[0], signal_data.shape[2]))
-                    temp_2_core_data[0, :, :] = core_data
-                    temp_2_core_data[1, :, :] = signal_data[:, chan_index, :]
-                    core_data = copy.deepcopy(temp_2_core_data)
-                    del temp_2_core_data
-                    signal_data = np.delete(signal_data, chan_index, axis=1)
-                    w = np.delete(w, chan_index, axis=1)
-                    # release RAM
-                    del remain_chans[0]
-                    del temp_2_chan_index, temp_2_extract, temp_2_para
-                    del mtemp_2_para, temp_2_compare_para, temp_2_w, temp_2_data
-                    del temp_1_chans, temp_1_data, temp_1_w
-                    # significant loop mark
-                    print('Complete ' + str(j) + 'th loop')               
-                else:  # no improvement
-                    # release RAM
-                    del temp_1_chans, temp_1_data, temp_1_w
-                    # reset
-                    print("Already best in 2 channels' contidion!")
-        # now we have at least 3 elements in remain_chans,
-        # delete one channel, then add a new one
-        if j > 2:
-            # save data
-            temp_core_w = np.zeros((j, w.shape[0], w.shape[2]))
-            temp_core_w[:j-1, :, :] = core_w
-            temp_core_w[j-1, :, :] = w[:, chan_index, :]
-            core_w = copy.deepcopy(temp_core_w)
-            del temp_core_w
-            temp_core_data = np.zeros((j, signal_data.shape[0], signal_data.shape[2]))
-            temp_core_data[:j-1, :, :] = core_data
-            temp_core_data[j-1, :, :] = signal_data[:, chan_index, :]
-            core_data = copy.deepcopy(temp_core_data)
-            del temp_core_data
-            # add judge condition to stop program while achieving the target
-            if para_change[-1] < np.max(para_change):
-                print('Stepwise complete!')
-                end = time.perf_counter()
-                print('Recursive running time: ' + str(end - start) + 's')
-                # if this judge is not passed, then there's no need to continue
-                active = False
-            # now the last para_change is still the largest in the total sequence
-            else:
-                # refresh data
-                signal_data = np.delete(signal_data, chan_index, axis=1)
-                w = np.delete(w, chan_index, axis=1)
-                # initialization (make copies)
-                temp_3_chans = copy.deepcopy(remain_chans)
-                temp_3_compare_para = np.zeros((len(temp_3_chans)-1))
-                temp_3_chan_index = []
-                # delete one channel except the latest one
-                for l in range(len(temp_3_chans)-1):
-                    # initialization (make copies)
-                    temp_4_chans = copy.deepcopy(remain_chans)
-                    temp_4_data = copy.deepcopy(core_data)
-                    temp_4_w = copy.deepcopy(core_w)
-                    # delete one channel
-                    del temp_4_chans[l]
-                    temp_4_data = np.delete(temp_4_data, l, axis=0)
-                    temp_4_w = np.delete(temp_4_w, l, axis=0)
-                    # add one channel
-                    temp_4_compare_para = np.zeros((signal_data.shape[1]))
-                    for m in range(signal_data.shape[1]):
-                        temp_5_w = np.zeros((j, w.shape[0], w.shape[2]))
-                        temp_5_w[:j-1, :, :] = temp_4_w
-                        temp_5_w[j-1, :, :] = w[:, m, :]               
-                        temp_5_data = np.zeros((j, signal_data.shape[0], signal_data.shape[2]))
-                        temp_5_data[:j-1, :, :] = temp_4_data
-                        temp_5_data[j-1, :, :] = signal_data[:, m, :]
-                        # mlr & compute para
-                        temp_5_extract = mlr(model_input=temp_5_w, model_target=w_target,
-                                             data_input=temp_5_data, data_target=data_target,
-                                             regression=regression)
-                        if method == 'SNR':
-                            temp_5_para = snr_time(temp_5_extract)
-                        elif method == 'Corr':
-                            temp_5_para = pearson_corr(temp_5_extract)
-                        elif method == 'CCA':
-                            temp_5_para = template_corr(temp_5_extract, freq=freq, phase=phase, sfreq=sfreq)
-                        mtemp_5_para = np.mean(temp_5_para)
-                        temp_4_compare_para[m] = mtemp_5_para - mpara
-                    # keep the best choice
-                    temp_4_chan_index = np.max(np.where(temp_4_compare_para == np.max(temp_4_compare_para)))
-                    temp_3_chan_index.append(str(temp_4_chan_index))
-                    temp_3_compare_para[l] = temp_4_compare_para[temp_4_chan_index]
-                # judge if there's improvement
-                if np.max(temp_3_compare_para) > np.max(para_change):  # has improvement
-                    # find index
-                    delete_chan_index = np.max(np.where(temp_3_compare_para == np.max(temp_3_compare_para)))
-                    add_chan_index = int(temp_3_chan_index[delete_chan_index])
-                    # operate (refresh data)
-                    del remain_chans[delete_chan_index]
-                    remain_chans.append(chans[add_chan_index])
-                    chan_index = add_chan_index
-                    para_change.append(temp_3_compare_para[delete_chan_index])
-                    # delete useless data & add new data
-                    core_w = np.delete(core_w, delete_chan_index, axis=0)                   
-                    temp_6_core_w = np.zeros((core_w.shape[0]+1, core_w.shape[1], core_w.shape[2]))
-                    temp_6_core_w[:core_w.shape[0], :, :] = core_w
-                    temp_6_core_w[core_w.shape[0], :, :] = w[:, add_chan_index, :]
-                    core_w = copy.deepcopy(temp_6_core_w)
-                    del temp_6_core_w               
-                    core_data = np.delete(core_data, delete_chan_index, axis=0)              
-                    temp_6_core_data = np.zeros((core_data.shape[0]+1, core_data.shape[1], core_data.shape[2]))
-                    temp_6_core_data[:core_data.shape[0], :, :] = core_data
-                    temp_6_core_data[core_data.shape[0], :, :] = signal_data[:, add_chan_index, :]
-                    core_data = copy.deepcopy(temp_6_core_data)
-                    del temp_6_core_data                
-                    signal_data = np.delete(signal_data, add_chan_index, axis=1)
-                    w = np.delete(w, add_chan_index, axis=1)
-                    del chans[add_chan_index]
-                    # release RAM
-                    del temp_3_chans, temp_3_compare_para, temp_3_chan_index
-                    del temp_4_chans, temp_4_data, temp_4_w, temp_4_compare_para, temp_4_chan_index
-                    del temp_5_data, temp_5_w, temp_5_extract, mtemp_5_para, temp_5_para
-                    # significant loop mark
-                    print('Complete ' + str(j) + 'th loop')
-                # no improvement
-                else:
-                    # release RAM
-                    del temp_3_chans, temp_3_compare_para, temp_3_chan_index
-                    del temp_4_chans, temp_4_data, temp_4_w, temp_4_compare_para, temp_4_chan_index
-                    del temp_5_data, temp_5_w, temp_5_extract, mtemp_5_para, temp_5_para
-                    # reset
-                    print('Complete ' + str(j) + 'th loop')
-                    print("Already best in " + str(j) + " channels' condition!")    
-        j += 1    
-    remain_chans = remain_chans[:len(remain_chans)-1]
-    return remain_chans, para_change
+    if method == 'SNR':
+        objective = snr_time
+    elif method == 'Corr':
+        objective = pearson_corr
+    elif method == 'CCA':
+        objective = lambda x: template_corr(x, freq=freq, phase=phase, sfreq=sfreq)
+    if regression in ['OLS', 'Ridge']:
+        cache = gram_cache(w, w_target, regression, alpha)
+        model_index, para_change = stepwise_search(cache, signal_data, data_target, objective, mpara)
+    else:
+        extract = refit_extract(w, w_target, signal_data, data_target, regression, alpha, l1_ratio)
+        model_index, para_change = stepwise_search(None, signal_data, data_target, objective, mpara,
+                                                   extract=extract)
+    model_chans = [chans[i] for i in model_index]
+    return model_chans, para_change
 
 def stepwise_SRCA_fs(chans, mfs, w, w_target, signal_data, data_target, regression):
     '''
@@ -663,188 +870,289 @@ def stepwise_SRCA_fs(chans, mfs, w, w_target, signal_data, data_target, regressi
         w_target: background part target data array (n_events, n_trials, n_times)
         signal_data: signal part input data array (n_events, n_trials, n_chans, n_times)
         data_target: signal part target data array (n_events, n_trials, n_times)
+        regression: OLS, Ridge, Lasso or ElasticNet
     Returns:
         model_chans: list of channels which should be used in MCEE
         para_change: list of fisher score's alteration
     '''
     print('Running Stepwise SRCA...')
-    start = time.perf_counter()   
-    j = 1   
-    max_loop = len(chans)   
-    remain_chans = []
-    snr_change = []
-    core_data = []
-    core_w = []
-    active = True
-    n_trials = w.shape[1]
-    n_times_w = w.shape[-1]
-    n_times_s = signal_data.shape[-1]
-    while active and len(chans) <= max_loop:
-        compare_snr = np.zeros((len(chans)))
-        mtemp_snr = np.zeros((len(chans)))
-        for i in range(len(chans)):
-            temp_extract = np.zeros_like(data_target)
-            if j == 1:
-                temp_w = w[:, :, i,:]
-                temp_data = signal_data[:, :, i, :]
-                for kk in range(2):
-                    temp_extract[kk, :, :] = mlr(temp_w[kk, :, :], w_target[kk, :, :],
-                    temp_data[kk, :, :], data_target[kk, :, :], regression)
-            else:
-                temp_w = np.zeros((j, 2, n_trials, n_times_w))
-                temp_w[:-1, :, :, :] = core_w
-                temp_w[-1, :, :, :] = w[:, :, i, :]                
-                temp_data = np.zeros((j, 2, n_trials, n_times_s))
-                temp_data[:-1, :, :, :] = core_data
-                temp_data[-1, :, :, :] = signal_data[:, :, i, :]
-                for kk in range(2):
-                    temp_extract[kk, :, :] = mlr(temp_w[:, kk, :, :], w_target[kk, :, :],
-                    temp_data[:, kk, :, :], data_target[kk, :, :], regression)
-            mtemp_snr[i] = np.mean(fisher_score(temp_extract))
-            compare_snr[i] = mtemp_snr[i] - mfs
-        chan_index = np.max(np.where(compare_snr == np.max(compare_snr)))
-        remain_chans.append(chans.pop(chan_index))
-        snr_change.append(np.max(compare_snr))    
-        if j == 1: 
-            core_w = w[:, :, chan_index, :]
-            core_data = signal_data[:, :, chan_index, :]
-            signal_data = np.delete(signal_data, chan_index, axis=2)
-            w = np.delete(w ,chan_index, axis=2)
-            print('Complete ' + str(j) + 'th loop')         
-        if j == 2:  
-            temp_core_w = np.zeros((j, 2, n_trials, n_times_w))
-            temp_core_w[0, :, :, :] = core_w
-            temp_core_w[1, :, :, :] = w[:, :, chan_index, :]
-            core_w = copy.deepcopy(temp_core_w)
-            temp_core_data = np.zeros((j, 2, n_trials, n_times_s))
-            temp_core_data[0, :, :, :] = core_data
-            temp_core_data[1, :, :, :] = signal_data[:, :, chan_index, :]
-            core_data = copy.deepcopy(temp_core_data)
-            if snr_change[-1] < np.max(snr_change):
-                print('Stepwise EE complete!')
-                end = time.perf_counter()
-                print('Recursive running time: ' + str(end - start) + 's')
-                active = False
-            else:
-                signal_data = np.delete(signal_data, chan_index, axis=2)
-                w = np.delete(w, chan_index, axis=2)
-                temp_1_chans = copy.deepcopy(remain_chans)
-                temp_1_data = copy.deepcopy(core_data)
-                temp_1_w = copy.deepcopy(core_w)
-                del temp_1_chans[0]
-                temp_1_data = np.delete(temp_1_data, 0, axis=0)
-                temp_1_w = np.delete(temp_1_w, 0, axis=0)
-                temp_2_compare_snr = np.zeros((signal_data.shape[2]))
-                for k in range(signal_data.shape[2]):
-                    temp_2_w = np.zeros((2, 2, n_trials, n_times_w))
-                    temp_2_w[0, :, :, :] = temp_1_w
-                    temp_2_w[1, :, :, :] = w[:, :, k, :]
-                    temp_2_data = np.zeros((2, 2, n_trials, n_times_s))
-                    temp_2_data[0, :, :, :] = temp_1_data
-                    temp_2_data[1, :, :, :] = signal_data[:, :, k, :]
-                    temp_2_extract = np.zeros_like(data_target)
-                    for kk in range(2):
-                        temp_2_extract[kk, :, :] = mlr(temp_2_w[:, kk, :, :],
-                            w_target[kk, :, :], temp_2_data[:, kk, :, :],
-                            data_target[kk, :, :], regression)
-                    mtemp_2_snr = np.mean(fisher_score(temp_2_extract))
-                    temp_2_compare_snr[k] = mtemp_2_snr - mfs
-                temp_2_chan_index = np.max(np.where(temp_2_compare_snr == np.max(temp_2_compare_snr)))
-                if temp_2_compare_snr[temp_2_chan_index] > snr_change[-1]:
-                    chan_index = temp_2_chan_index
-                    remain_chans.append(chans.pop(chan_index))
-                    snr_change.append(temp_2_compare_snr[temp_2_chan_index])
-                    core_w = np.delete(core_w, 0, axis=0)
-                    temp_2_core_w = np.zeros((2, 2, n_trials, n_times_w))
-                    temp_2_core_w[0, :, :, :] = core_w
-                    temp_2_core_w[1, :, :, :] = w[:, :, chan_index, :]
-                    core_w = copy.deepcopy(temp_2_core_w)
-                    core_data = np.delete(core_data, 0, axis=0)
-                    temp_2_core_data = np.zeros((2, 2, n_trials, n_times_s))
-                    temp_2_core_data[0, :, :, :] = core_data
-                    temp_2_core_data[1, :, :, :] = signal_data[:, :, chan_index, :]
-                    core_data = copy.deepcopy(temp_2_core_data)
-                    signal_data = np.delete(signal_data, chan_index, axis=2)
-                    w = np.delete(w, chan_index, axis=2)
-                    del remain_chans[0]
-                    print('Complete ' + str(j) + 'th loop')               
-                else:
-                    print("Already best in 2 channels' contidion!")
-        if j > 2:
-            temp_core_w = np.zeros((j, 2, n_trials, n_times_w))
-            temp_core_w[:-1, :, :, :] = core_w
-            temp_core_w[-1, :, :, :] = w[:, :, chan_index, :]
-            core_w = copy.deepcopy(temp_core_w)
-            temp_core_data = np.zeros((j, 2, n_trials, n_times_s))
-            temp_core_data[:-1, :, :, :] = core_data
-            temp_core_data[-1, :, :, :] = signal_data[:, :, chan_index, :]
-            core_data = copy.deepcopy(temp_core_data)
-            if snr_change[-1] < np.max(snr_change):
-                print('Stepwise EE complete!')
-                end = time.perf_counter()
-                print('Recursive running time: ' + str(end - start) + 's')
-                active = False
-            else:
-                signal_data = np.delete(signal_data, chan_index, axis=2)
-                w = np.delete(w, chan_index, axis=2)
-                temp_3_chans = copy.deepcopy(remain_chans)
-                temp_3_compare_snr = np.zeros((len(temp_3_chans)-1))
-                temp_3_chan_index = []
-                for l in range(len(temp_3_chans)-1):
-                    temp_4_chans = copy.deepcopy(remain_chans)
-                    temp_4_data = copy.deepcopy(core_data)
-                    temp_4_w = copy.deepcopy(core_w)
-                    del temp_4_chans[l]
-                    temp_4_data = np.delete(temp_4_data, l, axis=0)
-                    temp_4_w = np.delete(temp_4_w, l, axis=0)
-                    temp_4_compare_snr = np.zeros((signal_data.shape[2]))
-                    for m in range(signal_data.shape[2]):
-                        temp_5_w = np.zeros((j, 2, n_trials, n_times_w))
-                        temp_5_w[:-1, :, :, :] = temp_4_w
-                        temp_5_w[-1, :, :, :] = w[:, :, m, :]               
-                        temp_5_data = np.zeros((j, 2, n_trials, n_times_s))
-                        temp_5_data[:-1, :, :, :] = temp_4_data
-                        temp_5_data[-1, :, :, :] = signal_data[:, :, m, :]
-                        temp_5_extract = np.zeros_like(data_target)
-                        for kk in range(2):
-                            temp_5_extract[kk, :, :] = mlr(temp_5_w[:, kk, :, :],
-                                w_target[kk, :, :], temp_5_data[:, kk, :, :],
-                                data_target[kk, :, :], regression)
-                        mtemp_5_snr = np.mean(fisher_score(temp_5_extract))
-                        temp_4_compare_snr[m] = mtemp_5_snr - mfs
-                    temp_4_chan_index = np.max(np.where(temp_4_compare_snr == np.max(temp_4_compare_snr)))
-                    temp_3_chan_index.append(str(temp_4_chan_index))
-                    temp_3_compare_snr[l] = temp_4_compare_snr[temp_4_chan_index]
-                if np.max(temp_3_compare_snr) > np.max(snr_change):
-                    delete_chan_index = np.max(np.where(temp_3_compare_snr == np.max(temp_3_compare_snr)))
-                    add_chan_index = int(temp_3_chan_index[delete_chan_index])
-                    del remain_chans[delete_chan_index]
-                    remain_chans.append(chans[add_chan_index])
-                    chan_index = add_chan_index
-                    snr_change.append(temp_3_compare_snr[delete_chan_index])
-                    core_w = np.delete(core_w, delete_chan_index, axis=0)                   
-                    temp_6_core_w = np.zeros((core_w.shape[0]+1, 2, core_w.shape[2], core_w.shape[-1]))
-                    temp_6_core_w[:-1, :, :, :] = core_w
-                    temp_6_core_w[-1, :, :, :] = w[:, :, add_chan_index, :]
-                    core_w = copy.deepcopy(temp_6_core_w)
-                    core_data = np.delete(core_data, delete_chan_index, axis=0)              
-                    temp_6_core_data = np.zeros((core_data.shape[0]+1, 2, core_data.shape[2], core_data.shape[-1]))
-                    temp_6_core_data[:-1, :, :, :] = core_data
-                    temp_6_core_data[-1, :, :, :] = signal_data[:, :, add_chan_index, :]
-                    core_data = copy.deepcopy(temp_6_core_data)
-                    signal_data = np.delete(signal_data, add_chan_index, axis=2)
-                    w = np.delete(w, add_chan_index, axis=2)
-                    del chans[add_chan_index]
-                    print('Complete ' + str(j) + 'th loop')
-                else:
-                    print('Complete ' + str(j) + 'th loop')
-                    print("Already best in " + str(j) + " channels' condition!")    
-        j += 1    
-    remain_chans = remain_chans[:len(remain_chans)-1]
-    return remain_chans, snr_change
+    n_events, n_trials = w.shape[0], w.shape[1]
+    objective = lambda x: fisher_score(x.reshape((n_events, n_trials, -1)))
+    # events & trials share the same trial axis
+    w = w.reshape((n_events*n_trials,) + w.shape[2:])
+    w_target = w_target.reshape((n_events*n_trials, -1))
+    signal_data = signal_data.reshape((n_events*n_trials,) + signal_data.shape[2:])
+    data_target = data_target.reshape((n_events*n_trials, -1))
+    if regression in ['OLS', 'Ridge']:
+        cache = gram_cache(w, w_target, regression)
+        model_index, snr_change = stepwise_search(cache, signal_data, data_target, objective, mfs)
+    else:
+        extract = refit_extract(w, w_target, signal_data, data_target, regression)
+        model_index, snr_change = stepwise_search(None, signal_data, data_target, objective, mfs,
+                                                  extract=extract)
+    model_chans = [chans[i] for i in model_index]
+    return model_chans, snr_change
+
+
+# parallel SRCA training for (event, target channel, CV fold) jobs
+pool_data = {}  # memory-mapped dataset shared by the jobs of one worker process
+
+def SRCA_job(data_path, job, chans, rest, task, method='SNR', regression='OLS', alpha=1.0,
+             freq=None, phase=None, sfreq=1000):
+    '''
+    Train one SRCA model on the memory-mapped dataset
+
+    Parameters
+    ----------
+    data_path : str
+        .npy file of the dataset, (n_events, n_trials, n_chans, n_times).
+    job : tuple
+        (event index, target channel name, fold index, training trial indices).
+    chans : list
+        names of all channels.
+    rest : tuple of int
+        (start, end) points of rest state.
+    task : tuple of int
+        (start, end) points of mission state.
+    others : see SRCA_train.
+
+    Returns
+    -------
+    model_chans : list
+        list of channels which should be used in SRCA.
+    para_change : list
+        list of parameter's alteration.
+    '''
+    if data_path not in pool_data:
+        pool_data[data_path] = np.load(data_path, mmap_mode='r')
+    data = pool_data[data_path]
+    ne, tar_chan, _, train_trials = job
+    tar_index = chans.index(tar_chan)
+    model_index = [i for i in range(len(chans)) if i != tar_index]
+
+    # only the selected trials are read from disk
+    event_data = np.asarray(data[ne, train_trials, ...])
+    w = event_data[:, model_index, rest[0]:rest[1]]
+    w_target = event_data[:, tar_index, rest[0]:rest[1]]
+    signal_data = event_data[:, model_index, task[0]:task[1]]
+    data_target = event_data[:, tar_index, task[0]:task[1]]
+
+    if method == 'SNR':
+        mpara = np.mean(snr_time(data_target))
+    elif method == 'Corr':
+        mpara = np.mean(pearson_corr(data_target))
+    elif method == 'CCA':
+        mpara = np.mean(template_corr(data_target, freq=freq, phase=phase, sfreq=sfreq))
+    model_chans, para_change = SRCA_train([chans[i] for i in model_index], mpara, w, w_target,
+        signal_data, data_target, method, regression, alpha, freq=freq, phase=phase, sfreq=sfreq)
+    return model_chans, para_change
+
+def pool_key(data, **params):
+    '''
+    Key of one SRCA_train_pool run: hash of the dataset's content & all training parameters,
+        so a cache folder is never reused for different data, folds or settings.
+
+    Parameters
+    ----------
+    data : ndarray
+        total dataset.
+    params : dict
+        chans, tar_chans, folds and every parameter of the training.
+
+    Returns
+    -------
+    key : str
+    '''
+    sha = hashlib.sha1()
+    data = np.ascontiguousarray(data)
+    sha.update(str((data.shape, data.dtype.str)).encode('utf-8'))
+    flat = data.reshape(-1).view(np.uint8)
+    step = 1 << 24
+    for i in range(0, flat.size, step):  # chunks: no extra copy of a large dataset
+        sha.update(flat[i:i+step])
+    params = {k: np.asarray(v).tolist() if isinstance(v, np.ndarray) else v for k, v in params.items()}
+    params['folds'] = [np.asarray(f).tolist() for f in params.get('folds', [])]
+    sha.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+    return sha.hexdigest()[:20]
+
+def SRCA_train_pool(data, chans, tar_chans, folds, rest=(0, 1000), task=(1140, None), method='SNR',
+                    regression='OLS', alpha=1.0, freq=None, phase=None, sfreq=1000, n_jobs=1,
+                    cache_dir=None):
+    '''
+    Train SRCA models for every (event, target channel, CV fold) with a process pool.
+        The dataset is written once to a .npy file and memory-mapped by the workers
+        instead of being pickled for every job.
+        If cache_dir is given, each finished model is saved there and reloaded on the next call,
+        so an interrupted training could be resumed. Results are kept in a sub-folder named by
+        pool_key (data, channels, folds & parameters), i.e. only an identical run is resumed.
+
+    Parameters
+    ----------
+    data : (n_events, n_trials, n_chans, n_times)
+        total dataset.
+    chans : list
+        names of all channels.
+    tar_chans : list
+        names of target channels.
+    folds : list of array
+        training trial indices of each CV fold.
+    rest : tuple of int, optional
+        (start, end) points of rest state. The default is (0, 1000).
+    task : tuple of int, optional
+        (start, end) points of mission state. The default is (1140, None).
+    method : str, optional
+        SNR, Corr or CCA. The default is 'SNR'.
+    regression : str, optional
+        OLS or Ridge. The default is 'OLS'.
+    alpha : float, optional
+        parameters used in Ridge regression. The default is 1.0.
+    freq : list of int/float, optional
+        frequency of each event, used if method = 'CCA'. The default is None.
+    phase : list of int/float, optional
+        phase of each event, used if method = 'CCA'. The default is None.
+    sfreq : int/float, optional
+        sampling frequency. The default is 1000.
+    n_jobs : int, optional
+        number of processes. The default is 1.
+    cache_dir : str, optional
+        folder to store the dataset & finished models. The default is None (temporary folder).
+
+    Returns
+    -------
+    model_chans : list, (n_folds, len(tar_chans)*n_events)
+        SRCA channels of each fold, ordered as model_chans[fold][ntc*n_events + ne]
+        (the same as the input of SRCA_TRCA).
+    para_change : list, (n_folds, len(tar_chans)*n_events)
+        parameter's alteration of each model, in the same order.
+    '''
+    n_events = data.shape[0]
+    temp_dir = None
+    if cache_dir is None:
+        temp_dir = tempfile.TemporaryDirectory()
+        cache_dir = temp_dir.name
+    else:
+        params = {'chans': list(chans), 'tar_chans': list(tar_chans), 'folds': folds,
+                  'rest': rest, 'task': task, 'method': method, 'regression': regression,
+                  'alpha': alpha, 'freq': freq, 'phase': phase, 'sfreq': sfreq}
+        cache_dir = os.path.join(cache_dir, pool_key(data, **params))
+    os.makedirs(cache_dir, exist_ok=True)
+    data_path = os.path.join(cache_dir, 'data.npy')
+    if not os.path.exists(data_path):
+        np.save(data_path, np.ascontiguousarray(data))
+
+    # job list: deterministic order & file name of each result
+    jobs = []
+    for nf in range(len(folds)):
+        for ntc in range(len(tar_chans)):
+            for ne in range(n_events):
+                jobs.append((ne, tar_chans[ntc], nf, np.asarray(folds[nf])))
+    result_paths = [os.path.join(cache_dir, 'srca_e%d_c%d_f%d.npz' %(job[0],
+                    tar_chans.index(job[1]), job[2])) for job in jobs]
+
+    def job_kwargs(job):
+        return {'chans': chans, 'rest': rest, 'task': task, 'method': method,
+                'regression': regression, 'alpha': alpha, 'sfreq': sfreq,
+                'freq': freq[job[0]] if freq is not None else None,
+                'phase': phase[job[0]] if phase is not None else None}
+
+    results = [None for job in jobs]
+    todo = []
+    for nj in range(len(jobs)):  # resume from finished models
+        if os.path.exists(result_paths[nj]):
+            saved = np.load(result_paths[nj])
+            results[nj] = (saved['model_chans'].tolist(), saved['para_change'].tolist())
+        else:
+            todo.append(nj)
+
+    def save(nj, result):
+        results[nj] = result
+        np.savez(result_paths[nj], model_chans=np.array(result[0], dtype=str),
+                 para_change=np.array(result[1]))
+
+    try:
+        if n_jobs == 1:
+            for nj in todo:
+                save(nj, SRCA_job(data_path, jobs[nj], **job_kwargs(jobs[nj])))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = {executor.submit(SRCA_job, data_path, jobs[nj], **job_kwargs(jobs[nj])): nj
+                           for nj in todo}
+                for future in as_completed(futures):
+                    save(futures[future], future.result())
+    finally:
+        pool_data.pop(data_path, None)
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    n_models = len(tar_chans)*n_events
+    model_chans = [[results[nf*n_models + nm][0] for nm in range(n_models)]
+                   for nf in range(len(folds))]
+    para_change = [[results[nf*n_models + nm][1] for nm in range(n_models)]
+                   for nf in range(len(folds))]
+    return model_chans, para_change
 
 
 # %% Canonical Correlation Analysis
+@lru_cache(maxsize=256)
+def sin_bank(base_freq, n_bands, n_points, phase=0, sfreq=1000, start=0):
+    """
+    Sine/cosine reference bank: each reference is generated only once per session
+        and then served from an LRU cache keyed by all the arguments.
+
+    Parameters
+    ----------
+    base_freq : int/float
+        frequency / Hz
+    n_bands : int
+        number of harmonics.
+    n_points : int
+        number of sampling points.
+    phase : float, optional
+        0-2, initial phase (*pi) shared by all harmonics. The default is 0.
+    sfreq : float/int, optional
+        sampling frequency. The default is 1000.
+    start : int, optional
+        index of the first sampling point. The default is 0.
+
+    Returns
+    -------
+    model : ndarray, (2*n_bands, n_points)
+        read-only sine/cosine wave model: [sin(f), cos(f), sin(2f), cos(2f), ...].
+    """
+    time_point = (start + np.arange(n_points))/sfreq
+    harmonic = 2*pi*base_freq*np.arange(1, n_bands+1)[:, NA]*time_point[NA, :]
+    model = np.zeros((int(2*n_bands), n_points))
+    model[0::2, :] = sin(harmonic + pi*phase)
+    model[1::2, :] = cos(harmonic + pi*phase)
+    model.flags.writeable = False
+    return model
+
+@lru_cache(maxsize=256)
+def sin_qr(base_freq, n_bands, n_points, phase=0, sfreq=1000, start=0, center=False):
+    """
+    Cached thin QR factor of a sine/cosine reference (see sin_bank)
+
+    Parameters
+    ----------
+    base_freq, n_bands, n_points, phase, sfreq, start : see sin_bank
+    center : bool, optional
+        remove the mean of each reference before factorization. The default is False.
+
+    Returns
+    -------
+    Q : ndarray, (n_points, 2*n_bands)
+        read-only orthonormal basis of the reference.
+    R : ndarray, (2*n_bands, 2*n_bands)
+        read-only upper triangular factor, model.T = Q @ R.
+    """
+    model = sin_bank(base_freq, n_bands, n_points, phase, sfreq, start)
+    if center:
+        model = model - model.mean(axis=1, keepdims=True)
+    Q, R = LA.qr(model.T)
+    Q.flags.writeable = False
+    R.flags.writeable = False
+    return Q, R
+
 def sin_model(base_freq, n_bands, time, phase=0, sfreq=1000):
     """
 
@@ -863,18 +1171,58 @@ def sin_model(base_freq, n_bands, time, phase=0, sfreq=1000):
     Returns
     -------
     model : ndarray, (2*n_bands, time*sfreq)
-        sine/cosine wave model.
+        sine/cosine wave model (read-only, shared by sin_bank).
     """
-    n_point = int(time*sfreq)
-    model = np.zeros((int(2*n_bands), n_point))
-    time_point = np.linspace(0, (n_point-1)/sfreq, n_point)
-    
-    for i in range(n_bands):
-        model[i*2, :] = sin(2*pi*(i+1)*base_freq*time_point + pi*phase)
-        model[i*2+1, :] = cos(2*pi*(i+1)*base_freq*time_point + pi*phase)
-    
+    model = sin_bank(base_freq, n_bands, int(time*sfreq), phase, sfreq)
     return model
 
+def cca_svd(Qx, Rx, Qy, Ry):
+    """
+    Leading canonical pair from thin QR factors of both sides
+
+    Parameters
+    ----------
+    Qx : ndarray, (..., n_points, n_chans)
+    Rx : ndarray, (..., n_chans, n_chans)
+        X.T = Qx @ Rx.
+    Qy : ndarray, (..., n_points, n_y)
+    Ry : ndarray, (..., n_y, n_y)
+        Y.T = Qy @ Ry.
+
+    Returns
+    -------
+    w_X : ndarray, (..., n_chans)
+    w_Y : ndarray, (..., n_y)
+        spatial filters for X and Y.
+    rou : ndarray, (...)
+        the largest canonical correlation coefficient.
+    """
+    U, sigma, VT = LA.svd(np.swapaxes(Qx, -1, -2) @ Qy)
+    w_X = LA.solve(Rx, U[..., :, :1])[..., 0]
+    w_Y = LA.solve(Ry, np.swapaxes(VT[..., :1, :], -1, -2))[..., 0]
+    return w_X, w_Y, sigma[..., 0]
+
+def CCA_qr(X, Y):
+    """
+    Canonical correlation analysis via thin QR decomposition of both sides
+        and SVD of Qx.T @ Qy, batched over any leading dimensions.
+
+    Parameters
+    ----------
+    X : ndarray, (..., n_chans, n_points)
+    Y : ndarray, (..., n_y, n_points)
+
+    Returns
+    -------
+    w_X : ndarray, (..., n_chans)
+    w_Y : ndarray, (..., n_y)
+    rou : ndarray, (...)
+        canonical correlation coefficient of w_X @ X and w_Y @ Y.
+    """
+    Qx, Rx = LA.qr(np.swapaxes(X, -1, -2))
+    Qy, Ry = LA.qr(np.swapaxes(Y, -1, -2))
+    return cca_svd(Qx, Rx, Qy, Ry)
+
 def CCA_compute(data, model, mode='data'):
     """
 
@@ -891,23 +1239,62 @@ def CCA_compute(data, model, mode='data'):
         spatial filters for eeg data (or model)
 
     """
+    w_X, w_Y, _ = CCA_qr(data, model)
     if mode == 'data':
-        Z = data.T
-        projection = model.T @ LA.inv(model @ model.T) @ model
+        return w_X
     elif mode == 'model':
-        Z = model.T
-        projection = data.T @ LA.inv(data @ data.T) @ data
+        return w_Y
 
-    # unified framework: type I
-    matrix_A = Z.T @ projection @ projection.T @ Z
-    matrix_B = Z.T @ Z
+def cca_score(Qx, Qy):
+    """
+    Largest canonical correlation of every (test, reference) pair
+        from precomputed orthonormal bases
 
-    # solve generalized eigenvalue problem
-    e_va, e_vec = LA.eig(LA.inv(matrix_A) @ matrix_B)
-    w_index = np.argmax(e_va)
-    w = e_vec[:, w_index].T
+    Parameters
+    ----------
+    Qx : ndarray, (..., n_points, n_chans)
+        orthonormal bases of test trials (thin QR of X.T).
+    Qy : ndarray, (n_refs, n_points, n_y)
+        orthonormal bases of references.
 
-    return w
+    Returns
+    -------
+    r : ndarray, (..., n_refs)
+    """
+    M = np.swapaxes(Qx, -1, -2)[..., NA, :, :] @ Qy  # (..., n_refs, n_chans, n_y)
+    r = LA.svd(M, compute_uv=False)[..., 0]
+    return r
+
+def sCCA_classify(data, base_freq, n_bands, phase=0, sfreq=1000):
+    """
+    Standard CCA for all trials and candidate frequencies at once
+
+    Parameters
+    ----------
+    data : ndarray, (n_events, n_trials, n_chans, n_points)
+        test dataset
+    base_freq : list of float/int
+        candidate stimulus frequencies.
+    n_bands : int
+        number of harmonics.
+    phase : float, optional
+        0-2, initial phase (*pi) of references. The default is 0.
+    sfreq : float/int, optional
+        sampling frequency. The default is 1000.
+
+    Returns
+    -------
+    r : ndarray, (n_events, n_trials, n_freqs)
+        canonical correlation coefficients.
+    predict : ndarray, (n_events, n_trials)
+        index of the chosen frequency.
+    """
+    n_points = data.shape[-1]
+    Qx = LA.qr(np.swapaxes(data, -1, -2))[0]
+    Qy = np.stack([sin_qr(freq, n_bands, n_points, phase, sfreq)[0] for freq in base_freq])
+    r = cca_score(Qx, Qy)
+    predict = np.argmax(r, axis=-1)
+    return r, predict
 
 def sCCA(data, base_freq, n_bands, sfreq=1000):
     """
@@ -924,33 +1311,8 @@ def sCCA(data, base_freq, n_bands, sfreq=1000):
     accuracy : float, 0-1
     """
     n_events = data.shape[0]
-    n_tests = data.shape[1]
-    n_points = data.shape[-1]
-    signal_time = n_points/sfreq
-    r = np.zeros((n_events, n_tests, n_events))
-    for nete in range(n_events):
-        for nte in range(n_tests):
-            # preparation
-            test = data[nete, nte, ...]
-            for netr in range(n_events):
-                model = sin_model(base_freq[netr], n_bands, signal_time)
-                # compute spatial filters 
-                w_X = CCA_compute(test, model, mode='data')
-                w_Y = CCA_compute(test, model, mode='model')
-
-                # dimensionality reduction
-                trans_X, trans_Y = w_X @ test, w_Y @ model
-
-                # compute correlation
-                r[nete, nte, netr] = corr_coef(trans_X, trans_Y)
-    
-    # compute accuracy
-    accuracy = 0
-    for nete in range(n_events):
-        for nte in range(n_tests):
-            if np.argmax(r[nete, nte, :]) == nete:
-                accuracy += 1
-    accuracy /= (n_events*n_tests)
+    _, predict = sCCA_classify(data, base_freq, n_bands, sfreq=sfreq)
+    accuracy = np.mean(predict == np.arange(n_events)[:, NA])
 
     return accuracy
 
@@ -969,39 +1331,69 @@ def itCCA(train_data, test_data):
     accuracy : float, 0-1
     """
     n_events = train_data.shape[0]
-    n_tests = test_data.shape[1]
     template = train_data.mean(axis=1)  # (n_events, n_chans, n_points)
-    r = np.zeros((n_events, n_tests, n_events))
 
-    for nete in range(n_events):
-        for nte in range(n_tests):
-            # preparation
-            test = test_data[nete, nte, ...]
-            for netr in range(n_events):
-                model = template[netr, ...]
-                # compute spatial filters
-                w_X = CCA_compute(test, model, mode='data')
-                w_Y = CCA_compute(test, model, mode='model')
-                
-                # dimensionality reduction
-                trans_X, trans_Y = w_X @ test, w_Y @ model
-
-                # compute correlation
-                r[nete, nte, netr] = corr_coef(trans_X, trans_Y)
+    # factorize each test trial and each template only once
+    Qx = LA.qr(np.swapaxes(test_data, -1, -2))[0]
+    Qy = LA.qr(np.swapaxes(template, -1, -2))[0]
+    r = cca_score(Qx, Qy)  # (n_events, n_tests, n_events)
     
     # compute accuracy
-    accuracy = 0
-    for nete in range(n_events):
-        for nte in range(n_tests):
-            if np.argmax(r[nete, nte, :]) == nete:
-                accuracy += 1
-    accuracy /= (n_events*n_tests)
+    accuracy = np.mean(np.argmax(r, axis=-1) == np.arange(n_events)[:, NA])
 
     return accuracy
 
 
 # %% Target identification: TRCA method (series)
 # pre-functions
+def trca_matrix(data):
+    '''
+    Covariance matrices of TRCA, using the sum-of-trials identity:
+        sum_{i!=j} Xi @ Xj.T = (sum Xi) @ (sum Xi).T - sum Xi @ Xi.T
+
+    Parameters
+    ----------
+    data : (..., n_trials, n_chans, n_times)
+        input data array, e.g. (n_events, n_trials, n_chans, n_times).
+
+    Returns
+    -------
+    S : (..., n_chans, n_chans)
+        inter-channels' inter-trial covariance.
+    Q : (..., n_chans, n_chans)
+        inter-channel covariance.
+    '''
+    n_trials, n_times = data.shape[-3], data.shape[-1]
+    sum_data = data.sum(axis=-3)                                     # (..., n_chans, n_times)
+    cov_data = np.einsum('...tcp,...tdp->...cd', data, data)         # sum Xi @ Xi.T
+    S = (np.einsum('...cp,...dp->...cd', sum_data, sum_data) - cov_data) / n_times
+    Q = cov_data / (n_trials*n_times)
+    return S, Q
+
+def solve_gep(A, B):
+    '''
+    Eigenvector refering to the largest eigenvalue of A @ w = lambda * B @ w
+        (A symmetric, B symmetric positive definite)
+
+    Parameters
+    ----------
+    A : (..., n_chans, n_chans)
+    B : (..., n_chans, n_chans)
+
+    Returns
+    -------
+    w : (..., n_chans)
+        unit-norm eigenvectors.
+    '''
+    n_chans = A.shape[-1]
+    A_flat, B_flat = A.reshape((-1, n_chans, n_chans)), B.reshape((-1, n_chans, n_chans))
+    w = np.zeros((A_flat.shape[0], n_chans))
+    for i in range(A_flat.shape[0]):
+        _, e_vec = sLA.eigh(A_flat[i], B_flat[i], subset_by_index=[n_chans-1, n_chans-1])
+        w[i] = e_vec[:, 0]
+    w /= LA.norm(w, axis=-1, keepdims=True)
+    return w.reshape(A.shape[:-1])
+
 def TRCA_compute(data):
     '''
     Task-related component analysis (TRCA)
@@ -1010,6 +1402,7 @@ def TRCA_compute(data):
     ----------
     data : (n_events, n_trials, n_chans, n_times)
         input data array (default z-scored after bandpass filtering).
+        Extra leading dimensions (e.g. segments) are also supported.
 
     Returns
     -------
@@ -1017,33 +1410,8 @@ def TRCA_compute(data):
         eigenvector refering to the largest eigenvalue.
 
     '''
-    # basic information
-    n_events = data.shape[0]
-    n_trials= data.shape[1]
-    n_chans = data.shape[2]
-    n_times = data.shape[-1]
-
-    # compute spatial filter W 
-    w = np.zeros((n_events, n_chans))
-    for ne in range(n_events):
-        # matrix Q: inter-channel covariance
-        q = np.zeros((n_chans, n_chans))
-        temp_Q = data[ne, ...].swapaxes(0,1).reshape((n_chans,-1), order='C')
-        q = (temp_Q@temp_Q.T) / (n_trials*n_times)
-        # matrix S: inter-channels' inter-trial covariance
-        s = np.zeros_like(q)
-        for nt_i in range(n_trials):
-            for nt_j in range(n_trials):
-                if nt_i != nt_j:
-                    data_i = data[ne, nt_i, ...]
-                    data_j = data[ne, nt_j, ...]
-                    s += (data_i@data_j.T) / n_times
-        # generalized eigenvalue problem
-        e_va, e_vec = LA.eig(LA.inv(q)@s)
-        w_index = np.argmax(e_va)
-        #w[ne, :] = e_vec[:, e_va.argsort()[::-1]][:,0].T
-        w[ne, :] = e_vec[:, w_index].T
-        #e_value = np.array(sorted(e_va, reverse=True))
+    S, Q = trca_matrix(data)
+    w = solve_gep(S, Q)
     return w
 
 def pearson_corr2(data_A, data_B):
@@ -1068,6 +1436,73 @@ def pearson_corr2(data_A, data_B):
 
     return corr2
 
+def trca_score(w, template, test_data, ensemble=False, model_wise=False):
+    '''
+    Correlation coefficients between all test trials and all templates,
+        computed with normalized dot products after one projection of the whole batch.
+
+    Parameters
+    ----------
+    w : (..., n_events, n_chans)
+        spatial filters of each event.
+    template : (..., n_events, n_chans, n_times)
+        template data of each event.
+    test_data : (..., n_events, n_tests, n_chans, n_times)
+        test dataset.
+        If model_wise is True, (..., n_events (model), n_events, n_tests, n_chans, n_times),
+        i.e. different test data for each event's model (e.g. SRCA data).
+    ensemble : bool, optional
+        if True, use all filters (eTRCA, 2-D correlation); if False, use the filter of
+        each template's event (TRCA, corr_coef). The default is False.
+    model_wise : bool, optional
+        see test_data. The default is False.
+
+    Returns
+    -------
+    r : (..., n_events (template), n_tests, n_events (test))
+        correlation coefficients.
+    '''
+    if not ensemble:
+        if model_wise:
+            proj_test = np.einsum('...ec,...eftcp->...eftp', w, test_data)
+        else:
+            proj_test = np.einsum('...ec,...ftcp->...eftp', w, test_data)
+        proj_temp = np.einsum('...ec,...ecp->...ep', w, template)
+        r = np.einsum('...eftp,...ep->...eft', proj_test, proj_temp)
+        r /= LA.norm(proj_test, axis=-1) * LA.norm(proj_temp, axis=-1)[..., NA, NA]
+        return r.swapaxes(-1, -2)
+
+    proj_temp = np.einsum('...kc,...ecp->...ekp', w, template)
+    proj_temp = proj_temp - proj_temp.mean(axis=(-2, -1), keepdims=True)
+    if model_wise:
+        proj_test = np.einsum('...kc,...eftcp->...eftkp', w, test_data)
+    else:
+        proj_test = np.einsum('...kc,...ftcp->...ftkp', w, test_data)
+    proj_test = proj_test - proj_test.mean(axis=(-2, -1), keepdims=True)
+    var_test = np.sqrt(np.sum(proj_test**2, axis=(-2, -1)))
+    var_temp = np.sqrt(np.sum(proj_temp**2, axis=(-2, -1)))
+    if model_wise:
+        r = np.einsum('...eftkp,...ekp->...eft', proj_test, proj_temp) / var_test
+    else:
+        r = np.einsum('...ftkp,...ekp->...eft', proj_test, proj_temp) / var_test[..., NA, :, :]
+    r /= var_temp[..., NA, NA]
+    return r.swapaxes(-1, -2)
+
+def trca_accuracy(r):
+    '''
+    Parameters
+    ----------
+    r : (..., n_events (template), n_tests, n_events (test))
+        see trca_score.
+
+    Returns
+    -------
+    accuracy : float or ndarray, 0-1
+    '''
+    predict = np.argmax(r, axis=-3)  # (..., n_tests, n_events)
+    accuracy = np.mean(predict == np.arange(r.shape[-1]), axis=(-2, -1))
+    return accuracy
+
 # For origin data
 def TRCA(train_data, test_data):
     '''
@@ -1086,25 +1521,12 @@ def TRCA(train_data, test_data):
 
     '''
     # basic parameters
-    n_events, n_tests = test_data.shape[0], test_data.shape[1]
     template = train_data.mean(axis=1)  # template data: (n_events, n_chans, n_times)
     w = TRCA_compute(train_data)        # spatial filter W: (n_events, n_chans)
 
     # target identification
-    r = np.zeros((n_events, n_tests, n_events))
-    for netr in range(n_events):  # n_events in training dataset
-        for nte in range(n_tests):
-            for nete in range(n_events):  # n_events in test dataset
-                temp_test = w[netr, :] @ test_data[nete, nte, ...]
-                temp_template = w[netr, :] @ template[netr, ...]
-                r[netr, nte, nete] = corr_coef(temp_test, temp_template)
-    # compute accuracy
-    accuracy = []
-    for nete in range(n_events):  # n_events in training dataset
-        for nte in range(n_tests):
-            if np.argmax(r[:, nte, nete]) == nete:
-                accuracy.append(1)
-    accuracy = np.sum(accuracy) / (n_events*n_tests)
+    r = trca_score(w, template, test_data)  # (n_events, n_tests, n_events)
+    accuracy = trca_accuracy(r)
 
     return accuracy
 
@@ -1122,28 +1544,12 @@ def eTRCA(train_data, test_data):
         accuracy: int | the number of correct identification
     '''
     # basic parameters
-    n_events = train_data.shape[0]
-    n_tests = test_data.shape[1]
-
     template = train_data.mean(axis=1)  # template data: (n_events, n_chans, n_times)
     w = TRCA_compute(train_data)        # spatial filter W: (n_events, n_chans)
 
     # target identification
-    r = np.zeros((n_events, n_tests, n_events))
-    for netr in range(n_events):  # n_events in training dataset
-        for nte in range(n_tests):
-            for nete in range(n_events):  # n_events in test dataset
-                temp_test = w @ test_data[nete, nte, ...]
-                temp_template = w @ template[netr, ...]
-                r[netr, nte, nete] = pearson_corr2(temp_test, temp_template)
-
-    # compute accuracy
-    accuracy = []
-    for nete in range(n_events):  # n_events in training dataset
-        for nte in range(n_tests):
-            if np.argmax(r[:, nte, nete]) == nete:
-                accuracy.append(1)
-    accuracy = np.sum(accuracy) / (n_events*n_tests)
+    r = trca_score(w, template, test_data, ensemble=True)  # (n_events, n_tests, n_events)
+    accuracy = trca_accuracy(r)
 
     return accuracy
 
@@ -1167,6 +1573,27 @@ def TRCA_R():
 def eTRCA_R():
     pass
 
+def split_data(data, stepwidth):
+    """
+    Divide the time axis into non-overlapping segments without copying data
+
+    Parameters
+    ----------
+    data : ndarray, (..., n_times)
+    stepwidth : int
+        length of each segment.
+
+    Returns
+    -------
+    seg_data : ndarray, (seg_num, ..., stepwidth)
+        read-only strided view of data, seg_num = int(n_times/stepwidth).
+    """
+    seg_num = int(data.shape[-1]/stepwidth)
+    shape = (seg_num,) + data.shape[:-1] + (stepwidth,)
+    strides = (stepwidth*data.strides[-1],) + data.strides
+    seg_data = as_strided(data, shape=shape, strides=strides, writeable=False)
+    return seg_data
+
 def split_TRCA(stepwidth, train_data, test_data, mode='total'):
     """
 
@@ -1187,132 +1614,56 @@ def split_TRCA(stepwidth, train_data, test_data, mode='total'):
 
     """
     # basic parameters
-    n_events = test_data.shape[0]
-    n_tests = test_data.shape[1]
-    n_chans = test_data.shape[2]
-    n_times = test_data.shape[-1]
     template = train_data.mean(axis=1)  # (n_events, n_chans, n_times)
-    seg_num = int(n_times/stepwidth)
     
-    # split data
-    seg_test_data = np.zeros((1, n_events, n_tests, n_chans, stepwidth))
-    seg_template = np.zeros((1, n_events, n_chans, stepwidth))
-    for i in range(seg_num):
-        # seg_test_data: (seg_num, n_events, n_trials, n_chans, stepwidth)
-        seg_test_data = np.concatenate((seg_test_data,
-            test_data[NA, ..., i*stepwidth:(i+1)*stepwidth]), axis=0)
-        # seg_template: (seg_num, n_events, n_chans, stepwidth)
-        seg_template = np.concatenate((seg_template,
-            template[NA, ..., i*stepwidth:(i+1)*stepwidth]), axis=0)
-    seg_test_data = np.delete(seg_test_data, 0, axis=0)
-    seg_template = np.delete(seg_template, 0, axis=0)
+    # split data (views)
+    seg_test_data = split_data(test_data, stepwidth)  # (seg_num, n_events, n_trials, n_chans, stepwidth)
+    seg_template = split_data(template, stepwidth)    # (seg_num, n_events, n_chans, stepwidth)
 
     if mode == 'partial':  # only divide the test dataset
         # compute spatial filter w
         w = TRCA_compute(train_data)
 
-        # split target identification
-        rou = np.zeros((seg_num, n_events, n_tests, n_events))
-        for seg in range(seg_num):
-            for netr in range(n_events):  # n_events in training dataset
-                for nte in range(n_tests):
-                    for nete in range(n_events):  # n_events in test dataset
-                        temp_test = w[netr, :] @ seg_test_data[seg, nete, nte, ...]
-                        temp_template = w[netr, :] @ seg_template[seg, netr, ...]
-                        rou[seg, netr, nte, nete] = corr_coef(temp_test, temp_template)
+        # split target identification: (seg_num, n_events, n_tests, n_events)
+        rou = trca_score(w, seg_template, seg_test_data)
 
     elif mode == 'total':  # divide both the training and test dataset
-        # compute spatial filter w
-        seg_w = np.zeros((1, n_events, n_chans))
-        for i in range(seg_num):
-            temp_w = TRCA_compute(train_data[..., i*stepwidth:(i+1)*stepwidth])
-            seg_w = np.concatenate((seg_w, temp_w[NA, ...]), axis=0)
-        seg_w = np.delete(seg_w, 0, axis=0)
-
-        # split target identification
-        rou = np.zeros((seg_num, n_events, n_tests, n_events))
-        for seg in range(seg_num):
-            for netr in range(n_events):  # n_events in training dataset
-                for nte in range(n_tests):
-                    for nete in range(n_events):  # n_events in test dataset
-                        temp_test = seg_w[seg, netr, :] @ seg_test_data[seg, nete, nte, ...]
-                        temp_template = seg_w[seg, netr, :] @ seg_template[seg, netr, ...]
-                        rou[seg, netr, nte, nete] = corr_coef(temp_test, temp_template)
+        # compute spatial filter w of all segments at once: (seg_num, n_events, n_chans)
+        seg_w = TRCA_compute(split_data(train_data, stepwidth))
+
+        # split target identification: (seg_num, n_events, n_tests, n_events)
+        rou = trca_score(seg_w, seg_template, seg_test_data)
         
     # compute accuracy
-    accuracy = []
-    r = np.sum(rou, axis=0)
-    for nete in range(n_events):  # n_events in training dataset
-        for nte in range(n_tests):
-            if np.argmax(r[:, nte, nete]) == nete:
-                accuracy.append(1)
-    accuracy = np.sum(accuracy) / (n_events*n_tests)
+    accuracy = trca_accuracy(np.sum(rou, axis=0))
 
     return rou, accuracy
 
 def split_eTRCA(stepwidth, train_data, test_data, mode='total'):
 
     # basic parameters
-    n_events = test_data.shape[0]
-    n_tests = test_data.shape[1]
-    n_chans = test_data.shape[2]
-    n_times = test_data.shape[-1]
     template = train_data.mean(axis=1)  # (n_events, n_chans, n_times)
-    seg_num = int(n_times/stepwidth)
     
-    # split data
-    seg_test_data = np.zeros((1, n_events, n_tests, n_chans, stepwidth))
-    seg_template = np.zeros((1, n_events, n_chans, stepwidth))
-    for i in range(seg_num):
-        # seg_test_data: (seg_num, n_events, n_trials, n_chans, stepwidth)
-        seg_test_data = np.concatenate((seg_test_data,
-                        test_data[NA, ..., i*stepwidth:(i+1)*stepwidth]), axis=0)
-        # seg_template: (seg_num, n_events, n_chans, stepwidth)
-        seg_template = np.concatenate((seg_template,
-                        template[NA, ..., i*stepwidth:(i+1)*stepwidth]), axis=0)
-    seg_test_data = np.delete(seg_test_data, 0, axis=0)
-    seg_template = np.delete(seg_template, 0, axis=0)
+    # split data (views)
+    seg_test_data = split_data(test_data, stepwidth)  # (seg_num, n_events, n_trials, n_chans, stepwidth)
+    seg_template = split_data(template, stepwidth)    # (seg_num, n_events, n_chans, stepwidth)
 
     if mode == 'partial':  # only divide the test dataset
         # compute spatial filter w
         w = TRCA_compute(train_data)
 
-        # split target identification
-        rou = np.zeros((seg_num, n_events, n_tests, n_events))
-        for seg in range(seg_num):
-            for netr in range(n_events):  # n_events in training dataset
-                for nte in range(n_tests):
-                    for nete in range(n_events):  # n_events in test dataset
-                        temp_test = w @ seg_test_data[seg, nete, nte, ...]
-                        temp_template = w @ seg_template[seg, netr, ...]
-                        rou[seg, netr, nte, nete] = pearson_corr2(temp_test, temp_template)
+        # split target identification: (seg_num, n_events, n_tests, n_events)
+        rou = trca_score(w, seg_template, seg_test_data, ensemble=True)
 
     elif mode == 'total':  # divide both the training and test dataset
-        # compute spatial filter w
-        seg_w = np.zeros((1, n_events, n_chans))
-        for i in range(seg_num):
-            temp_w = TRCA_compute(train_data[..., i*stepwidth:(i+1)*stepwidth])
-            seg_w = np.concatenate((seg_w, temp_w[NA, ...]), axis=0)
-        seg_w = np.delete(seg_w, 0, axis=0)
-
-        # split target identification
-        rou = np.zeros((seg_num, n_events, n_tests, n_events))
-        for seg in range(seg_num):
-            for netr in range(n_events):  # n_events in training dataset
-                for nte in range(n_tests):
-                    for nete in range(n_events):  # n_events in test dataset
-                        temp_test = seg_w[seg, ...] @ seg_test_data[seg, nete, nte, ...]
-                        temp_template = seg_w[seg, ...] @ seg_template[seg, netr, ...]
-                        rou[seg, netr, nte, nete] = pearson_corr2(temp_test, temp_template)
+        # compute spatial filter w of all segments at once: (seg_num, n_events, n_chans)
+        seg_w = TRCA_compute(split_data(train_data, stepwidth))
+
+        # split target identification: (seg_num, n_events, n_tests, n_events)
+        rou = trca_score(seg_w, seg_template, seg_test_data, ensemble=True)
 
     # compute accuracy
-    accuracy = []
-    r = np.sum(rou, axis=0)
-    for nete in range(n_events):  # n_events in training dataset
-        for nte in range(n_tests):
-            if np.argmax(r[:, nte, nete]) == nete:
-                accuracy.append(1)
-    accuracy = np.sum(accuracy) / (n_events*n_tests)
+    accuracy = trca_accuracy(np.sum(rou, axis=0))
 
     return rou, accuracy
 
@@ -1383,22 +1734,9 @@ def SRCA_TRCA(train_data, test_data, tar_chans, model_chans, chans,
     template = model_sig.mean(axis=1)  # template data: (n_events, n_chans, n_times)
     w = TRCA_compute(model_sig)        # Spatial filter W: (n_events, n_chans)
 
-    # target identification
-    r = np.zeros((n_events, n_tests, n_events))  # (n_events srca, n_tests, n_events test)
-    for nes in range(n_events):                  # n_events in srca model
-        for nte in range(n_tests):               # n_tests
-            for ner in range(n_events):          # n_events in real test dataset
-                temp_test = w[nes, :] @ target_sig[nes, ner, nte,...]
-                temp_template = w[nes, :] @ template[nes, ...]
-                r[nes, nte, ner] = corr_coef(temp_test, temp_template)
-
-    # compute accuracy
-    accuracy = []
-    for ner in range(n_events):
-        for nte in range(n_tests):
-            if np.argmax(r[:, nte, ner]) == ner:
-                accuracy.append(1)
-    accuracy = np.sum(accuracy) / (n_events*n_tests)
+    # target identification: (n_events srca, n_tests, n_events test)
+    r = trca_score(w, template, target_sig, model_wise=True)
+    accuracy = trca_accuracy(r)
 
     return accuracy
 
@@ -1444,23 +1782,9 @@ def SRCA_eTRCA(train_data, test_data, tar_chans, model_chans, chans,
     template = model_sig.mean(axis=1)
     w = TRCA_compute(model_sig)
 
-    # Ensemble target identification
-    r = np.zeros((n_events, n_tests, n_events))  # (n_events srca, n_tests, n_events test)
-    for nes in range(n_events):                  # n_events in srca model
-        for nte in range(n_tests):               # n_tests
-            for ner in range(n_events):          # n_events in test dataset
-                temp_test = np.dot(w, target_sig[nes, ner, nte, ...])
-                temp_template = np.dot(w, template[nes, ...])
-                r[nes, nte, ner] = pearson_corr2(temp_test, temp_template)
-    del nes, nte, ner
-
-    # Compute accuracy
-    accuracy = []
-    for ner in range(n_events):
-        for nte in range(n_tests):
-            if np.argmax(r[:, nte, ner]) == ner:
-                accuracy.append(1)
-    accuracy = np.sum(accuracy) / (n_events*n_tests)
+    # Ensemble target identification: (n_events srca, n_tests, n_events test)
+    r = trca_score(w, template, target_sig, ensemble=True, model_wise=True)
+    accuracy = trca_accuracy(r)
 
     return accuracy
 
@@ -1479,7 +1803,6 @@ def split_SRCA_TRCA(stepwidth, train_data, test_data, tar_chans, model_chans, ch
     n_tests = test_data.shape[1]
     n_chans = len(tar_chans)
     n_times = train_data.shape[-1] - sp
-    seg_num = int(n_times/stepwidth)
 
     # config correct srca process on training dataset
     model_sig = np.zeros((n_events, n_trains, n_chans, n_times))
@@ -1500,59 +1823,27 @@ def split_SRCA_TRCA(stepwidth, train_data, test_data, tar_chans, model_chans, ch
                 temp_model, chans, regression, sp)
     del ne_tr, ne_re
 
-    # split data
-    seg_target_data = np.zeros((1, n_events, n_events, n_tests, n_chans, stepwidth))
-    seg_template = np.zeros((1, n_events, n_chans, stepwidth))
-    for i in range(seg_num):
-        # seg_target_data: (seg_num, n_events, n_events, n_trials, n_chans, stepwidth)
-        seg_target_data = np.concatenate((seg_target_data,
-            target_sig[NA, ..., i*stepwidth:(i+1)*stepwidth]), axis=0)
-        # seg_template: (seg_num, n_events, n_chans, stepwidth)
-        seg_template = np.concatenate((seg_template,
-            template[NA, ..., i*stepwidth:(i+1)*stepwidth]), axis=0)
-    seg_target_data = np.delete(seg_target_data, 0, axis=0)
-    seg_template = np.delete(seg_template, 0, axis=0)
+    # split data (views)
+    # seg_target_data: (seg_num, n_events, n_events, n_trials, n_chans, stepwidth)
+    seg_target_data = split_data(target_sig, stepwidth)
+    seg_template = split_data(template, stepwidth)  # (seg_num, n_events, n_chans, stepwidth)
     
     if mode == 'partial':  # only divide the test dataset
         # compute spatial filter w
         w = TRCA_compute(model_sig)
 
-        # split target identification
-        rou = np.zeros((seg_num, n_events, n_tests, n_events))
-        for seg in range(seg_num):
-            for nes in range(n_events):                  # n_events in srca model
-                for nte in range(n_tests):               # n_tests
-                    for ner in range(n_events):          # n_events in real test dataset
-                        temp_test = w[nes, :] @ seg_target_data[seg, nes, ner, nte, ...]
-                        temp_template = w[nes, :] @ seg_template[seg, nes, ...]
-                        rou[seg, nes, nte, ner] = corr_coef(temp_test, temp_template)
+        # split target identification: (seg_num, n_events srca, n_tests, n_events test)
+        rou = trca_score(w, seg_template, seg_target_data, model_wise=True)
     
     elif mode == 'total':  # divide both the training and test dataset
-        # compute spatial filter w
-        seg_w = np.zeros((1, n_events, n_chans))
-        for i in range(seg_num):
-            temp_w = TRCA_compute(model_sig[..., i*stepwidth:(i+1)*stepwidth])
-            seg_w = np.concatenate((seg_w, temp_w[NA, ...]), axis=0)
-        seg_w = np.delete(seg_w, 0, axis=0)
-
-        # split target identification
-        rou = np.zeros((seg_num, n_events, n_tests, n_events))
-        for seg in range(seg_num):
-            for nes in range(n_events):                  # n_events in srca model
-                for nte in range(n_tests):               # n_tests
-                    for ner in range(n_events):          # n_events in real test dataset
-                        temp_test = seg_w[seg, nes, :] @ seg_target_data[seg, nes, ner, nte, ...]
-                        temp_template = seg_w[seg, nes, :] @ seg_template[seg, nes, ...]
-                        rou[seg, nes, nte, ner] = corr_coef(temp_test, temp_template)
+        # compute spatial filter w of all segments at once: (seg_num, n_events, n_chans)
+        seg_w = TRCA_compute(split_data(model_sig, stepwidth))
+
+        # split target identification: (seg_num, n_events srca, n_tests, n_events test)
+        rou = trca_score(seg_w, seg_template, seg_target_data, model_wise=True)
 
     # compute accuracy
-    accuracy = []
-    r = np.sum(rou, axis=0)
-    for ner in range(n_events):
-        for nte in range(n_tests):
-            if np.argmax(r[:, nte, ner]) == ner:
-                accuracy.append(1)
-    accuracy = np.sum(accuracy) / (n_events*n_tests)
+    accuracy = trca_accuracy(np.sum(rou, axis=0))
 
     return rou, accuracy
 
@@ -1565,7 +1856,6 @@ def split_SRCA_eTRCA(stepwidth, train_data, test_data, tar_chans, model_chans, c
     n_tests = test_data.shape[1]
     n_chans = len(tar_chans)
     n_times = train_data.shape[-1] - sp
-    seg_num = int(n_times/stepwidth)
 
     # config correct srca process on training dataset
     model_sig = np.zeros((n_events, n_trains, n_chans, n_times))
@@ -1586,59 +1876,27 @@ def split_SRCA_eTRCA(stepwidth, train_data, test_data, tar_chans, model_chans, c
                 temp_model, chans, regression, sp)
     del nes, ner
 
-    # split data
-    seg_target_data = np.zeros((1, n_events, n_events, n_tests, n_chans, stepwidth))
-    seg_template = np.zeros((1, n_events, n_chans, stepwidth))
-    for i in range(seg_num):
-        # seg_target_data: (seg_num, n_events, n_events, n_trials, n_chans, stepwidth)
-        seg_target_data = np.concatenate((seg_target_data,
-            target_sig[NA, ..., i*stepwidth:(i+1)*stepwidth]), axis=0)
-        # seg_template: (seg_num, n_events, n_chans, stepwidth)
-        seg_template = np.concatenate((seg_template,
-            template[NA, ..., i*stepwidth:(i+1)*stepwidth]), axis=0)
-    seg_target_data = np.delete(seg_target_data, 0, axis=0)
-    seg_template = np.delete(seg_template, 0, axis=0)
+    # split data (views)
+    # seg_target_data: (seg_num, n_events, n_events, n_trials, n_chans, stepwidth)
+    seg_target_data = split_data(target_sig, stepwidth)
+    seg_template = split_data(template, stepwidth)  # (seg_num, n_events, n_chans, stepwidth)
     
     if mode == 'partial':  # only divide the test dataset
         # compute spatial filter w
         w = TRCA_compute(model_sig)
 
-        # split target identification
-        rou = np.zeros((seg_num, n_events, n_tests, n_events))
-        for seg in range(seg_num):
-            for nes in range(n_events):                  # n_events in srca model
-                for nte in range(n_tests):               # n_tests
-                    for ner in range(n_events):          # n_events in real test dataset
-                        temp_test = w @ seg_target_data[seg, nes, ner, nte, ...]
-                        temp_template = w @ seg_template[seg, nes, ...]
-                        rou[seg, nes, nte, ner] = pearson_corr2(temp_test, temp_template)
+        # split target identification: (seg_num, n_events srca, n_tests, n_events test)
+        rou = trca_score(w, seg_template, seg_target_data, ensemble=True, model_wise=True)
     
     elif mode == 'total':  # divide both the training and test dataset
-        # compute spatial filter w
-        seg_w = np.zeros((1, n_events, n_chans))
-        for i in range(seg_num):
-            temp_w = TRCA_compute(model_sig[..., i*stepwidth:(i+1)*stepwidth])
-            seg_w = np.concatenate((seg_w, temp_w[NA, ...]), axis=0)
-        seg_w = np.delete(seg_w, 0, axis=0)
-
-        # split target identification
-        rou = np.zeros((seg_num, n_events, n_tests, n_events))
-        for seg in range(seg_num):
-            for nes in range(n_events):                  # n_events in srca model
-                for nte in range(n_tests):               # n_tests
-                    for ner in range(n_events):          # n_events in real test dataset
-                        temp_test = seg_w[seg, ...] @ seg_target_data[seg, nes, ner, nte, ...]
-                        temp_template = seg_w[seg, ...] @ seg_template[seg, nes, ...]
-                        rou[seg, nes, nte, ner] = pearson_corr2(temp_test, temp_template)
+        # compute spatial filter w of all segments at once: (seg_num, n_events, n_chans)
+        seg_w = TRCA_compute(split_data(model_sig, stepwidth))
+
+        # split target identification: (seg_num, n_events srca, n_tests, n_events test)
+        rou = trca_score(seg_w, seg_template, seg_target_data, ensemble=True, model_wise=True)
 
     # compute accuracy
-    accuracy = []
-    r = np.sum(rou, axis=0)
-    for ner in range(n_events):
-        for nte in range(n_tests):
-            if np.argmax(r[:, nte, ner]) == ner:
-                accuracy.append(1)
-    accuracy = np.sum(accuracy) / (n_events*n_tests)
+    accuracy = trca_accuracy(np.sum(rou, axis=0))
 
     return rou, accuracy
 
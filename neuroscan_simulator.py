@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Neuroscan Scan server & benchmark of the acquisition pipeline
+
+1. NeuroscanSimulator: TCP server speaking the same header/data format as ex_base.Neuroscan
+    (12-byte 'CTRL'/'DATA' headers, big-endian int32 samples with the label as the last column),
+    streaming synthetic or recorded (.mat) EEG at a configurable rate, channel number and trigger schedule.
+2. benchmark: drive ex_base.Neuroscan against the simulator and report packets/s,
+    end-to-end hook latency percentiles and dropped data.
+
+@author: Brynhildr
+"""
+
+import time
+import socket, struct, threading
+
+import numpy as np
+import scipy.io as sio
+
+
+class NeuroscanSimulator:
+    """
+    Simulated Scan server.
+    Usage:
+        sim = NeuroscanSimulator(('127.0.0.1', 4000), srate=1000, num_chans=68,
+            triggers={'label': 1, 'onset': 1, 'interval': 2})
+        sim.start()
+        ... (ex_base.Neuroscan(address=('127.0.0.1', 4000), ...))
+        sim.stop()
+    """
+    # (w_code, w_request) of the control commands, see ex_base.Neuroscan._COMMANDS
+    _CTRL = {
+        (1, 2): 'stop_connect',
+        (2, 1): 'start_acq',
+        (2, 2): 'stop_acq',
+        (3, 3): 'start_trans',
+        (3, 4): 'stop_trans'
+    }
+
+    def __init__(self, address=('127.0.0.1', 4000), srate=1000, num_chans=68, data=None,
+                 triggers=None, speed=1.0, seed=None):
+        """
+        :param address: (host, port) to listen on.
+        :param srate: sampling rate / Hz, each package has srate/25 points.
+        :param num_chans: number of EEG channels (the label channel is extra).
+        :param data: None (synthetic), ndarray (num_chans(+1), n_points) in uV, or (file_name, key) of a .mat file;
+            if there are num_chans+1 rows (e.g. files of Amplifier's save hook), the last one is used as labels.
+        :param triggers: None, dict {'label': int, 'onset': s, 'interval': s} for a periodic schedule,
+            or ndarray (n_triggers, 2) of (sample index, label).
+        :param speed: streaming speed relative to real time, e.g. 10 for load-testing.
+        """
+        self.address = address
+        self.srate = srate
+        self.num_chans = num_chans
+        self.pkg_points = int(srate/25)
+        self.speed = speed
+        self.rng = np.random.default_rng(seed)
+
+        if isinstance(data, tuple):
+            data = sio.loadmat(data[0])[data[1]]
+        if data is None:
+            data = self._synthetic(10*srate)
+        data = np.asarray(data, dtype=np.float64)
+        if data.shape[0] == num_chans+1:
+            data, labels = data[:-1], data[-1].copy()
+        elif data.shape[0] == num_chans:
+            labels = np.zeros((data.shape[1]))
+        else:
+            raise ValueError('data should have num_chans or num_chans+1 rows.')
+        # raw integers as sent by the amplifier (see ex_base.Neuroscan._unpack_data)
+        self.raw = np.round(data/0.0298).astype('>i4').T  # (n_points, num_chans)
+        self.file_labels = labels.astype(np.int64)
+        self.triggers = triggers
+
+        self.sent_times = []  # perf_counter of each DATA package
+        self.trigger_samples = []  # (sample index, label) of each sent trigger
+        self._server = None
+        self._conn = None
+        self._streaming = threading.Event()
+        self._closed = threading.Event()
+        self._t_server = None
+
+    def _synthetic(self, n_points):
+        time_point = np.arange(n_points)/self.srate
+        freqs = self.rng.uniform(8, 16, size=(self.num_chans, 1))
+        return 10*np.sin(2*np.pi*freqs*time_point) + self.rng.standard_normal((self.num_chans, n_points))
+
+    def _labels(self, start, stop):
+        labels = self.file_labels[np.arange(start, stop) % self.file_labels.size].copy()
+        if isinstance(self.triggers, dict):
+            onset = int(self.triggers.get('onset', 0)*self.srate)
+            interval = int(self.triggers['interval']*self.srate)
+            first = onset if start <= onset else onset + int(np.ceil((start-onset)/interval))*interval
+            labels[np.arange(first, stop, interval) - start] = self.triggers['label']
+        elif self.triggers is not None:
+            schedule = np.asarray(self.triggers)
+            idx = (schedule[:, 0] >= start) & (schedule[:, 0] < stop)
+            labels[schedule[idx, 0] - start] = schedule[idx, 1]
+        return labels
+
+    def _package(self, n_package):
+        start = n_package*self.pkg_points
+        stop = start + self.pkg_points
+        data = np.empty((self.pkg_points, self.num_chans+1), dtype='>i4')
+        data[:, :-1] = self.raw[np.arange(start, stop) % self.raw.shape[0]]
+        labels = self._labels(start, stop)
+        data[:, -1] = labels + 65280
+        for i in np.flatnonzero(labels):
+            self.trigger_samples.append((start+i, labels[i]))
+        b_data = data.tobytes()
+        return struct.pack('>4sHHI', b'DATA', 2, 1, len(b_data)) + b_data
+
+    def _recv_command(self):
+        b_header = b''
+        while len(b_header) < 12:
+            chunk = self._conn.recv(12 - len(b_header))
+            if not chunk:
+                return None
+            b_header += chunk
+        ch_id, w_code, w_request, pkg_size = struct.unpack('>4sHHI', b_header)
+        if pkg_size:
+            self._conn.recv(pkg_size)
+        return self._CTRL.get((w_code, w_request), 'unknown')
+
+    def _stream(self):
+        n_package = 0
+        t_start = time.perf_counter()
+        period = self.pkg_points/self.srate/self.speed
+        while self._streaming.is_set() and not self._closed.is_set():
+            delay = t_start + n_package*period - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            package = self._package(n_package)
+            try:
+                self._conn.sendall(package)
+            except OSError:
+                break
+            self.sent_times.append(time.perf_counter())
+            n_package += 1
+
+    def _serve(self):
+        self._conn, _ = self._server.accept()
+        t_stream = None
+        while not self._closed.is_set():
+            try:
+                command = self._recv_command()
+            except OSError:
+                break
+            if command is None or command == 'stop_connect':
+                break
+            if command == 'start_acq':
+                # two header-only replies, read by Neuroscan.command('start_acq')
+                self._conn.sendall(struct.pack('>4sHHI', b'CTRL', 3, 5, 0)*2)
+            elif command == 'start_trans':
+                self._streaming.set()
+                t_stream = threading.Thread(target=self._stream, daemon=True, name='sim_stream')
+                t_stream.start()
+            elif command == 'stop_trans':
+                self._streaming.clear()
+                if t_stream is not None:
+                    t_stream.join()
+        self._streaming.clear()
+        self._conn.close()
+
+    def start(self):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(self.address)
+        self._server.listen(1)
+        self.address = self._server.getsockname()  # port 0 -> actual port
+        self._t_server = threading.Thread(target=self._serve, daemon=True, name='sim_server')
+        self._t_server.start()
+
+    def stop(self):
+        self._closed.set()
+        self._streaming.clear()
+        if self._server is not None:
+            self._server.close()
+        if self._t_server is not None:
+            self._t_server.join(timeout=1)
+
+
+def benchmark(duration=10, srate=1000, num_chans=68, speed=1.0, data=None, triggers=None,
+              epoch=(0.14, 0.64), hooks=None, amplifier=None):
+    """
+    Run ex_base.Neuroscan against a local simulator.
+
+    :param duration: streaming time / s.
+    :param srate, num_chans, speed, data, triggers: see NeuroscanSimulator;
+        triggers default to label 1 every second.
+    :param epoch: tlim of the 'label' probe hook / s.
+    :param hooks: extra hooks, list of (name, data_type, handler) registered beside the probes.
+    :param amplifier: optional Neuroscan instance (default: a new ex_base.Neuroscan).
+    :return: report: dict,
+        packets/s, end-to-end latency percentiles (ms) of the probes, dropped samples & epochs,
+        queue backlog (ring cursors, or the hook queues of AsyncNeuroscan)
+        and the amplifier's own PipelineStats snapshot.
+    """
+    triggers = {'label': 1, 'onset': 1, 'interval': 1} if triggers is None else triggers
+    sim = NeuroscanSimulator(('127.0.0.1', 0), srate, num_chans, data, triggers, speed)
+    sim.start()
+
+    if amplifier is None:
+        # ex_base uses package-relative imports: the simulator lives in the same package
+        from .ex_base import Neuroscan
+        amplifier = Neuroscan(address=sim.address, srate=srate, num_chans=num_chans)
+    else:
+        amplifier.address = sim.address
+
+    # probes: every package (realtime) and every labelled epoch
+    amplifier.register_hook('probe_realtime', handler=lambda eeg_data, extras: (time.perf_counter(), len(eeg_data)))
+    amplifier.register_hook('probe_label', handler=lambda eeg_data, extras: time.perf_counter(),
+        data_type={'process_type': 'label', 'label': triggers['label'] if isinstance(triggers, dict) else None,
+                   'tlim': epoch})
+    names = ['probe_realtime', 'probe_label']
+    for name, data_type, handler in (hooks or []):
+        amplifier.register_hook(name, data_type=data_type, handler=handler)
+        names.append(name)
+
+    amplifier.command('connect')
+    amplifier.command('start_acq')
+    amplifier.use_hooks(names)
+    output_queues = {name: amplifier.get_output_queue(name) for name in names}
+    ring = amplifier._get_ring()
+    amplifier.command('start_transport')
+
+    max_backlog = 0
+    t_end = time.perf_counter() + duration/speed
+    while time.perf_counter() < t_end:
+        backlog = list(ring.backlog().values())
+        # AsyncNeuroscan: hooks are fed through asyncio queues, not the ring
+        backlog += [hook_queue.qsize() for _, hook_queue in list(getattr(amplifier, '_hook_queues', {}).values())]
+        max_backlog = max([max_backlog] + backlog)
+        time.sleep(0.01)
+
+    # stop streaming on the server side first and let the pipeline drain
+    sim._streaming.clear()
+    time.sleep(0.2)
+    amplifier.command('stop_transport')
+    amplifier.command('disconnect')
+    sim.stop()
+
+    outputs = {}
+    for name, q in output_queues.items():
+        outputs[name] = []
+        while not q.empty():
+            item = q.get()
+            if item is not None:
+                outputs[name].append(item)
+
+    # realtime: i-th received package <-> i-th sent package
+    sent = np.array(sim.sent_times)
+    received = outputs['probe_realtime']
+    n_received = len(received)
+    latency_rt = np.array([t for t, _ in received]) - sent[:n_received]
+    n_samples = int(np.sum([n for _, n in received]))
+
+    # label: k-th epoch completes at its trigger + max(0, epoch end)
+    latency_label = np.zeros((0))
+    if isinstance(triggers, dict) and outputs['probe_label']:
+        t_label = np.array(outputs['probe_label'])
+        done = np.array([s for s, _ in sim.trigger_samples]) + int(max(epoch[1], 0)*srate)
+        done = done[:t_label.size]
+        latency_label = t_label - sent[np.minimum(done//sim.pkg_points, sent.size-1)]
+
+    def percentiles(latency):
+        if latency.size == 0:
+            return {}
+        summary = {p: 1e3*np.percentile(latency, p) for p in (50, 95, 99)}
+        summary['max'] = 1e3*latency.max()
+        return summary
+
+    report = {
+        'packets_sent': sent.size,
+        'packets_received': n_received,
+        'packets_per_s': n_received/(duration/speed),
+        'dropped_samples': sent.size*sim.pkg_points - n_samples,
+        'max_queue_backlog': max_backlog,
+        'ring_overflows': dict(ring.overflows),
+        'ring_dropped': ring.dropped,
+        'ring_missed_epochs': dict(ring.missed),
+        'latency_realtime_ms': percentiles(latency_rt),
+        'latency_label_ms': percentiles(latency_label),
+        'stats': amplifier.stats.snapshot()
+    }
+    return report
+
+
+if __name__ == '__main__':
+    # run as a module of the package: python -m <package>.neuroscan_simulator
+    print(benchmark(duration=10))
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Cached preprocessing pipeline: .cnt files -> epoched (& filtered) arrays
+
+Stages (each one cached on disk, keyed by the hash of its input & its own parameters):
+    (1) raw: read & concatenate .cnt files (key: content hash of the files, read options)
+    (2) raw_filter: optional filtering of the continuous data (key: raw + raw.filter options)
+    (3) epochs: (n_events, n_trials, n_chans, n_times) in uV (key: raw + tmin/tmax/picks),
+        all event ids in a single pass (epoch_all)
+    (4) filtered: filter_data of the epochs (key: epochs + band/method)
+Changing a parameter only recomputes the stages after it,
+e.g. a sweep over filter bands reads the .cnt files once.
+
+Usage:
+    pipeline = CntPipeline.from_folders(r'D:\\SSVEP\\dataset\\code_VEP\\wuqiaoyi', ['srca train-12-31'],
+                                        cache_dir=r'D:\\SSVEP\\cache')
+    f_data, chan_info = pipeline.filtered(tmin=-1, tmax=1, l_freq=50, h_freq=70, drop_chans=['M1', 'M2'])
+    pipeline.to_mat(data_path, tmin=-1, tmax=1, l_freq=50, h_freq=70, drop_chans=['M1', 'M2'])
+
+@author: Brynhildr
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+import scipy.io as io
+
+import mne
+from mne.io import concatenate_raws
+from mne.filter import filter_data
+
+
+def _hash_params(*params):
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:20]
+
+
+def file_hash(file_name, chunk_size=1<<20):
+    """
+    SHA-1 of a file's content, read in chunks.
+    :param file_name: path of the file.
+    :param chunk_size: bytes per read.
+    :return: hex digest: str
+    """
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def epoch_all(data, events, tmin, tmax, sfreq, event_ids=None, scale=1., out=None):
+    """
+    Epoch every event id in one pass (instead of one mne.Epochs per event id).
+    Sample selection is the same as mne.Epochs(baseline=None):
+        onset + round(tmin*sfreq) ... onset + round(tmax*sfreq).
+    Unlike mne.Epochs, no epoch is dropped: epochs overlapping BAD/boundary annotations are kept,
+    and epochs extending past the data raise ValueError instead of being left out.
+    :param data: (n_chans, n_points) continuous data.
+    :param events: (n_triggers, 3) events array (mne format), onsets in samples of data.
+    :param tmin, tmax: time range / s.
+    :param sfreq: sampling frequency / Hz.
+    :param event_ids: event ids in output order, default: all ids of events (sorted).
+    :param scale: e.g. 1e6 for V -> uV.
+    :param out: optional preallocated (n_events, n_trials, n_chans, n_times) array.
+    :return: out: (n_events, n_trials, n_chans, n_times) ndarray
+    """
+    events = np.asarray(events)
+    event_ids = np.unique(events[:, 2]) if event_ids is None else np.asarray(event_ids)
+    start = int(round(tmin * sfreq))
+    n_times = int(round(tmax * sfreq)) - start + 1
+
+    # onsets of all events at once: (n_events, n_trials), in trigger order within each event
+    missing = np.setdiff1d(event_ids, events[:, 2])
+    if missing.size:
+        raise ValueError('Event id %d not found.' % missing[0])
+    onsets = [events[events[:, 2] == event_id, 0] for event_id in event_ids]
+    n_trials = {o.size for o in onsets}
+    if len(n_trials) != 1:
+        raise ValueError('Every event should have the same number of trials.')
+    onsets = np.array(onsets) + start
+    if onsets.min() < 0 or onsets.max() + n_times > data.shape[-1]:
+        raise ValueError('Epochs exceed the range of data.')
+
+    # (n_events, n_trials, n_times) sample indices, gathered channel by channel
+    idx = onsets[..., None] + np.arange(n_times)
+    shape = onsets.shape[:2] + (data.shape[0], n_times)
+    if out is None:
+        out = np.empty(shape, dtype=np.result_type(data.dtype, np.float64))
+    elif out.shape != shape:
+        raise ValueError('out should have the shape %s.' % (shape,))
+    for nc in range(data.shape[0]):
+        np.multiply(data[nc][idx], scale, out=out[:, :, nc, :])
+    return out
+
+
+class CntPipeline:
+    """
+    Content-addressed cache of the preprocessing of one group of .cnt files.
+    Files in cache_dir:
+        <key>_raw.fif & <key>_raw.json: raw & raw_filter stages (mne's own format in float64, read lazily;
+            the .json marks a complete save)
+        <key>.npy & <key>.json: epochs & filtered stages (data & chan_info/sfreq/parameters)
+        file_hashes.json: content hashes of the .cnt files, reused while (size, mtime) is unchanged
+    """
+    def __init__(self, files, cache_dir, read_kwargs=None, n_jobs=1, verbose=True):
+        """
+        :param files: list of .cnt files, concatenated in this order.
+        :param cache_dir: directory of the cache (can be shared by several pipelines).
+        :param read_kwargs: kwargs of mne.io.read_raw_cnt,
+            default: eog=['HEO', 'VEO'], emg=['EMG'], ecg=['EKG'].
+        :param n_jobs: n_jobs of filter_data/raw.filter (not part of the cache keys).
+        :param verbose: print cache hits & computed stages.
+        """
+        self.files = list(files)
+        self.cache_dir = cache_dir
+        if read_kwargs is None:
+            read_kwargs = {'eog': ['HEO', 'VEO'], 'emg': ['EMG'], 'ecg': ['EKG']}
+        self.read_kwargs = read_kwargs
+        self.n_jobs = n_jobs
+        self.verbose = verbose
+        os.makedirs(cache_dir, exist_ok=True)
+        self._hashes = None
+
+    @classmethod
+    def from_folders(cls, filepath, subjectlist, cache_dir=None, **kwargs):
+        """
+        Same file list as the preprocessing scripts: every file of filepath/subindex.
+        :param filepath: root folder.
+        :param subjectlist: list of sub-folders.
+        :param cache_dir: default: filepath/.cache
+        """
+        files = []
+        for subindex in subjectlist:
+            filefolder = os.path.join(filepath, subindex)
+            for file in sorted(os.listdir(filefolder)):
+                if file.lower().endswith('.cnt'):
+                    files.append(os.path.join(filefolder, file))
+        cache_dir = os.path.join(filepath, '.cache') if cache_dir is None else cache_dir
+        return cls(files, cache_dir, **kwargs)
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key + suffix)
+
+    # %% keys
+    def file_hashes(self):
+        """Content hashes of the .cnt files, rehashed only when a file's size or mtime changes."""
+        if self._hashes is not None:
+            return self._hashes
+        memo_path = self._path('file_hashes', '.json')
+        memo = {}
+        if os.path.exists(memo_path):
+            with open(memo_path, 'r') as f:
+                memo = json.load(f)
+        hashes = []
+        for file in self.files:
+            stat = os.stat(file)
+            tag = [stat.st_size, stat.st_mtime_ns]
+            entry = memo.get(os.path.abspath(file))
+            if entry is None or entry[0] != tag:
+                entry = [tag, file_hash(file)]
+                memo[os.path.abspath(file)] = entry
+            hashes.append(entry[1])
+        self._save_json(memo_path, memo)
+        self._hashes = hashes
+        return hashes
+
+    def raw_key(self, raw_filter=None):
+        key = _hash_params('raw', self.file_hashes(), self.read_kwargs)
+        if raw_filter:
+            key = _hash_params('raw_filter', key, raw_filter)
+        return key
+
+    def epochs_key(self, tmin, tmax, picks=None, drop_chans=None, raw_filter=None):
+        # version 2: epoch_all (caches of the former per-event mne.Epochs stage are not reused)
+        return _hash_params('epochs', 2, self.raw_key(raw_filter), tmin, tmax, picks, drop_chans)
+
+    def filtered_key(self, tmin, tmax, l_freq, h_freq, method='fir', picks=None, drop_chans=None,
+                     raw_filter=None, **filter_kwargs):
+        epochs_key = self.epochs_key(tmin, tmax, picks, drop_chans, raw_filter)
+        return _hash_params('filtered', epochs_key, l_freq, h_freq, method, filter_kwargs)
+
+    # %% cache I/O
+    @staticmethod
+    def _save_json(path, content):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(content, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def _save_array(self, key, data, meta):
+        # .npy first, the .json marks the entry as complete
+        with open(self._path(key, '.npy.tmp'), 'wb') as f:
+            np.save(f, data)
+        os.replace(self._path(key, '.npy.tmp'), self._path(key, '.npy'))
+        self._save_json(self._path(key, '.json'), meta)
+
+    def _load_meta(self, key):
+        if not os.path.exists(self._path(key, '.json')):
+            return None
+        with open(self._path(key, '.json'), 'r') as f:
+            return json.load(f)
+
+    def _load_array(self, key, mmap_mode=None):
+        meta = self._load_meta(key)
+        if meta is None:
+            return None, None
+        return np.load(self._path(key, '.npy'), mmap_mode=mmap_mode), meta
+
+    # %% stages
+    def raw(self, raw_filter=None):
+        """
+        Continuous data of all files.
+        :param raw_filter: None or dict of raw.filter kwargs, e.g. {'l_freq': 0.5, 'h_freq': 20., 'method': 'fir'}.
+        :return: raw: mne.io.Raw (not preloaded)
+        """
+        key = self.raw_key(raw_filter)
+        fif_path = self._path(key, '_raw.fif')
+        if os.path.exists(self._path(key, '_raw.json')):
+            self._log('raw: cache hit (%s)' % key)
+            return mne.io.read_raw_fif(fif_path, preload=False, verbose=False)
+
+        if raw_filter:
+            raw = self.raw().load_data()
+            self._log('raw: filtering (%s)' % key)
+            raw.filter(n_jobs=self.n_jobs, verbose=False, **raw_filter)
+        else:
+            self._log('raw: reading %d .cnt files (%s)' % (len(self.files), key))
+            raw_cnts = [mne.io.read_raw_cnt(file, preload=True, verbose=False, **self.read_kwargs)
+                        for file in self.files]
+            raw = concatenate_raws(raw_cnts)
+            del raw_cnts
+        # float64 like the in-memory raw: cold runs & cache hits give the same epochs
+        # .fif first, the .json marks the entry as complete (a crash mid-save is never a cache hit);
+        # no rename: split files of a long recording refer to each other by name
+        raw.save(fif_path, fmt='double', overwrite=True, verbose=False)
+        self._save_json(self._path(key, '_raw.json'), {'stage': 'raw', 'raw_filter': raw_filter,
+                                                      'files': self.files})
+        return raw
+
+    def epochs(self, tmin, tmax, picks=None, drop_chans=None, raw_filter=None):
+        """
+        Epoch every event id.
+        :param tmin, tmax: time range / s.
+        :param picks: list of channel names, default: all EEG channels except drop_chans.
+        :param drop_chans: channels excluded from the default picks, e.g. ['M1', 'M2'].
+        :param raw_filter: see raw.
+        :return: data: (n_events, n_trials, n_chans, n_times) ndarray (uV, read-only memmap)
+            chan_info: list of picked channels' names
+        """
+        key = self.epochs_key(tmin, tmax, picks, drop_chans, raw_filter)
+        data, meta = self._load_array(key, mmap_mode='r')
+        if data is not None:
+            self._log('epochs: cache hit (%s)' % key)
+            return data, meta['chan_info']
+
+        raw = self.raw(raw_filter)
+        self._log('epochs: extracting (%s)' % key)
+        events, events_id = mne.events_from_annotations(raw, verbose=False)
+        if picks is None:
+            picks_idx = mne.pick_types(raw.info, emg=False, eeg=True, stim=False, eog=False,
+                                       exclude=drop_chans or [])
+        else:
+            picks_idx = mne.pick_channels(raw.ch_names, include=picks, ordered=True)
+        chan_info = [raw.ch_names[i] for i in picks_idx]
+        sfreq = raw.info['sfreq']
+
+        # boundary annotations of concatenate_raws are not stimulus events
+        event_ids = sorted(v for k, v in events_id.items() if 'boundary' not in k.lower())
+        events = events.copy()
+        events[:, 0] -= raw.first_samp
+        data = epoch_all(raw.get_data(picks=picks_idx), events, tmin, tmax, sfreq,
+                         event_ids=event_ids, scale=1e6)
+
+        self._save_array(key, data, {'stage': 'epochs', 'chan_info': chan_info, 'sfreq': sfreq,
+                                     'tmin': tmin, 'tmax': tmax, 'raw': self.raw_key(raw_filter)})
+        return data, chan_info
+
+    def filtered(self, tmin, tmax, l_freq, h_freq, method='fir', picks=None, drop_chans=None,
+                 raw_filter=None, **filter_kwargs):
+        """
+        Band-pass filtered epochs.
+        :param tmin, tmax, picks, drop_chans, raw_filter: see epochs.
+        :param l_freq, h_freq, method, filter_kwargs: see mne.filter.filter_data.
+        :return: f_data: (n_events, n_trials, n_chans, n_times) ndarray (read-only memmap)
+            chan_info: list of picked channels' names
+        """
+        key = self.filtered_key(tmin, tmax, l_freq, h_freq, method, picks, drop_chans,
+                                raw_filter, **filter_kwargs)
+        f_data, meta = self._load_array(key, mmap_mode='r')
+        if f_data is not None:
+            self._log('filtered: cache hit (%s)' % key)
+            return f_data, meta['chan_info']
+
+        data, chan_info = self.epochs(tmin, tmax, picks, drop_chans, raw_filter)
+        meta = self._load_meta(self.epochs_key(tmin, tmax, picks, drop_chans, raw_filter))
+        self._log('filtered: %s-%s Hz %s (%s)' % (l_freq, h_freq, method, key))
+        f_data = filter_data(np.array(data), sfreq=meta['sfreq'], l_freq=l_freq, h_freq=h_freq,
+                             method=method, n_jobs=self.n_jobs, verbose=False, **filter_kwargs)
+        self._save_array(key, f_data, {'stage': 'filtered', 'chan_info': chan_info,
+                                       'sfreq': meta['sfreq'], 'l_freq': l_freq, 'h_freq': h_freq,
+                                       'method': method, 'epochs': meta})
+        return f_data, chan_info
+
+    def to_mat(self, data_path, tmin, tmax, l_freq=None, h_freq=None, **kwargs):
+        """
+        Save {'f_data', 'chan_info'} like the preprocessing scripts.
+        Without l_freq & h_freq the unfiltered epochs are saved.
+        :param data_path: .mat file.
+        :param kwargs: see filtered.
+        """
+        if l_freq is None and h_freq is None:
+            data, chan_info = self.epochs(tmin, tmax, kwargs.get('picks'), kwargs.get('drop_chans'),
+                                          kwargs.get('raw_filter'))
+        else:
+            data, chan_info = self.filtered(tmin, tmax, l_freq, h_freq, **kwargs)
+        io.savemat(data_path, {'f_data': np.asarray(data), 'chan_info': chan_info})
@@ -11,6 +11,7 @@ import time
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
 import mcee
+from dataset_store import (fdata_store, SubsetReader)
 import seaborn as sns
 from math import pi
 
@@ -31,13 +32,13 @@ for i in range(len(tempChans)):
     if i % 2 == 0 or i % 2 == 1:
         modelChans.append(tempChans[i].tolist())
 del tempChans, srca, i
-eeg = io.loadmat(r'D:\SSVEP\dataset\preprocessed_data\pangjun\40_70bp.mat')
-f_data = eeg['f_data'][:2,:,:,:]
-chans = eeg['chan_info'].tolist()
-trainData = f_data[:, trainTrials[:40], :, :1440]
-testData = f_data[:, trainTrials[-80:], :, :1440]
+store, name = fdata_store(r'D:\SSVEP\dataset\preprocessed_data\pangjun\40_70bp.mat')
+chans = store.chans
+reader = SubsetReader(store, times=(0, 1440), events=[0, 1])
+trainData = reader(name, trials=trainTrials[:40])
+testData = reader(name, trials=trainTrials[-80:])
 del trainTrials
-del eeg, f_data
+del store, reader
 
 #%% (1) apply SRCA models
 srcaTe = np.zeros((2,80,9,300))
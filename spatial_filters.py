@@ -68,6 +68,8 @@ from time import perf_counter
 import scipy.io as io
 import matplotlib.pyplot as plt
 
+from mcee import (trca_matrix, solve_gep)
+
 # %% Prefunctions
 def zero_mean(data):
     """
@@ -348,15 +350,8 @@ class spatial_filter:
 
             if 'origin' or 'ensemble' in filter_type:
                 # same in filter constructing, different in target identification
-                for ne in range(self.n_events):
-                    temp = self.train_data[ne, ...].swapaxes(0,1).reshape((self.n_chans,-1), order='C')
-                    self.matrix_A[ne, ...] = (temp@temp.T) / (self.n_trains*self.n_times)
-                    for i in range(self.n_trains):
-                        for j in range(self.n_trains):
-                            if i != j:
-                                data_i = self.train_data[ne, i, ...]
-                                data_j = self.train_data[ne, j, ...]
-                                self.matrix_B[ne, ...] += (data_i@data_j.T) / self.n_times
+                # all events at once (shared TRCA kernel)
+                self.matrix_B, self.matrix_A = trca_matrix(self.train_data)
                 self.template = self.train_data.mean(axis=1)
                 if 'ensemble' in filter_type:
                     self.ensemble = True
@@ -408,8 +403,5 @@ class spatial_filter:
                     matrix_B[ne, ...] = data.T @ data
                 elif self.frame_type == '2':  # B = E
                     matrix_B[ne, ...] = np.eye(matrix_A.shape[0])
-        # solve Generalized Eigenvalue Problems(GEPS)
-        for ne in range(self.n_events):
-            e_va, e_vec = LA.eig(LA.inv(matrix_A[ne, ...]) @ matrix_B[ne, ...])
-            w_index = np.argmax(e_va)
-            self.w[ne, :] = e_vec[:, w_index].T
\ No newline at end of file
+        # solve Generalized Eigenvalue Problems(GEPS): B*W = A*W*Lambda
+        self.w = solve_gep(matrix_B, matrix_A)
\ No newline at end of file
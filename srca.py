@@ -58,6 +58,8 @@ Target identification functions (Developer-Special Edition, DSE)
 Main function:
 1. SRCA: class
     container of SRCA data
+2. srca_search:
+    stepwise channel search of one target channel (used by SRCA.fit)
 
 update: 2020/12/10
 
@@ -71,10 +73,16 @@ from math import pi
 from sklearn import linear_model
 
 from copy import deepcopy
+from functools import partial
 from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+import os
+import tempfile
 import scipy.io as io
 import matplotlib.pyplot as plt
 
+import mcee
+
 # %% Prefunctions
 def zero_mean(data):
     """
@@ -134,9 +142,7 @@ def sinw(freq, time, phase, sfreq=1000):
     wave : (time*sfreq,)
         sinusoidal sequence.
     """
-    n_point = int(time*sfreq)
-    time_point = np.linspace(0, (n_point-1)/sfreq, n_point)
-    wave = np.sin(2*pi*freq*time_point + pi*phase)
+    wave = mcee.sin_bank(freq, 1, int(time*sfreq), phase, sfreq)[0]
 
     return wave
 
@@ -401,6 +407,96 @@ def srca_process(rest_model, rest_target, task_model, task_target, regression='I
     return extract
 
 
+def srca_objective(data, objective_function='fisher_score', y=None):
+    """
+
+    Parameters
+    ----------
+    data : (n_trials, n_points)
+        SRCA filtered data (or original data) of target channel.
+    objective_function : str, optional
+        'fisher_score' or 'pearson_corr'. The default is 'fisher_score'.
+    y : (n_trials,), optional
+        Labels. Required by 'fisher_score'. The default is None.
+
+    Returns
+    -------
+    para : float
+        The mean of objective function.
+    """
+    if objective_function == 'fisher_score':
+        if y is None or np.unique(y).size != 2:
+            raise ValueError('fisher_score objective needs labels of exactly 2 classes.')
+        order = np.argsort(y, kind='stable')
+        break_point = int(np.sum(y == y[order[0]]))
+        return np.mean(fisher_score(data[order, :], break_point))
+    elif objective_function == 'pearson_corr':
+        labels = np.zeros((data.shape[0])) if y is None else y
+        return np.mean([pearson_corr(data[labels == label, :]) for label in np.unique(labels)])
+    raise ValueError('Unknown objective function: ' + str(objective_function))
+
+def srca_search(rest_model, rest_target, task_model, task_target, objective_function='fisher_score',
+                y=None, regression='OLS'):
+    """
+    Stepwise channel search of one target channel (see mcee.stepwise_search)
+
+    Parameters
+    ----------
+    rest_model : (n_trials, n_channels, n_points)
+        Rest-state data of raw fitting channels.
+    rest_target : (n_trials, n_points)
+        Rest-state data of target channel.
+    task_model : (n_trials, n_channels, n_points)
+        Task-state data of raw fitting channels.
+    task_target : (n_trials, n_points)
+        Task-state data of target channel.
+    objective_function : str, optional
+        'fisher_score' or 'pearson_corr'. The default is 'fisher_score'.
+    y : (n_trials,), optional
+        Labels. The default is None.
+    regression : str, optional
+        'OLS' or 'Ridge'. The default is 'OLS'.
+
+    Returns
+    -------
+    model_index : list of int
+        Indices of the best fitting channels (in raw fitting channels).
+    """
+    objective = partial(srca_objective, objective_function=objective_function, y=y)
+    cache = mcee.gram_cache(rest_model, rest_target, regression)
+    model_index, _ = mcee.stepwise_search(cache, task_model, task_target, objective,
+                                          objective(task_target))
+    return model_index
+
+def srca_job(data_path, target_index, raw_index, rest, task, objective_function='fisher_score',
+             y=None, regression='OLS'):
+    """
+    srca_search of one target channel on the memory-mapped dataset (see mcee.SRCA_job)
+
+    Parameters
+    ----------
+    data_path : str
+        .npy file of the raw data, (n_trials, n_channels, n_points).
+    target_index : int
+        Index of the target channel.
+    raw_index : list of int
+        Indices of the raw fitting channels.
+    rest, task : slice
+        Points of rest & task state.
+    others : see srca_search.
+
+    Returns
+    -------
+    model_index : list of int
+        Indices of the best fitting channels (in raw fitting channels).
+    """
+    if data_path not in mcee.pool_data:
+        mcee.pool_data[data_path] = np.load(data_path, mmap_mode='r')
+    X = mcee.pool_data[data_path]
+    return srca_search(X[:, raw_index, rest], X[:, target_index, rest], X[:, raw_index, task],
+                       X[:, target_index, task], objective_function, y, regression)
+
+
 # main class
 class SRCA:
     """
@@ -408,7 +504,8 @@ class SRCA:
     """
     def __init__(self, sample_rate, target_channel, background_end_time, task_end_time = None,
                  background_begin_time = 0, task_begin_time = None, recursive_form = 'stepwise',
-                 raw_fitting_channels = None, objective_function = 'fisher_score', n_jobs = 1):
+                 raw_fitting_channels = None, objective_function = 'fisher_score', n_jobs = 1,
+                 regression = 'OLS'):
         """
 
         Parameters
@@ -427,7 +524,7 @@ class SRCA:
         task_begin_time : float, the default is None.
             Task EEG begin time, unit is second.
             When it is None, set it to background EEG end time.
-        recursive_form : string, the options are {'traversal','stepwise'},
+        recursive_form : string, the only option is 'stepwise' now,
                          the default is 'stepwise'.
             The recursive form for choose channels from raw fitting channals.
         raw_fitting_channels : string list list, the default is None.
@@ -439,11 +536,17 @@ class SRCA:
             The objective function.
         n_jobs : int, the default is 1.
             Parallel computing, the value is the number of processes.
+            Each target channel is searched in its own process; X is written once to a temporary
+            .npy file and memory-mapped by the workers instead of being pickled for every job.
+        regression : string, the options are {'OLS','Ridge'}, the default is 'OLS'.
+            The regression method of SRCA models.
 
         Raises
         ------
         ValueError
             Len of raw_fitting_channels must be equal to len of target_channel.
+        ValueError
+            Unsupported recursive_form.
 
         Returns
         -------
@@ -465,32 +568,71 @@ class SRCA:
         self.raw_fitting_channels = raw_fitting_channels
         if self.raw_fitting_channels != None and len(self.raw_fitting_channels) != len(self.target_channel):
             raise ValueError("len of raw_fitting_channels must be equal to len of target_channel.")
+        if recursive_form != 'stepwise':
+            raise ValueError("Only 'stepwise' recursive_form is supported.")
         self.recursive_form = recursive_form
         self.objective_function = objective_function
         self.n_jobs = n_jobs # Multiprocess parameter
+        self.regression = regression
         
-    def fit(self,X,y):
+    def fit(self, X, y=None, chans=None):
         """
 
         Parameters
         ----------
         X : ndarray, shape (n_trials, n_channels, n_points)
             Raw data.
-        y : ndarray, shape (n_trials)
-            Labels.
+        y : ndarray, shape (n_trials), optional
+            Labels. Required when objective_function is 'fisher_score' (exactly 2 classes).
+        chans : string list, optional
+            Names of all channels (the order corresponds to X).
+            If None, target_channel and raw_fitting_channels are treated as channel indices.
 
         Returns
         -------
-        None.
+        self : SRCA
+            Fitted model. The best fitting channels of each target channel are kept in
+            best_fitting_channels, and their indices in target_index & model_index.
 
         """
-        X = deepcopy(X)
-        y = deepcopy(y)
         n_trials, n_channels, n_points = X.shape
-        self.best_fitting_channels = self.raw_fitting_channels # The best fitting channels combination.
-        pass
-
-    def transform(self,X):
+        to_index = (lambda c: chans.index(c)) if chans is not None else int
+        to_name = (lambda i: chans[i]) if chans is not None else int
+        y = np.asarray(y) if y is not None else None
+
+        # candidate channels of each target channel
+        target_index = [to_index(tc) for tc in self.target_channel]
+        if self.raw_fitting_channels is None:
+            raw_index = [[i for i in range(n_channels) if i != ti] for ti in target_index]
+        else:
+            raw_index = [[to_index(c) for c in rfc] for rfc in self.raw_fitting_channels]
+
+        # one search job per target channel
+        rest = slice(self.background_begin_point, self.background_end_point)
+        task = slice(self.task_begin_point, self.task_end_point)
+        if self.n_jobs == 1:
+            results = [srca_search(X[:, raw_index[i], rest], X[:, target_index[i], rest],
+                                   X[:, raw_index[i], task], X[:, target_index[i], task],
+                                   self.objective_function, y, self.regression)
+                       for i in range(len(target_index))]
+        else:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                data_path = os.path.join(temp_dir, 'X.npy')
+                np.save(data_path, np.ascontiguousarray(X))
+                with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+                    futures = [executor.submit(srca_job, data_path, target_index[i], raw_index[i],
+                                               rest, task, self.objective_function, y, self.regression)
+                               for i in range(len(target_index))]
+                    results = [future.result() for future in futures]
+
+        # precomputed index arrays for transform
+        model_chans = [[raw_index[i][j] for j in results[i]] for i in range(len(target_index))]
+        self.best_fitting_channels = [[to_name(c) for c in mc] for mc in model_chans]
+        self.target_index, self.model_index, self.model_mask = mcee.srca_index(
+            target_index, model_chans, list(range(n_channels)))
+        return self
+
+    def transform(self, X):
         """
 
         Parameters
@@ -500,11 +642,11 @@ class SRCA:
 
         Returns
         -------
-        Residual_X : ndarray, shape (n_trials, n_best_fitting_channels, n_points)
+        Residual_X : ndarray, shape (n_trials, n_target_channels, n_task_points)
             Data after SRCA.
 
         """
-        Residual_X = deepcopy(X)
+        Residual_X = mcee.multi_srca(X, self.target_index, self.model_index, self.model_mask,
+            rest=(self.background_begin_point, self.background_end_point),
+            task=(self.task_begin_point, self.task_end_point), regression=self.regression)
         return Residual_X
-
-
@@ -9,6 +9,7 @@ Created on Sat Jan 11 15:14:37 2020
 import numpy as np
 import scipy.io as io
 import mcee
+from dataset_store import (fdata_store, SubsetReader)
 import pandas as pd
 import xlrd
 import matplotlib.pyplot as plt
@@ -127,22 +128,24 @@ for nPeo in range(len(nameList)):
     people = nameList[nPeo]
     print('Running ' + people + "'s data...")
     for fq in freq:
-        eeg = io.loadmat(r'D:\SSVEP\dataset\preprocessed_data\xwt_bishe\%s\f_%d.mat' %(people, fq))
-        f_data = eeg['f_data']
-        chans = eeg['chan_info'].tolist()
+        # only tar_chans & 1140:1640 are read from the (cached) file
+        store, name = fdata_store(r'D:\SSVEP\dataset\preprocessed_data\xwt_bishe\%s\f_%d.mat' %(people, fq))
+        reader = SubsetReader(store, chans=tar_chans, times=(1140, 1640))
         n_events = 2  
         ns = 40    
         print('Testing frequency: ' + str(fq) + 'Hz')
         for cv in range(10):  # cross-validation in training
             print('CV: %d turn...' %(cv+1))
             # randomly pick channels for identification
-            randPick = np.arange(f_data.shape[1])
+            randPick = np.arange(store[name].shape[1])
             np.random.shuffle(randPick)
+            train_all = reader(name, trials=randPick[:ns])
+            test_all = reader(name, trials=randPick[ns:])
             for nt in range(5): 
                 print('Data length: %d00ms' %(nt+1))
                 # extract origin data with correct trials & correct length [45,51,52,53,54,55,58,59,60]
-                train_data = f_data[:,randPick[:ns],:,1140:1240+nt*100][...,tar_list,:]
-                test_data = f_data[:,randPick[ns:],:,1140:1240+nt*100][...,tar_list,:]
+                train_data = train_all[..., :100+nt*100]
+                test_data = test_all[..., :100+nt*100]
             
                 # target identification main process
                 otrca = mcee.TRCA(test_data, train_data)
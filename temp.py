@@ -42,14 +42,10 @@ for cv in range(5):       # 交叉验证
         n_events = train_data.shape[0]
         template = train_data.mean(axis=1)  # template data: (n_events, n_chans, n_times)
         n_tests = test_data.shape[1]
-        r = np.zeros((n_events, n_tests, n_events))
-        # target identification
-        for ne in range(n_events):                       # test data 中按类别取出数据
-            for nte in range(n_tests):                 # test data 中每一类别有多个trials
-                for netr in range(n_events):             # n_events in training dataset  一个test trial 和所有类别的W计算相关系数
-                    temp_test = test_data[ne, nte, ...]  # (N_chans, N_points)
-                    temp_template = template[netr, ...]  # (N_chans, N_points)
-                    r[ne, nte, netr] = sCCA(temp_test, temp_template)  # 所有trails都会得出一个corrcoef, 存入netr中
+        # target identification: 所有test trials与所有类别的模板一次算完
+        Qx = np.linalg.qr(np.swapaxes(test_data, -1, -2))[0]  # (n_events, n_tests, N_points, N_chans)
+        Qy = np.linalg.qr(np.swapaxes(template, -1, -2))[0]   # (n_events, N_points, N_chans)
+        r = mcee.cca_score(Qx, Qy)  # (n_events, n_tests, n_events)
         accuracy = []
         # compute accuracys
         for ne in range(n_events):
@@ -63,53 +59,6 @@ for cv in range(5):       # 交叉验证
     print('acc_ori_CCA:', acc_ori_CCA.mean(axis=0))       # 按列求平均
     print('acc_ori_CCA:', np.std(acc_ori_CCA,axis=0))
 
-def sCCA(X,Y):
-    """
-
-    Parameters
-    -----------
-    X: (N_chans, N_points)
-        input data array (default z-scored after bandpass filtering)
-    Y: (2*N_harmos, N_points)
-        input data array (default z-scored after bandpass filtering)
-
-    Returns
-    ---------
-    corrcoef:float
-    """
-
-    # 转置
-    st_X = X.T                          # Np x Nc
-    st_Y = Y.T                          # Np x 2Nh
-
-    # 计算协方差
-    C_XX = np.dot(st_X.T,st_X)          # NcxNp,NpxNc = NcxNc
-    C_YY = np.dot(st_Y.T,st_Y)          # 2NhxNp,Npx2Nh = 2Nhx2Nh
-    C_XY = np.dot(st_X.T,st_Y)          # NcxNp,Npx2Nh = Ncx2Nh
-    C_YX = np.dot(st_Y.T,st_X)          # 2NhxNp,NpxNc = 2NhxNc
-
-    # 求C_XX、C_YY的逆矩阵
-    C_XX_Reverse = np.linalg.inv(C_XX)  # NcxNc
-    C_YY_Reverse = np.linalg.inv(C_YY)  # NhxNh
-
-    # 求X的系数特征值的方程
-    X_Feature_mat = np.dot(np.dot(C_XX_Reverse, C_XY), np.dot(C_YY_Reverse, C_YX))  # 特征方程 NcxNcxNcx2Nhx2Nhx2Nhx2NhxNc
-    eigvals_X, eigvectors_X = np.linalg.eig(X_Feature_mat)
-    X_coff = eigvectors_X[:, np.argmax(eigvals_X)]                                   # 计算最大特征值对应的特征向量，列向量
-
-    # 求Y的系数特征值的方程
-    Y_Feature_mat = np.dot(np.dot(C_YY_Reverse, C_YX), np.dot(C_XX_Reverse, C_XY))  # 特征方程 NcxNcxNcx2Nhx2Nhx2Nhx2NhxNc
-    eigvals_Y, eigvectors_Y = np.linalg.eig(Y_Feature_mat)
-    Y_coff = eigvectors_Y[:, np.argmax(eigvals_Y)]                                    # 计算最大特征值对应的特征向量，列向量
-
-    # 计算相关系数  np.corrcoef
-    Trans_X = np.dot(X_coff.T, st_X.T)              # 1xNcxNcxNp
-    Trans_Y = np.dot(Y_coff.T, st_Y.T)              # 1xNcxNcxNp
-    corrcoef_XY = np.corrcoef(Trans_X.T, Trans_Y.T)
-    corrcoef_XY = corrcoef_XY[0, 1]                 # 计算出的相关系数是一个矩阵
-
-    return corrcoef_XY
-
 
 # %%
 eeg = io.loadmat(r'D:\SSVEP\dataset\preprocessed_data\60&80\zhaowei\fir_50_90.mat')